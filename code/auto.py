@@ -52,7 +52,6 @@ class ExtensionHandler(FileSystemEventHandler):
             fsize = -1
             while fsize != os.path.getsize(event.src_path):
                 fsize = os.path.getsize(event.src_path)
-                print(fsize)
                 time.sleep(0.010)
             process_new_data()
 
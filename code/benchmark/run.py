@@ -0,0 +1,171 @@
+"""
+Pipeline benchmark on synthetic Terrameter LS2 data.
+
+Generates synthetic deployments at several scales, runs the stages of main.py
+against a scratch configuration and appends the timings to a JSON-lines file.
+With --baseline, stages slower than the baseline by more than --tolerance are
+reported as regressions.
+
+Run from the code directory:
+    python -m benchmark.run --scales small medium --output bench_results.jsonl
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmark.synthetic import SyntheticSurvey, generate, generate_models
+
+
+SCALES = {
+    'small': SyntheticSurvey(number_of_electrodes=32, number_of_tasks=1, number_of_gates=8, number_of_days=24),
+    'medium': SyntheticSurvey(number_of_electrodes=64, number_of_tasks=2, number_of_gates=12, number_of_days=240),
+    'large': SyntheticSurvey(number_of_electrodes=96, number_of_tasks=4, number_of_gates=20, number_of_days=1000),
+}
+
+# (stage name, function in main.py)
+STAGES = (
+    ('ingest', 'read_data'),
+    ('qc', 'quality_control'),
+    ('filter', 'filterr'),
+    ('write_dat', 'write_dats_indivual'),
+    ('read_xyz', 'read_results_single'),
+    ('plot', 'plot_pseudo_single'),
+    ('csv', 'data_to_csv'),
+)
+
+CONFIG = """
+PATH_TO_DATA = {root!r} + '/data'
+PATH_TO_PLOT = {root!r} + '/plot'
+PATH_TO_PSEUDO = {root!r} + '/pseudo'
+PATH_TO_PICKLE = {root!r} + '/pickle'
+PATH_TO_INVERSION_OUTPUT = {root!r} + '/inversion'
+INVERSION_PARAMS = {root!r} + '/inversion_params.ini'
+RES2DINV_EXE = ''
+TASK_IDS = (1,)  # set per scale
+PICKLE_NAME = 'benchmark.pickle'
+"""
+
+
+def write_config(root: str) -> None:
+    # Scratch settings package, imported by main.py instead of the site configuration
+    os.makedirs(os.path.join(root, 'settings'), exist_ok=True)
+    with open(os.path.join(root, 'settings', '__init__.py'), 'w') as fout:
+        fout.write('')
+    with open(os.path.join(root, 'settings', 'config.py'), 'w') as fout:
+        fout.write(CONFIG.format(root=root))
+
+
+def prepare(root: str, survey: SyntheticSurvey) -> None:
+    for name in ('data', 'plot', 'pseudo', 'pickle', 'inversion'):
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        os.makedirs(os.path.join(root, name))
+    with open(os.path.join(root, 'inversion_params.ini'), 'w') as fout:
+        fout.write('synthetic\n')
+    generate(survey, os.path.join(root, 'data'))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_scale(main, root: str, name: str, survey: SyntheticSurvey, skip: set, memory: bool, dtype: str) -> list[dict]:
+    main.TASK_IDS = tuple(range(1, survey.number_of_tasks + 1))
+    main.STORAGE_DTYPE = dtype
+    prepare(root, survey)
+    records = []
+    for stage, function in STAGES:
+        if stage in skip:
+            continue
+        if stage == 'read_xyz':
+            # Stand-in for the Res2DInv output (the inversion itself is not benchmarked)
+            generate_models(survey, os.path.join(root, 'inversion'))
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        getattr(main, function)()
+        seconds = time.perf_counter() - start
+        record = {'scale': name, 'stage': stage, 'dtype': dtype, 'seconds': round(seconds, 4),
+                  'electrodes': survey.number_of_electrodes, 'tasks': survey.number_of_tasks,
+                  'gates': survey.number_of_gates, 'days': survey.number_of_days}
+        if memory:
+            record['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        pickle = os.path.join(root, 'pickle', 'benchmark.pickle')
+        if os.path.isfile(pickle):
+            record['pickle_bytes'] = os.path.getsize(pickle)
+        if os.path.isfile(pickle + '.decay'):
+            record['decay_bytes'] = os.path.getsize(pickle + '.decay')
+        if os.path.isfile(pickle + '.journal'):
+            record['journal_bytes'] = os.path.getsize(pickle + '.journal')
+        records.append(record)
+        print('{:>8} {:>8} {:>10} {:10.3f} s'.format(name, dtype, stage, seconds))
+    return records
+
+
+def compare(records: list[dict], baseline_file: str, tolerance: float) -> list[str]:
+    baseline = dict()
+    with open(baseline_file, 'r') as fin:
+        for line in fin:
+            record = json.loads(line)
+            # Keep the latest baseline entry of each (scale, stage)
+            baseline[(record['scale'], record.get('dtype', 'float64'), record['stage'])] = record['seconds']
+    regressions = []
+    for record in records:
+        key = (record['scale'], record['dtype'], record['stage'])
+        if key in baseline and record['seconds'] > baseline[key] * (1 + tolerance):
+            regressions.append('{} {} {}: {:.3f} s (baseline {:.3f} s)'.format(*key, record['seconds'], baseline[key]))
+    return regressions
+
+
+def main_cli(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', default=['small'], choices=sorted(SCALES))
+    parser.add_argument('--skip', nargs='*', default=[], choices=[stage for stage, _ in STAGES])
+    parser.add_argument('--dtypes', nargs='+', default=['float64'], choices=['float64', 'float32'],
+                        help='storage dtypes of the raw and filtered arrays')
+    parser.add_argument('--output', default='bench_results.jsonl')
+    parser.add_argument('--baseline', default='')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--memory', action='store_true', help='record the tracemalloc peak of each stage')
+    parser.add_argument('--workdir', default='', help='scratch directory (temporary by default)')
+    args = parser.parse_args(argv)
+
+    root = args.workdir if args.workdir != '' else tempfile.mkdtemp(prefix='gemonpy_bench_')
+    root = os.path.abspath(root)
+    write_config(root)
+    sys.path.insert(0, root)
+    main = importlib.import_module('main')
+
+    revision = git_revision()
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    for name in args.scales:
+        for dtype in args.dtypes:
+            records += run_scale(main, root, name, SCALES[name], set(args.skip), args.memory, dtype)
+    with open(args.output, 'a') as fout:
+        for record in records:
+            fout.write(json.dumps({'time': stamp, 'revision': revision, **record}) + '\n')
+
+    if args.workdir == '':
+        shutil.rmtree(root, ignore_errors=True)
+    if args.baseline != '':
+        regressions = compare(records, args.baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,176 @@
+"""
+Synthetic Terrameter LS2 project databases for benchmarking.
+
+The generated project.db files contain the tables and columns queried in
+tools/database_io.py (Tasks, AcqSettings, TaskSettings, DPV, DP_ABMN, Measures,
+Datatype) with multiple-gradient quadrupoles, a smooth resistivity model with a
+slow temporal drift and exponential IP decays.
+"""
+import os
+import sqlite3
+
+import numpy as np
+
+from dataclasses import dataclass
+
+from tools.lib import geometric_factor, focus_point
+
+
+SCHEMA = """
+CREATE TABLE Tasks (ID INTEGER PRIMARY KEY, Name TEXT, SpacingX REAL, SpacingY REAL, SpacingZ REAL, ArrayCode INTEGER);
+CREATE TABLE AcqSettings (key1 INTEGER, key2 INTEGER, Setting TEXT, Value TEXT);
+CREATE TABLE TaskSettings (key1 INTEGER, Setting TEXT, Value TEXT);
+CREATE TABLE Datatype (ID INTEGER PRIMARY KEY, Name TEXT);
+CREATE TABLE Measures (ID INTEGER PRIMARY KEY, TaskID INTEGER, Time TEXT);
+CREATE TABLE DP_ABMN (ID INTEGER PRIMARY KEY, TaskID INTEGER,
+    APosX REAL, APosY REAL, APosZ REAL, BPosX REAL, BPosY REAL, BPosZ REAL,
+    MPosX REAL, MPosY REAL, MPosZ REAL, NPosX REAL, NPosY REAL, NPosZ REAL,
+    FocusX REAL, FocusY REAL, FocusZ REAL);
+CREATE TABLE DPV (TaskID INTEGER, MeasureID INTEGER, DPID INTEGER, Channel INTEGER,
+    DatatypeID INTEGER, SeqNum INTEGER, DataValue REAL, DataSDev REAL);
+"""
+
+DATATYPES = ((2, 'Rho'), (3, 'IP'), (5, 'R'), (6, 'I'), (7, 'U'))
+
+
+@dataclass
+class SyntheticSurvey:
+
+    number_of_electrodes: int = 32
+    number_of_tasks: int = 1
+    number_of_gates: int = 8
+    number_of_days: int = 24
+    interval_hours: int = 3
+    channels: int = 12
+    dropout: float = 0.0  # fraction of (measurement, day) values missing
+    outliers: float = 0.0  # fraction of (measurement, day) values with a large repeat error and a rising decay
+    seed: int = 0
+
+    def gate_widths(self) -> list[float]:
+        # Delay time followed by increasing window widths (IP_WindowSecList)
+        return [0.01] + [round(0.02 * 1.4 ** gate, 4) for gate in range(self.number_of_gates)]
+
+    def injections(self) -> list[tuple[int, int, list[tuple[int, int]]]]:
+        """ Multiple-gradient layout: (A, B, [(M, N), ...]) with electrode numbers starting at 1 """
+        result = []
+        separation = 4
+        while separation < self.number_of_electrodes:
+            for a in range(1, self.number_of_electrodes - separation + 1):
+                b = a + separation
+                pairs = [(m, m + 1) for m in range(a + 1, b - 1)][:self.channels]
+                result.append((a, b, pairs))
+            separation *= 2
+        return result
+
+    def dates(self) -> np.ndarray:
+        start = np.datetime64('2024-01-01T00:00:00')
+        return start + np.arange(self.number_of_days) * np.timedelta64(self.interval_hours, 'h')
+
+
+def generate(survey: SyntheticSurvey, path_to_data: str) -> list[str]:
+    """ Write one <YYYYmmdd_HHMMSS>/project.db per acquisition
+
+    Args:
+        survey (SyntheticSurvey): size of the synthetic deployment
+        path_to_data (str): output directory (PATH_TO_DATA)
+
+    Returns:
+        list[str]: the acquisition directories
+    """
+    rng = np.random.default_rng(survey.seed)
+    widths = survey.gate_widths()
+    gate_times = np.cumsum(widths)[1:] - np.array(widths[1:]) / 2
+    injections = survey.injections()
+
+    # Static geometry shared by all acquisitions
+    dp_abmn = []
+    layout = []  # (task, A, B, [(channel, dpid, K, focus_x)])
+    dpid = 1
+    for task in range(1, survey.number_of_tasks + 1):
+        for a, b, pairs in injections:
+            channels = []
+            for channel, (m, n) in enumerate(pairs, start=1):
+                fx, fz = focus_point(a, b, m, n)
+                dp_abmn.append((dpid, task, a, 0, 0, b, 0, 0, m, 0, 0, n, 0, 0, fx, 0, fz))
+                channels.append((channel, dpid, geometric_factor(a, b, m, n), fx, fz))
+                dpid += 1
+            layout.append((task, a, b, channels))
+    number_of_dpids = dpid - 1
+    base_apres = np.empty(number_of_dpids + 1)
+    tau = np.empty(number_of_dpids + 1)
+    for task, a, b, channels in layout:
+        for channel, dp, k, fx, fz in channels:
+            base_apres[dp] = 100 * (1 + 0.5 * np.sin(fx / 7) * np.exp(-fz / 10)) + 20 * task
+            tau[dp] = 0.3 + 0.2 * np.cos(fx / 5)
+
+    directories = []
+    for day, dt in enumerate(survey.dates()):
+        name = np.datetime_as_string(dt, unit='s').replace('-', '').replace(':', '').replace('T', '_')
+        directory = os.path.join(path_to_data, name)
+        os.makedirs(directory, exist_ok=True)
+        database = os.path.join(directory, 'project.db')
+        if os.path.isfile(database):
+            os.remove(database)
+        drift = 1 + 0.05 * np.sin(2 * np.pi * day / max(survey.number_of_days, 2))
+        time = np.datetime_as_string(dt, unit='s').replace('T', ' ')
+        measures = []
+        dpv = []
+        for measure_id, (task, a, b, channels) in enumerate(layout, start=1):
+            current = 0.1 + 0.01 * rng.standard_normal()
+            measures.append((measure_id, task, time))
+            dpv.append((task, measure_id, 0, 14, 6, 0, current, 0.0))
+            for channel, dp, k, fx, fz in channels:
+                if rng.random() < survey.dropout:
+                    continue
+                outlier = rng.random() < survey.outliers
+                apres = base_apres[dp] * drift * (1 + 0.01 * rng.standard_normal())
+                res = apres / k
+                sdev = 20.0 if outlier else 0.1
+                dpv.append((task, measure_id, dp, channel, 2, 0, apres, sdev))
+                dpv.append((task, measure_id, dp, channel, 5, 0, res, sdev))
+                dpv.append((task, measure_id, dp, channel, 7, 0, res * current, sdev))
+                decay = 0.01 * drift * np.exp(-gate_times / tau[dp]) + 5e-5 * rng.standard_normal(len(gate_times))
+                if outlier:
+                    decay = decay[::-1]
+                for gate, value in enumerate(decay, start=1):
+                    dpv.append((task, measure_id, dp, channel, 3, gate, value, 0.5))
+        with sqlite3.connect(database) as connection:
+            connection.executescript(SCHEMA)
+            connection.executemany('INSERT INTO Datatype VALUES (?, ?)', DATATYPES)
+            for task in range(1, survey.number_of_tasks + 1):
+                connection.execute('INSERT INTO Tasks VALUES (?, ?, 1, 1, 1, 11)', (task, f'Line {task}'))
+                connection.execute("INSERT INTO AcqSettings VALUES (?, ?, 'IP_WindowSecList', ?)",
+                                   (task, task, ' '.join(map(str, widths))))
+                connection.execute("INSERT INTO TaskSettings VALUES (?, 'ElectrodeSpacing', '1;1;1')", (task,))
+            connection.executemany('INSERT INTO DP_ABMN VALUES ({})'.format(', '.join('?' * 17)), dp_abmn)
+            connection.executemany('INSERT INTO Measures VALUES (?, ?, ?)', measures)
+            connection.executemany('INSERT INTO DPV VALUES (?, ?, ?, ?, ?, ?, ?, ?)', dpv)
+        connection.close()
+        directories.append(directory)
+    return directories
+
+
+def write_xyz(filename: str, x: np.ndarray, z: np.ndarray, resistivity: np.ndarray, chargeability: np.ndarray) -> None:
+    """ Res2DInv model output in the layout parsed by reader.read_res2dinv_xyz_single """
+    with open(filename, 'w') as fout:
+        fout.write('Synthetic model\n/\n/\n/\n/\n')
+        fout.write('{} 6\n'.format(len(x)))
+        for row in zip(x, z, resistivity, np.log10(resistivity), 1 / resistivity, chargeability):
+            fout.write('{:.3f} {:.3f} {:.4f} {:.4f} {:.6f} {:.4f}\n'.format(*row))
+        fout.write('/\n')
+
+
+def generate_models(survey: SyntheticSurvey, path_to_inversion_output: str, cells: int = 400) -> None:
+    """ Inverted sections for every task and acquisition (input of read_results_single) """
+    rng = np.random.default_rng(survey.seed + 1)
+    side = int(np.sqrt(cells))
+    x, z = np.meshgrid(np.linspace(0, survey.number_of_electrodes, side), np.linspace(0.5, survey.number_of_electrodes / 6, side))
+    x, z = x.ravel(), z.ravel()
+    for task in range(1, survey.number_of_tasks + 1):
+        directory = os.path.join(path_to_inversion_output, 'individual', f'task_{task}')
+        os.makedirs(directory, exist_ok=True)
+        for day, dt in enumerate(survey.dates()):
+            name = np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00.xyz'
+            resistivity = 100 * (1 + 0.5 * np.sin(x / 7)) * (1 + 0.01 * rng.standard_normal(len(x)))
+            chargeability = 5 + np.cos(x / 5) + 0.1 * rng.standard_normal(len(x))
+            write_xyz(os.path.join(directory, name), x, z, resistivity, chargeability)
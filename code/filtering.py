@@ -1,3 +1,6 @@
+import os
+import warnings
+
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
 
@@ -23,36 +26,227 @@ class FillMissingData(FilteringStrategy):
     interval: tuple = (3, 'h')
     kind: str = 'cubic'
 
-    def filter(self, dates: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    MINIMUM_POINTS = {'linear': 2, 'quadratic': 3, 'cubic': 4}
+
+    def filter(self, dates: np.ndarray, values: np.ndarray, valid: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
         """_summary_
 
         Args:
             dates (np.ndarray): dates
             values (np.ndarray): values to be filtered [resistance, app.resistivity, chargeability]
+            valid (np.ndarray): validity mask of values, by default the non-NaN entries
 
         Returns:
-            tuple[np.ndarray, np.ndarray]: Return a tuple of interpolated values
+            tuple[np.ndarray, np.ndarray]: Return a tuple of interpolated values (in the dtype of values),
+                NaN outside the valid range of a measurement
         """
 
         number_of_measurements, number_of_days = values.shape
+        if valid is None:
+            valid = ~np.isnan(values)
+        valid = valid & ~np.isnan(values)
 
         # Round the dates and get the missing dates
         dates_rounded = np.array(dates, dtype='datetime64[h]')
         dates_all = np.arange(min(dates_rounded), max(dates_rounded)+1, np.timedelta64(*self.interval))
-        dates_mapper = {key: value for value, key in enumerate(dates_all)}
         
         # Interpolations requires numbers instead of 'dates'
         number_of_days_interp = len(dates_all)
-        x = [dates_mapper[date_round] for date_round in dates_rounded]
+        x = (dates_rounded - dates_all[0]) / np.timedelta64(*self.interval)
         xnew = np.arange(0, number_of_days_interp)
         
-        values_filtered = np.empty([number_of_measurements, number_of_days_interp])
-        for meas_id in range(number_of_measurements):
-            f = interp1d(x, values[meas_id, :], kind=self.kind)
-            values_filtered[meas_id, :] = f(xnew)
-        return dates_all, values_filtered
+        values_filtered = np.full([number_of_measurements, number_of_days_interp], np.nan)
+        # Measurements with the same gaps share one interpolation over all their rows
+        patterns, inverse = np.unique(valid, axis=0, return_inverse=True)
+        for pattern_id, pattern in enumerate(patterns):
+            rows = np.flatnonzero(inverse.ravel() == pattern_id)
+            number_of_points = pattern.sum()
+            if number_of_points < 2:
+                continue
+            kind = self.kind
+            if number_of_points < self.MINIMUM_POINTS.get(kind, 2):
+                kind = 'linear'
+            # Spline coefficients in float64 also for float32 storage
+            f = interp1d(x[pattern], values[np.ix_(rows, pattern)].astype(np.float64), kind=kind,
+                         axis=1, bounds_error=False, fill_value=np.nan, assume_sorted=False)
+            values_filtered[rows, :] = f(xnew)
+        return dates_all, values_filtered.astype(values.dtype, copy=False)
     
 
+@dataclass
+class KalmanState:
+    """ Filtered level of every measurement after its last acquisition, to continue with new samples """
+
+    date: np.datetime64  # last date filtered, None before the first one
+    mean: np.ndarray  # (measurements,) filtered level
+    variance: np.ndarray  # (measurements,) its variance, inf before the first valid value
+    scale: np.ndarray  # (measurements,) typical magnitude the noise levels are relative to
+
+    def save(self, filename: str) -> None:
+        """ Write the state to an npz file (replaced atomically) """
+        date = np.datetime64('NaT', 's') if self.date is None else np.datetime64(self.date, 's')
+        tmp = filename[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp, date=date, mean=self.mean, variance=self.variance, scale=self.scale)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename: str):
+        """ State saved by save, None if there is none """
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as stored:
+            date = stored['date'][()]
+            return cls(None if np.isnat(date) else date, stored['mean'], stored['variance'], stored['scale'])
+
+
+@dataclass
+class KalmanSmoother(FilteringStrategy):
+    """ Kalman filter and Rauch-Tung-Striebel smoother on the acquisition dates
+
+    Each measurement is a level following a random walk, observed with noise. Between two dates
+    dt days apart the level changes with variance (process_noise * scale) ** 2 * dt, and a value has
+    the variance (measurement_noise * scale) ** 2, where scale is the median magnitude of the
+    measurement. All measurements are filtered together along the shared dates, each with its
+    own gaps, so no regular grid is needed.
+    """
+
+    process_noise: float = 0.01  # relative standard deviation of the change per day
+    measurement_noise: float = 0.02  # relative standard deviation of a value (lower bound with errors)
+
+    def filter(self, dates: np.ndarray, values: np.ndarray, valid: np.ndarray = None,
+               errors: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """ Smoothed values on the acquisition dates (see smooth)
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: sorted dates and smoothed values, as FillMissingData.filter
+        """
+        dates, mean, _, _ = self.smooth(dates, values, valid, errors)
+        return dates, mean
+
+    def smooth(self, dates: np.ndarray, values: np.ndarray, valid: np.ndarray = None,
+               errors: np.ndarray = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, KalmanState]:
+        """ Smoothed values and their uncertainty
+
+        Args:
+            dates (np.ndarray): acquisition dates, in any order
+            values (np.ndarray): (measurements, days) values [resistance, app.resistivity, chargeability]
+            valid (np.ndarray): validity mask of values, by default the non-NaN entries
+            errors (np.ndarray): (measurements, days) relative standard deviation of each value (e.g. the
+                repeat error / 100), NaN where unknown
+
+        Returns:
+            tuple: sorted dates, smoothed values and their standard deviation (in the dtype of values,
+                NaN outside the valid range of a measurement), and the state for update
+        """
+        order = np.argsort(dates, kind='stable')
+        dates = np.asarray(dates)[order]
+        observations = self._observations(values, valid)[:, order]
+        state = self.initial_state(observations)
+        noise = self._noise(state, observations, None if errors is None else errors[:, order])
+        filtered, filtered_variance, predicted, predicted_variance, state = self._forward(state, dates, observations, noise)
+
+        # Backward pass: each day corrected by the smoothed next day
+        mean, variance = filtered.copy(), filtered_variance.copy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for day in range(len(dates) - 2, -1, -1):
+                gain = filtered_variance[:, day] / predicted_variance[:, day + 1]
+                mean[:, day] += gain * (mean[:, day + 1] - predicted[:, day + 1])
+                variance[:, day] += gain ** 2 * (variance[:, day + 1] - predicted_variance[:, day + 1])
+
+        # Nothing is extrapolated before the first or after the last valid value
+        observed = ~np.isnan(observations)
+        inside = (np.cumsum(observed, axis=1) > 0) & (np.cumsum(observed[:, ::-1], axis=1)[:, ::-1] > 0)
+        mean[~inside] = np.nan
+        variance[~inside] = np.nan
+        return dates, mean.astype(values.dtype, copy=False), np.sqrt(variance).astype(values.dtype, copy=False), state
+
+    def update(self, state: KalmanState, dates: np.ndarray, values: np.ndarray, valid: np.ndarray = None,
+               errors: np.ndarray = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, KalmanState]:
+        """ Filtered values of new acquisitions, continuing from an earlier smooth or update
+
+        The new values are filtered with the ones before them only (the earlier days are not smoothed again).
+
+        Args:
+            state (KalmanState): state returned by smooth or update
+            dates (np.ndarray): new acquisition dates, after state.date
+            values (np.ndarray): (measurements, new days) values
+            valid (np.ndarray): validity mask of values
+            errors (np.ndarray): relative standard deviation of each value
+
+        Returns:
+            tuple: sorted dates, filtered values and their standard deviation (NaN before the first valid
+                value of a measurement), and the new state
+        """
+        order = np.argsort(dates, kind='stable')
+        dates = np.asarray(dates)[order]
+        observations = self._observations(values, valid)[:, order]
+        noise = self._noise(state, observations, None if errors is None else errors[:, order])
+        mean, variance, _, _, state = self._forward(state, dates, observations, noise)
+        known = np.isfinite(variance)
+        mean[~known] = np.nan
+        variance[~known] = np.nan
+        return dates, mean.astype(values.dtype, copy=False), np.sqrt(variance).astype(values.dtype, copy=False), state
+
+    def initial_state(self, observations: np.ndarray) -> KalmanState:
+        # Unknown levels (infinite variance), noise relative to the median magnitude of each measurement
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # measurements without any valid value
+            scale = np.nanmedian(np.abs(observations), axis=1)
+        scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+        number_of_measurements = len(observations)
+        return KalmanState(None, np.zeros(number_of_measurements), np.full(number_of_measurements, np.inf), scale)
+
+    @staticmethod
+    def _observations(values: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        # float64 values, NaN where not valid
+        observations = values.astype(np.float64)
+        if valid is not None:
+            observations[~valid] = np.nan
+        return observations
+
+    def _noise(self, state: KalmanState, observations: np.ndarray, errors: np.ndarray) -> np.ndarray:
+        # Variance of each value
+        relative = np.full(observations.shape, self.measurement_noise)
+        if errors is not None:
+            relative = np.fmax(relative, errors.astype(np.float64))
+        return (relative * state.scale[:, np.newaxis]) ** 2
+
+    def _forward(self, state: KalmanState, dates: np.ndarray, observations: np.ndarray, noise: np.ndarray) -> tuple:
+        # Filtered and predicted means and variances of every day, and the state after the last day
+        filtered = np.empty(observations.shape)
+        filtered_variance = np.empty(observations.shape)
+        predicted = np.empty(observations.shape)
+        predicted_variance = np.empty(observations.shape)
+        mean, variance, last = state.mean.copy(), state.variance.copy(), state.date
+        process = (self.process_noise * state.scale) ** 2
+        for day in range(len(dates)):
+            elapsed = 0.0 if last is None else max((dates[day] - last) / np.timedelta64(1, 'D'), 0.0)
+            variance += process * elapsed
+            predicted[:, day], predicted_variance[:, day] = mean, variance
+            observed = ~np.isnan(observations[:, day])
+            first = observed & np.isinf(variance)
+            update = observed & ~first
+            gain = variance[update] / (variance[update] + noise[update, day])
+            mean[update] += gain * (observations[update, day] - mean[update])
+            variance[update] *= 1 - gain
+            mean[first], variance[first] = observations[first, day], noise[first, day]
+            filtered[:, day], filtered_variance[:, day] = mean, variance
+            last = dates[day]
+        return filtered, filtered_variance, predicted, predicted_variance, KalmanState(last, mean, variance, state.scale)
+
+
+def _valid_runs(values: np.ndarray):
+    # Rows with the same gaps and each run of consecutive non-NaN days they share
+    if len(values) == 0:
+        return
+    patterns, inverse = np.unique(~np.isnan(values), axis=0, return_inverse=True)
+    for pattern_id, pattern in enumerate(patterns):
+        rows = np.flatnonzero(inverse.ravel() == pattern_id)
+        edges = np.diff(np.r_[0, pattern.astype(np.int8), 0])
+        for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            yield rows, slice(start, end)
+
+
 @dataclass
 class Median(FilteringStrategy):
 
@@ -65,13 +259,16 @@ class Median(FilteringStrategy):
             values (np.ndarray): values to be filtered [resistance, app.resistivity, chargeability]
 
         Returns:
-            _type_: Return a numpy array with the filtered values
+            _type_: Return a numpy array with the filtered values (NaN where values are NaN, each run
+                of consecutive valid days is filtered on its own)
         """
 
-        number_of_measurements, number_of_days = values.shape
-        values_filtered = np.empty([number_of_measurements, number_of_days])
-        for meas_id in range(number_of_measurements):
-            values_filtered[meas_id, :] = medfilt(values[meas_id, :], self.window_length)
+        values_filtered = np.full(values.shape, np.nan, dtype=values.dtype)
+        # One 2-D median per run of the measurements with the same gaps (kernel along the days only)
+        for rows, run in _valid_runs(values):
+            length = run.stop - run.start
+            window_length = min(self.window_length, length - (length % 2 == 0))
+            values_filtered[rows, run] = medfilt(values[rows, run], [1, window_length])
         return values_filtered
 
 
@@ -90,24 +287,25 @@ class Butterworth(FilteringStrategy):
             values (np.ndarray): values to be filtered [resistance, app.resistivity, chargeability]
 
         Returns:
-            np.ndarray: Return a numpy array with the filtered values
+            np.ndarray: Return a numpy array with the filtered values (in the dtype of values),
+                NaN where values are NaN, each run of consecutive valid days is filtered on its own
         """
 
         nyq = 0.5 * self.fs
         normal_cutoff = self.cutoff / nyq
         b, a = butter(self.order, normal_cutoff, btype='low', analog=False)
 
-        number_of_measurements, number_of_days = values.shape
-        values_filtered_forward = np.empty([number_of_measurements, number_of_days])
-        values_filtered_reverse = np.empty([number_of_measurements, number_of_days])
-        for meas_id in range(number_of_measurements):
-            values_filtered_forward[meas_id, :] = lfilter(b, a, values[meas_id, :])
-            values_filtered_reverse[meas_id, :] = lfilter(b, a, values[meas_id, ::-1])
-        values_filtered_reverse = values_filtered_reverse[:, ::-1]
-        values_filtered = (values_filtered_forward+values_filtered_reverse) / 2
-        values_filtered[:, :20] = values_filtered_reverse[:, :20]
-        values_filtered[:, -20:] = values_filtered_reverse[:, -20:]
-        return values_filtered
+        result = np.full(values.shape, np.nan, dtype=values.dtype)
+        for rows, run in _valid_runs(values):
+            # The IIR recursion accumulates in float64 also for float32 storage
+            series = values[rows, run].astype(np.float64)
+            values_filtered_forward = lfilter(b, a, series, axis=1)
+            values_filtered_reverse = lfilter(b, a, series[:, ::-1], axis=1)[:, ::-1]
+            values_filtered = (values_filtered_forward+values_filtered_reverse) / 2
+            values_filtered[:, :20] = values_filtered_reverse[:, :20]
+            values_filtered[:, -20:] = values_filtered_reverse[:, -20:]
+            result[rows, run] = values_filtered
+        return result
 
     def frequency_response(self) -> np.ndarray:
         b, a = self.butter_lowpass(self.cutoff, self.fs, self.order)
@@ -115,4 +313,123 @@ class Butterworth(FilteringStrategy):
 
         xf, yf = 0.5*self.fs*w/np.pi, np.abs(h)
         return np.array(xf, yf)
-    
+
+
+@dataclass
+class ChangeDetection:
+
+    threshold: float = 0.02  # RMS relative change to the last inverted timestep that triggers an inversion
+    cadence: tuple = (24, 'h')  # longest interval between two inverted timesteps
+
+    def select(self, dates: np.ndarray, values: np.ndarray, reference: np.ndarray = None,
+               reference_date: np.datetime64 = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Select the timesteps worth inverting
+
+        Args:
+            dates (np.ndarray): candidate dates, ascending
+            values (np.ndarray): (measurements, candidates) filtered values at the candidate dates
+            reference (np.ndarray): values of the last inverted timestep, None if nothing was inverted yet
+            reference_date (np.datetime64): date of the last inverted timestep
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: change metric, selection and reason of each candidate
+        """
+        number_of_candidates = len(dates)
+        metric = np.full(number_of_candidates, np.nan)
+        selected = np.zeros(number_of_candidates, dtype=bool)
+        reason = np.empty(number_of_candidates, dtype=object)
+        cadence = np.timedelta64(*self.cadence)
+        for index in range(number_of_candidates):
+            column = values[:, index].astype(np.float64)
+            if reference is None:
+                selected[index], reason[index] = True, 'first'
+            else:
+                # RMS relative change over the measurements known at both timesteps
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    change = ((column - reference) / reference) ** 2
+                known = np.isfinite(change)
+                if known.any():
+                    metric[index] = np.sqrt(change[known].mean())
+                if not known.any():
+                    selected[index], reason[index] = True, 'no common measurements'
+                elif metric[index] > self.threshold:
+                    selected[index], reason[index] = True, 'change'
+                elif dates[index] - reference_date >= cadence:
+                    selected[index], reason[index] = True, 'cadence'
+                else:
+                    reason[index] = 'change below threshold'
+            if selected[index]:
+                reference, reference_date = column, dates[index]
+        return metric, selected, reason.astype(str)
+
+
+@dataclass
+class QualityControl(FilteringStrategy):
+
+    max_repeat_error: float = 5.0  # stacking error of the resistance [%]
+    max_apres_mismatch: float = 0.05  # relative difference between apres and K * resistance
+    max_decay_rise: float = 0.05  # rise between consecutive gates, relative to the first gate
+    max_decay_rises: int = 1  # rising gates tolerated in a decay
+    max_reciprocal_error: float = 10.0  # normal/reciprocal resistance difference [%]
+    days_per_block: int = 256  # the decay cube is read in blocks of days
+
+    def filter(self, raw) -> np.ndarray:
+        """ Reject noisy measurements before the inversion
+
+        Args:
+            raw (GeophysicalTimeSeriesRaw): raw data
+
+        Returns:
+            np.ndarray: (measurements, days) mask, True where an acquired measurement is rejected.
+                Unknown quantities (NaN) never reject a measurement.
+        """
+        rejected = self.repeat_error(raw.repeat_error)
+        rejected |= self.inconsistent_apres(raw.apres, raw.resistance, raw.metadata.k)
+        rejected |= self.irregular_decay(raw)
+        rejected |= self.reciprocal_error(raw.metadata.abmn, raw.resistance)
+        return rejected & raw.valid
+
+    def repeat_error(self, repeat_error: np.ndarray) -> np.ndarray:
+        return repeat_error > self.max_repeat_error
+
+    def inconsistent_apres(self, apres: np.ndarray, resistance: np.ndarray, k: np.ndarray) -> np.ndarray:
+        # Negative apparent resistivity or one that does not match the geometric factor
+        apres = apres.astype(np.float64)
+        mismatch = np.abs(apres - k[:, np.newaxis] * resistance) > self.max_apres_mismatch * np.abs(apres)
+        return (apres <= 0) | mismatch
+
+    def irregular_decay(self, raw) -> np.ndarray:
+        # Decays starting non-positive or rising between gates more often than tolerated
+        number_of_measurements, number_of_days, number_of_gates = raw.decay.shape
+        rejected = np.zeros([number_of_measurements, number_of_days], dtype=bool)
+        if number_of_gates < 2:
+            return rejected
+        for start in range(0, number_of_days, self.days_per_block):
+            days = slice(start, start + self.days_per_block)
+            decay = raw.decay_slice(days=days).astype(np.float64)
+            first = decay[:, :, 0]
+            rises = (np.diff(decay, axis=2) > self.max_decay_rise * np.abs(first)[:, :, np.newaxis]).sum(axis=2)
+            rejected[:, days] = (first <= 0) | (rises > self.max_decay_rises)
+        return rejected
+
+    def reciprocal_error(self, abmn: np.ndarray, resistance: np.ndarray) -> np.ndarray:
+        # Quadrupoles measured also as reciprocal (MNAB) with too different resistances
+        rejected = np.zeros(resistance.shape, dtype=bool)
+        positions, electrodes = np.unique(abmn, return_inverse=True)
+        a, b, m, n = electrodes.reshape(-1, 4).T.astype(np.int64)
+        number_of_positions = len(positions)
+        normal = ((a * number_of_positions + b) * number_of_positions + m) * number_of_positions + n
+        reciprocal = ((m * number_of_positions + n) * number_of_positions + a) * number_of_positions + b
+        order = np.argsort(normal)
+        position = np.clip(np.searchsorted(normal[order], reciprocal), 0, len(normal) - 1)
+        found = normal[order][position] == reciprocal
+        if not found.any():
+            return rejected
+        normals = np.flatnonzero(found)
+        reciprocals = order[position[found]]
+        r_normal = resistance[normals].astype(np.float64)
+        r_reciprocal = resistance[reciprocals].astype(np.float64)
+        error = np.abs(r_normal - r_reciprocal) / ((np.abs(r_normal) + np.abs(r_reciprocal)) / 2) * 100
+        # Each pair is found from both sides, so both quadrupoles are flagged
+        rejected[normals] = error > self.max_reciprocal_error
+        return rejected
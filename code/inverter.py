@@ -1,7 +1,20 @@
+import os
 import subprocess
 
 from settings.config import RES2DINV_EXE
+from tools.instrumentation import count
 
 
 def invert_batch_file(BATCH_FILE: str) -> None:
-    subprocess.call([RES2DINV_EXE, BATCH_FILE])
\ No newline at end of file
+    with open(BATCH_FILE, 'r') as fin:
+        number_of_files = int(fin.readline())
+    subprocess.call([RES2DINV_EXE, BATCH_FILE])
+    count('inversions_run', number_of_files)
+
+
+def backend_version() -> str:
+    # Fingerprint of the inversion executable (part of the inversion cache key)
+    if not os.path.isfile(RES2DINV_EXE):
+        return os.path.basename(RES2DINV_EXE)
+    stat = os.stat(RES2DINV_EXE)
+    return '{}:{}:{}'.format(os.path.basename(RES2DINV_EXE), stat.st_size, int(stat.st_mtime))
@@ -1,216 +1,828 @@
 import os
 
 from shutil import copyfile
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-from reader import TerrameterDatabase, read_res2dinv_xyz_single
+from reader import AarhusInvTx2, MPTDAS, Res2DInvDat, TerrameterDatabase, read_res2dinv_xyz_single
 from tools.lib import my_timer
+from tools.instrumentation import instrumentation, count
+from tools.inversion_cache import InversionCache
+from tools.shards import ShardedTimeSeries
+from tools.history import aggregate_table
+from tools.database_io import integral_decay
+from tools.decay_fit import FIT_FIELDS, fit_decays
+from tools.anomaly import AnomalyDetector
 
 import filtering as flt
 import plotter as p
 import writter as w
 
-from inverter import invert_batch_file
+from inverter import invert_batch_file, backend_version
 
-from tools.geodata import GeophysicalTimeSeries
+from tools.geodata import GeophysicalTimeSeries, GeophysicalTimeSeriesResults, VALUE_FIELDS
 
 from settings.config import PATH_TO_DATA, PATH_TO_PLOT, PATH_TO_PSEUDO, PATH_TO_PICKLE, PATH_TO_INVERSION_OUTPUT, INVERSION_PARAMS
 from settings.config import TASK_IDS, PICKLE_NAME
 
+try:
+    from settings.config import PATH_TO_METRICS  # optional: JSON-lines log or '.prom' file
+except ImportError:
+    PATH_TO_METRICS = ''
+try:
+    from settings.config import STORAGE_DTYPE  # optional: 'float32' halves memory and pickle size
+except ImportError:
+    STORAGE_DTYPE = 'float64'
+try:
+    from settings.config import CHANGE_THRESHOLD  # optional: invert only timesteps that changed (RMS relative change)
+except ImportError:
+    CHANGE_THRESHOLD = 0.0
+try:
+    from settings.config import INVERSION_CADENCE_HOURS  # optional: with CHANGE_THRESHOLD, invert at least this often
+except ImportError:
+    INVERSION_CADENCE_HOURS = 24
+try:
+    from settings.config import TIMELAPSE_BASELINE  # optional: baseline day (chronological index) or 'rolling'
+except ImportError:
+    TIMELAPSE_BASELINE = 0
+try:
+    from settings.config import TIMELAPSE_SECTIONS  # optional: time sections per time-lapse dat file
+except ImportError:
+    TIMELAPSE_SECTIONS = 2
+try:
+    from settings.config import TIMELAPSE_START  # optional: first day (chronological index) in a time-lapse file
+except ImportError:
+    TIMELAPSE_START = 5
+try:
+    from settings.config import PATH_TO_INVERSION_CACHE  # optional: outputs of earlier inversions by input hash
+except ImportError:
+    PATH_TO_INVERSION_CACHE = os.path.join(PATH_TO_INVERSION_OUTPUT, 'cache')
+try:
+    from settings.config import INVERSION_CACHE_BYTES  # optional: least recently used entries are evicted above
+except ImportError:
+    INVERSION_CACHE_BYTES = 2 * 1024 ** 3
+try:
+    from settings.config import TASK_WORKERS  # optional: worker processes of the per-task chain
+except ImportError:
+    TASK_WORKERS = 1
+try:
+    from settings.config import SHARD_PERIOD  # optional: 'M' stores one pickle per month ('Y' per year)
+except ImportError:
+    SHARD_PERIOD = ''
+try:
+    from settings.config import FILTER_LOOKBACK_DAYS  # optional: with SHARD_PERIOD, days of the previous shard filtered along
+except ImportError:
+    FILTER_LOOKBACK_DAYS = 7
+try:
+    from settings.config import FILTER_STRATEGY  # optional: 'kalman' smooths on the acquisition dates, with uncertainty
+except ImportError:
+    FILTER_STRATEGY = 'fill'
+try:
+    from settings.config import INPUT_FORMAT  # optional: 'mpt' (.Ohm), 'res2dinv' (.dat) or 'aarhusinv' (.tx2) files
+except ImportError:
+    INPUT_FORMAT = 'terrameter'
+try:
+    from settings.config import PATH_TO_MONITOR  # optional: state and alerts.jsonl of the online anomaly detection
+except ImportError:
+    PATH_TO_MONITOR = ''
+try:
+    from settings.config import BACKFILL_MEMORY_MB  # optional: memory of the acquisitions read per backfill batch
+except ImportError:
+    BACKFILL_MEMORY_MB = 1024
+try:
+    from settings.config import DECAY_FIT_WORKERS  # optional: worker processes of fit_decay_curves
+except ImportError:
+    DECAY_FIT_WORKERS = 1
+
+try:
+    from settings.config import TRACE_MEMORY  # optional: with PATH_TO_METRICS, peak Python memory of each stage
+except ImportError:
+    TRACE_MEMORY = False
+
 PICKLE_FULLPATH = os.path.join(PATH_TO_PICKLE, PICKLE_NAME)
+PATH_TO_SHARDS = PICKLE_FULLPATH + '.shards'
+
+if PATH_TO_METRICS != '':
+    instrumentation.enable(PATH_TO_METRICS, trace_memory=TRACE_MEMORY)
+
+def shard_store() -> ShardedTimeSeries:
+    store = ShardedTimeSeries(PATH_TO_SHARDS, SHARD_PERIOD)
+    if len(store.keys()) == 0 and os.path.isfile(PICKLE_FULLPATH):
+        # First run on an archive kept in a single pickle
+        store.split(GeophysicalTimeSeries.load(PICKLE_FULLPATH))
+    return store
+
+def load_data(start=None, end=None) -> GeophysicalTimeSeries:
+    """ The stored time series, with SHARD_PERIOD the shards overlapping [start, end] """
+    if SHARD_PERIOD == '':
+        return GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+    return shard_store().query(start, end)
+
+def save_data(data: GeophysicalTimeSeries) -> None:
+    if SHARD_PERIOD == '':
+        data.save(PICKLE_FULLPATH)
+    else:
+        shard_store().update(data)
+
+def data_to_update(stage: str):
+    """ Time series a stage runs on: the whole pickle, or each shard with days new to the stage """
+    if SHARD_PERIOD == '':
+        yield GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+        return
+    store = shard_store()
+    for key in store.stale(stage):
+        yield store.open([key])
+        # Once the stage saved the shard
+        store.mark_done(stage, key)
+
+def make_reader():
+    # Reader of the INPUT_FORMAT files in PATH_TO_DATA (Terrameter project databases by default)
+    readers = {'mpt': MPTDAS, 'res2dinv': Res2DInvDat, 'aarhusinv': AarhusInvTx2}
+    if INPUT_FORMAT == 'terrameter':
+        return TerrameterDatabase(TASK_IDS, value_dtype=STORAGE_DTYPE)
+    return readers[INPUT_FORMAT](task_id=TASK_IDS[0], value_dtype=STORAGE_DTYPE)
 
 @my_timer
 def read_data():
-    reader = TerrameterDatabase(TASK_IDS)
+    reader = make_reader()
 
     path = PATH_TO_DATA
 
     reader.read_data(path)
-    reader.save_data(PICKLE_NAME)
+    if SHARD_PERIOD == '':
+        reader.save_data(PICKLE_NAME)
+    else:
+        store = ShardedTimeSeries(PATH_TO_SHARDS, SHARD_PERIOD)
+        store.clear()
+        store.append(reader.data.raw)
+    # The filter states of the previous data do not apply to the new store
+    for name in ('resistance', 'apres', 'chargeability'):
+        if os.path.isfile(kalman_state_file(name)):
+            os.remove(kalman_state_file(name))
+    monitor_raw(reader.data.raw, slice(None))
 
 @my_timer
 def extend_data():
-    reader = TerrameterDatabase(TASK_IDS)
+    reader = make_reader()
 
     path = PATH_TO_DATA
 
+    if SHARD_PERIOD != '':
+        # The last shard gives the structure of the measurements, the new days go to the shards of their period
+        store = shard_store()
+        reader.data = store.open(store.keys()[-1:])
+        raw = reader.read_new(path, store.dates())
+        if raw is not None:
+            store.append(raw)
+            monitor_raw(raw, slice(None))
+        return
+
     reader.load_data(PICKLE_NAME)
+    # Convert archives stored with another dtype
+    if getattr(reader.data.raw, 'value_dtype', 'float64') != STORAGE_DTYPE:
+        reader.data.raw.astype(STORAGE_DTYPE)
+    number_of_days = len(reader.data.raw.dates)
     reader.extend(path)
     reader.save_data(PICKLE_NAME)
+    monitor_raw(reader.data.raw, slice(number_of_days, None))
+
+
+def backfill_batch_size(raw) -> int:
+    # Acquisitions of the structure of raw that fit BACKFILL_MEMORY_MB (value arrays, decays and validity)
+    measurements, _, gates = raw.decay.shape
+    per_acquisition = measurements * ((len(VALUE_FIELDS) - 1 + gates) * np.dtype(STORAGE_DTYPE).itemsize + 1)
+    # Twice for the copies made while the batch is stored in its shards
+    return max(1, int(BACKFILL_MEMORY_MB * 1024 ** 2 // (2 * per_acquisition)))
 
 @my_timer
-def filterr():
+def backfill():
+    """ Onboard an archive in time-ordered batches of at most BACKFILL_MEMORY_MB
+
+    Each batch is read, stored in the shards of its period, quality controlled, filtered and
+    written to individual dat files before the next one is read, so memory is bounded by the
+    batch and a shard (SHARD_PERIOD). The shards are the checkpoint: a backfill started again
+    skips the stored acquisitions and first finishes the stages of the shards that received
+    days. The first batch is a single acquisition, which gives the size of the others.
+    """
+    if SHARD_PERIOD == '':
+        print('The backfill stores the archive in shards, set SHARD_PERIOD!')
+        return
+    reader = make_reader()
+    pending = reader.list_new(PATH_TO_DATA, shard_store().dates())
+    total = len(pending)
+    while True:
+        # Stages of the shards with new days (also those of an interrupted backfill)
+        quality_control()
+        filterr()
+        for data in data_to_update('dats'):
+            for task_id in TASK_IDS:
+                write_dats_task(data, task_id, 'individual')
+        if len(pending) == 0:
+            break
+        # Reopened every batch: the stages update the index of the store
+        store = shard_store()
+        if len(store.keys()) == 0:
+            reader.default_structure(pending[0])
+            size = 1
+        else:
+            # The last shard gives the structure of the measurements
+            reader.data = store.open(store.keys()[-1:])
+            size = backfill_batch_size(reader.data.raw)
+        batch, pending = pending[:size], pending[size:]
+        raw = reader.make_data(batch)
+        store.append(raw)
+        count('acquisitions_backfilled', len(batch))
+        monitor_raw(raw, slice(None))
+        print('Backfill: {} of {} acquisitions stored'.format(total - len(pending), total))
+        reader.data = GeophysicalTimeSeries()
+
+
+def monitor_raw(raw, days) -> None:
+    # Anomalies of the new acquisitions (PATH_TO_MONITOR)
+    if PATH_TO_MONITOR == '':
+        return
+    detector = AnomalyDetector(PATH_TO_MONITOR)
+    for name in ('apres', 'chargeability'):
+        alerts = detector.update(f'raw_{name}', raw.dates[days], getattr(raw, name)[:, days], raw.metadata.dpid,
+                                 raw.valid[:, days])
+        count('alerts', len(alerts))
+
+
+def monitor_results(results: GeophysicalTimeSeriesResults, task_id: int, dates: np.ndarray) -> None:
+    # Anomalies of the cells of new models (PATH_TO_MONITOR)
+    if PATH_TO_MONITOR == '' or len(dates) == 0:
+        return
+    detector = AnomalyDetector(PATH_TO_MONITOR)
+    days = np.flatnonzero(np.isin(results.dates, dates))
+    for name in ('resistivity', 'chargeability'):
+        values = getattr(results, name).reshape(len(results.x), -1)
+        alerts = detector.update(f'inverted_{task_id}_{name}', results.dates[days], values[:, days])
+        count('alerts', len(alerts))
+
+def kalman_state_file(name: str) -> str:
+    # Kalman filter state of a filtered quantity after the last filtered day, next to the store
+    return PICKLE_FULLPATH + f'.kalman_{name}.npz'
+
+def filter_new_days(smoother: flt.KalmanSmoother, data: GeophysicalTimeSeries) -> bool:
+    """ Continue the Kalman filter of the earlier runs over the new days of data
+
+    The new days are filtered with the days before them only, the stored days are not smoothed
+    again. Not possible (False) without a state, without stored days (e.g. a new shard, smoothed
+    as a whole) or if the new days are not all after the state.
+    """
+    raw = data.raw
+    states = {name: flt.KalmanState.load(kalman_state_file(name)) for name in ('resistance', 'apres', 'chargeability')}
+    if any(state is None or state.date is None or len(state.mean) != len(raw.metadata) for state in states.values()):
+        return False
+    dates = raw.dates.astype('datetime64[s]')
+    new = np.flatnonzero(dates > states['apres'].date)
+    # The stored days of data are the ones filtered already (with their uncertainty)
+    filtered_days = len(data.filtered.dates)
+    if len(new) == 0 or filtered_days == 0 or len(dates) - len(new) != filtered_days:
+        return False
+    if any(getattr(data.filtered, name + '_std') is None for name in states):
+        return False
+    valid = raw.accepted[:, new]
+    errors = {'resistance': raw.repeat_error[:, new] / 100, 'apres': raw.repeat_error[:, new] / 100, 'chargeability': None}
+    for name, state in states.items():
+        new_dates, values, std, state = smoother.update(state, dates[new], getattr(raw, name)[:, new], valid, errors[name])
+        stored = getattr(data.filtered, name)
+        setattr(data.filtered, name, np.concatenate((stored, values.astype(stored.dtype)), axis=1))
+        setattr(data.filtered, name + '_std', np.concatenate((getattr(data.filtered, name + '_std'), std.astype(stored.dtype)), axis=1))
+        state.save(kalman_state_file(name))
+    data.filtered.dates = np.concatenate((data.filtered.dates, new_dates.astype(data.filtered.dates.dtype)))
+    return True
 
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+@my_timer
+def filterr():
 
-    # Fill Strategy
+    # Fill Strategy, or a smoother on the acquisition dates (continued over new days by its saved state)
     fill = flt.FillMissingData()
-    data.filtered.dates, data.filtered.resistance = fill.filter(
-        data.raw.dates, data.raw.resistance)
-    _, data.filtered.apres = fill.filter(
-        data.raw.dates, data.raw.apres)
-    _, data.filtered.chargeability = fill.filter(
-        data.raw.dates, data.raw.chargeability)
-    # Store object
-    data.save(PICKLE_FULLPATH)
+    smoother = flt.KalmanSmoother() if FILTER_STRATEGY == 'kalman' else None
+    for data in data_to_update('filtered'):
+        if smoother is not None and filter_new_days(smoother, data):
+            data.filtered.astype(STORAGE_DTYPE)
+            save_data(data)
+            continue
+        raw = data.raw
+        if SHARD_PERIOD != '':
+            # The interpolation continues from the end of the previous shard
+            raw = shard_store().with_lookback(data.raw, np.timedelta64(FILTER_LOOKBACK_DAYS, 'D'))
+        valid = raw.accepted
+        # Relative stacking error of the resistance, also that of apres = K * resistance
+        errors = {'resistance': raw.repeat_error / 100, 'apres': raw.repeat_error / 100, 'chargeability': None}
+        for name in ('resistance', 'apres', 'chargeability'):
+            std = None
+            if smoother is None:
+                dates, values = fill.filter(raw.dates, getattr(raw, name), valid)
+            else:
+                dates, values, std, state = smoother.smooth(raw.dates, getattr(raw, name), valid, errors[name])
+                stored = flt.KalmanState.load(kalman_state_file(name))
+                # The state of the latest day filtered so far is kept for the next run
+                if stored is None or stored.date is None or state.date >= stored.date:
+                    state.save(kalman_state_file(name))
+            # Without the look-back days
+            keep = dates >= data.raw.dates.min().astype('datetime64[h]')
+            setattr(data.filtered, name, values[:, keep])
+            setattr(data.filtered, name + '_std', None if std is None else std[:, keep])
+        data.filtered.dates = dates[keep]
+        data.filtered.astype(STORAGE_DTYPE)
+        # Store object
+        save_data(data)
+
+@my_timer
+def quality_control():
+
+    # Rejected measurements are interpolated by the filter and left out of the dat files
+    qc = flt.QualityControl()
+    for data in data_to_update('qc'):
+        data.raw.rejected = qc.filter(data.raw)
+        count('qc_rejected', int(data.raw.rejected.sum()))
+        save_data(data)
+
+@my_timer
+def select_timesteps():
+
+    data = load_data()
+
+    # Change of the filtered apparent resistivity against the last inverted timestep of each task
+    detector = flt.ChangeDetection(threshold=CHANGE_THRESHOLD, cadence=(INVERSION_CADENCE_HOURS, 'h'))
+    filtered_dates = data.filtered.dates.astype('datetime64[s]')
+
+    def filtered_at(indices, dates):
+        # Filtered values interpolated at the acquisition dates (off the filter grid, e.g. hourly sites)
+        values = np.full([len(indices), len(dates)], np.nan)
+        if len(filtered_dates) == 0:
+            return values
+        # Dates past the ends of the grid (within one filter interval) take the value at the end
+        interval = np.timedelta64(*flt.FillMissingData.interval)
+        dates = dates.astype('datetime64[s]')
+        inside = (dates >= filtered_dates[0] - interval) & (dates <= filtered_dates[-1] + interval)
+        dates = np.clip(dates, filtered_dates[0], filtered_dates[-1])
+        left = np.clip(np.searchsorted(filtered_dates, dates[inside], side='right') - 1, 0, len(filtered_dates) - 1)
+        right = np.minimum(left + 1, len(filtered_dates) - 1)
+        span = (filtered_dates[right] - filtered_dates[left]).astype(np.float64)
+        weight = np.where(span > 0, (dates[inside] - filtered_dates[left]).astype(np.float64) / np.maximum(span, 1), 0.0)
+        lower = data.filtered.apres[np.ix_(indices, left)].astype(np.float64)
+        upper = data.filtered.apres[np.ix_(indices, right)].astype(np.float64)
+        # On a grid point the neighbour is not needed (it may be NaN)
+        values[:, inside] = np.where(weight == 0, lower, (1 - weight) * lower + weight * upper)
+        return values
+
+    for task_id in TASK_IDS:
+        selection = data.selection[task_id]
+        indices = np.sort(data.raw.metadata.task_indices(task_id))
+        # Decide the new timesteps only, earlier decisions are kept
+        dates = np.sort(data.raw.dates.astype('datetime64[s]'))
+        dates = dates[~np.isin(dates, selection.dates)]
+        if len(dates) == 0:
+            continue
+        reference_date = selection.last_selected()
+        if reference_date is None and len(data.inverted[task_id].dates) > 0:
+            reference_date = data.inverted[task_id].dates.max().astype('datetime64[s]')
+        reference = None if reference_date is None else filtered_at(indices, np.array([reference_date]))[:, 0]
+        metric, selected, reason = detector.select(dates, filtered_at(indices, dates), reference, reference_date)
+        selection.extend(dates, metric, selected, reason)
+        count('timesteps_skipped', int((~selected).sum()))
+        # Record of the decisions next to the dat files
+        fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual', f"task_{task_id}")
+        os.makedirs(fullpath, exist_ok=True)
+        selection.to_frame().to_csv(os.path.join(fullpath, 'selection.csv'), index=False)
+    save_data(data)
+
+@my_timer
+def integrate_chargeability(sgate: int = 1, egate: int = 0):
+
+    data = load_data()
+
+    # Re-integrate the whole history from the stored decays (no database access)
+    gates_width = data.raw.ip_window_list()
+    if len(gates_width) == 0:
+        print('IP window widths not available!')
+        return
+    chargeability = integral_decay(data.raw.decay, gates_width, sgate=sgate, egate=egate)
+    data.raw.chargeability = chargeability.astype(data.raw.value_dtype, copy=False)
+    save_data(data)
+
+@my_timer
+def fit_decay_curves():
+    """ Stretched-exponential fit of every stored decay (see tools.decay_fit)
+
+    The parameters and fit-quality masks are saved next to the pickle, and only the days added since
+    the last fit are fitted.
+    """
+    data = load_data()
+    if len(data.raw.ip_window_list()) == 0:
+        print('IP window widths not available!')
+        return
+    filename = PICKLE_FULLPATH + '.decayfit.npz'
+    fitted, first = None, 0
+    if os.path.isfile(filename):
+        with np.load(filename) as stored:
+            days = len(stored['dates'])
+            if (np.array_equal(stored['dpid'], data.raw.metadata.dpid)
+                    and np.array_equal(stored['dates'], data.raw.dates[:days])):
+                fitted, first = {name: stored[name] for name in FIT_FIELDS}, days
+    new = fit_decays(data.raw, days=slice(first, None), max_workers=DECAY_FIT_WORKERS)
+    if fitted is not None:
+        new = {name: np.concatenate((fitted[name], new[name]), axis=1) for name in FIT_FIELDS}
+    tmp = PICKLE_FULLPATH + '.decayfit.tmp.npz'
+    np.savez(tmp, dates=data.raw.dates, dpid=data.raw.metadata.dpid, **new)
+    os.replace(tmp, filename)
+    count('decays_fitted', (len(data.raw.dates) - first) * len(data.raw.metadata))
 
 @my_timer
 def plot():
 
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+    data = load_data()
 
     p.plot_raw_data(data, 'resistance', os.path.join(PATH_TO_PLOT, 'resistance'))
     p.plot_raw_data(data, 'apres', os.path.join(PATH_TO_PLOT, 'apres'))
     p.plot_raw_data(data, 'chargeability', os.path.join(PATH_TO_PLOT, 'chargeability'))
 
 
-@my_timer
-def write_dats_indivual():
+def history_files() -> list[str]:
+    # Pickles with a history store next to them
+    if SHARD_PERIOD == '':
+        return [PICKLE_FULLPATH]
+    store = shard_store()
+    return [store.filename(key) for key in store.keys()]
 
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+@my_timer
+def plot_history(dpids: list[int], type_of_plot: str = 'apres', resolution_days: float = None):
 
-    fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual')
-    if not os.path.exists(fullpath):
-        os.mkdir(fullpath)
+    # Single measurements from the history stores, without loading the time series
+    # (aggregated if a resolution of a day or coarser is enough)
+    path = os.path.join(PATH_TO_PLOT, type_of_plot)
+    os.makedirs(path, exist_ok=True)
+    filenames = history_files()
+    resolution = None if resolution_days is None else np.timedelta64(int(resolution_days * 24), 'h')
+    for dpid in dpids:
+        p.plot_measurement_history(filenames, dpid, type_of_plot, path, resolution=resolution)
 
-    for task_id in TASK_IDS:
-        files_written = []
-        task = f"task_{task_id}"
-        if not os.path.exists(os.path.join(fullpath, task)):
-            os.mkdir(os.path.join(fullpath, task))
-        # Write Res2DInv dat files
+@my_timer
+def aggregates_to_csv(level: str = 'D'):
+
+    # Daily ('D'), weekly ('W') or monthly ('M') statistics of the raw data of every measurement
+    filenames = history_files()
+    frames = []
+    for name in ('apres', 'chargeability'):
+        dpids, bins, statistics = aggregate_table(filenames, name, level)
+        if len(bins) == 0:
+            continue
+        rows, columns = np.indices(statistics['mean'].shape)
+        frame = pd.DataFrame({'dt': np.datetime_as_string(bins)[columns.ravel()], 'dpid': dpids[rows.ravel()],
+                              'quantity': name})
+        for statistic in ('min', 'max', 'mean', 'count'):
+            frame[statistic] = statistics[statistic].ravel()
+        frames.append(frame)
+    if len(frames) > 0:
+        pd.concat(frames).to_csv(os.path.join(PATH_TO_PICKLE, f'data_raw_{level}.csv'), index=False)
+        count('files_written')
+
+
+def dat_filename(path: str, dt: np.datetime64) -> str:
+    return os.path.join(path, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00.dat')
+
+def timelapse_schedule(dates: np.ndarray, sections: int = 2, baseline=0, start: int = 5) -> list[list[int]]:
+    """ Day indices of the time sections of each time-lapse dat file
+
+    Args:
+        dates (np.ndarray): dates of the raw data
+        sections (int): time sections per file, the baseline and sections-1 new days
+        baseline: chronological index of the baseline day, or 'rolling' for the day before each file
+        start (int): chronological index of the first day written
+
+    Returns:
+        list[list[int]]: per file, the baseline followed by the new days, in chronological order
+            (the first section is the reference of a Res2DInv time-lapse inversion)
+    """
+    order = np.argsort(dates, kind='stable')
+    step = sections - 1
+    if baseline == 'rolling':
+        start = max(start, 1)
+    schedule = []
+    # Complete files only, the remaining days wait for the next run
+    for first in range(start, len(order) - step + 1, step):
+        base = order[first - 1] if baseline == 'rolling' else order[baseline]
+        schedule.append([base] + list(order[first:first + step]))
+    return schedule
+
+def inversion_cache() -> InversionCache:
+    return InversionCache(PATH_TO_INVERSION_CACHE, max_bytes=INVERSION_CACHE_BYTES, backend=backend_version())
+
+def write_text(filename: str, text: str) -> None:
+    with open(filename, 'w') as fout:
+        fout.write(text)
+    count('files_written')
+
+def dat_inputs(data: GeophysicalTimeSeries, task_id: int, days: list[int]) -> list[np.ndarray]:
+    # Arrays the dat file of some days of a task is formatted from (see InversionCache.inputs_key)
+    indices = data.raw.metadata.task_indices(task_id)
+    arrays = [data.raw.metadata.abmn[indices]]
+    for index_day in days:
+        arrays += [data.raw.resistance[indices, index_day], data.raw.chargeability[indices, index_day],
+                   data.raw.accepted_at(index_day)[indices], data.raw.dates[index_day:index_day + 1]]
+    return arrays
+
+def write_dats_task(data: GeophysicalTimeSeries, task_id: int, kind: str = 'individual') -> None:
+    """ Res2DInv dat files and batch file of one task
+
+    Args:
+        data (GeophysicalTimeSeries): data
+        task_id (int): task
+        kind (str): 'individual' or 'timelapse' (see timelapse_schedule)
+    """
+    files_written = []
+    task = f"task_{task_id}"
+    fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, kind)
+    # Tasks may run concurrently
+    os.makedirs(os.path.join(fullpath, task), exist_ok=True)
+    # Copy inversion parameters file (if not there already)
+    params_file = os.path.join(fullpath, task, os.path.basename(INVERSION_PARAMS))
+    if not os.path.isfile(params_file):
+        copyfile(INVERSION_PARAMS, params_file)
+    # Write Res2DInv dat files of the timesteps without results for their current inputs
+    cache = inversion_cache()
+    if kind == 'individual':
+        # Timesteps skipped by select_timesteps are not inverted individually
+        selected = np.ones(len(data.raw.dates), dtype=bool)
+        if task_id in data.selection:
+            selected = data.selection[task_id].is_selected(data.raw.dates)
         for index_day in range(data.raw.resistance.shape[1]):
-            dt = data.raw.dates[index_day]
-            filename = os.path.join(fullpath, task, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00.dat')
-            if os.path.isfile(filename[:-4] + '.xyz'):
+            if not selected[index_day]:
+                continue
+            filename = dat_filename(os.path.join(fullpath, task), data.raw.dates[index_day])
+            # Only the days whose inputs changed are formatted
+            inputs = cache.inputs_key(dat_inputs(data, task_id, [index_day]), params_file)
+            if cache.unchanged(filename, inputs):
+                continue
+            text = w.format_dat(data, filename, task_id, index_to_write=index_day)
+            if cache.up_to_date(filename, text, params_file, inputs):
+                continue
+            files_written.append(filename)
+            write_text(filename, text)
+    else:
+        writer = w.TimelapseWriter(data, task_id)
+        for sections in timelapse_schedule(data.raw.dates, TIMELAPSE_SECTIONS, TIMELAPSE_BASELINE, TIMELAPSE_START):
+            # Named after the first new day
+            filename = dat_filename(os.path.join(fullpath, task), data.raw.dates[sections[1]])
+            inputs = cache.inputs_key(dat_inputs(data, task_id, sections), params_file)
+            if cache.unchanged(filename, inputs):
+                continue
+            text = writer.format(filename, sections)
+            if cache.up_to_date(filename, text, params_file, inputs):
                 continue
             files_written.append(filename)
-            w.write_dat(data, filename, task_id, index_to_write=index_day)
-        # Copy inversion parameters file (if not there already)
-        params_file = os.path.join(fullpath, task, os.path.basename(INVERSION_PARAMS))
-        if not os.path.isfile(params_file):
-            copyfile(INVERSION_PARAMS, params_file)
-        # Write Res2DInv Batch File (if at least 1 new file present)
-        if len(files_written) > 0:
-            batch_file = os.path.join(fullpath, task, 'batch.bth')
-            with open(batch_file, 'w') as fout:
-                fout.writelines(str(len(files_written)) + '\n')
-                fout.writelines('INVERSION PARAMETERS FILES USED \n')
-                for index_file in range(len(files_written)):
-                    fout.writelines(f'DATA FILE {index_file} \n')
-                    fout.writelines(files_written[index_file] + '\n')
-                    fout.writelines(files_written[index_file].replace('.dat', '.inv') + '\n')
-                    fout.writelines(params_file + '\n')
+            write_text(filename, text)
+    # Write Res2DInv Batch File (if at least 1 new file present)
+    if len(files_written) > 0:
+        batch_file = os.path.join(fullpath, task, 'batch.bth')
+        if os.path.isfile(batch_file):
+            # Files of a batch not inverted yet stay in it (DATA FILE, dat, inv, parameters per file)
+            with open(batch_file, 'r') as fin:
+                lines = fin.read().splitlines()[2:]
+            pending = [lines[index + 1].strip() for index in range(0, len(lines) - 3, 4)]
+            files_written = [f for f in pending if f not in files_written] + files_written
+        with open(batch_file, 'w') as fout:
+            fout.writelines(str(len(files_written)) + '\n')
+            fout.writelines('INVERSION PARAMETERS FILES USED \n')
+            for index_file in range(len(files_written)):
+                fout.writelines(f'DATA FILE {index_file} \n')
+                fout.writelines(files_written[index_file] + '\n')
+                fout.writelines(files_written[index_file].replace('.dat', '.inv') + '\n')
+                fout.writelines(params_file + '\n')
+
+def invert_task(task_id: int, kind: str = 'individual') -> None:
+    batch_file = os.path.join(PATH_TO_INVERSION_OUTPUT, kind, f"task_{task_id}", 'batch.bth')
+    if os.path.isfile(batch_file):
+        invert_batch_file(batch_file)
+        # Keep the new models in the inversion cache: (DATA FILE, dat, inv, parameters) per file
+        with open(batch_file, 'r') as fin:
+            lines = fin.read().splitlines()[2:]
+        cache = inversion_cache()
+        for index in range(0, len(lines) - 3, 4):
+            cache.store(lines[index + 1].strip(), lines[index + 3].strip())
+        cache.evict()
+        os.remove(batch_file)
+
+def read_results_task(data: GeophysicalTimeSeries, task_id: int) -> None:
+    task = f"task_{task_id}"
+
+    fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual', task)
+    root, dirs, files = next(os.walk(fullpath))
+
+    xyz_files = []
+    for f in files:
+        if f.endswith('.xyz'):
+            xyz_files.append(os.path.join(root, f))
+
+    def result_date(filename):
+        return np.datetime64(pd.to_datetime(os.path.basename(filename)[:-4], format='%Y_%m_%d_%H_%M_%S'), 'h')
+
+    def result_key(filename):
+        # Inversion cache key of a model ('' for models inverted before the cache existed)
+        if not os.path.isfile(filename[:-4] + '.key'):
+            return ''
+        with open(filename[:-4] + '.key', 'r') as fin:
+            return fin.read().strip()
+
+    results = data.inverted[task_id]
+    # Models re-inverted after their inputs changed replace the stored ones
+    for filename in xyz_files:
+        dt = result_date(filename)
+        key = result_key(filename)
+        if dt in results.dates and key not in ('', results.keys.get(str(dt), '')):
+            _, _, res, charg = read_res2dinv_xyz_single(filename)
+            results.replace(np.array([dt]), res, charg)
+            results.keys[str(dt)] = key
+            for suffix in ('_res.png', '_charg.png'):
+                if os.path.isfile(filename[:-4] + suffix):
+                    os.remove(filename[:-4] + suffix)
+
+    new_dirs = [fpathdir for fpathdir in xyz_files if result_date(fpathdir) not in data.inverted[task_id].dates]
+    new_dates = np.array([result_date(filename) for filename in new_dirs], dtype='datetime64[h]')
+    for filename in new_dirs:
+        results.keys[str(result_date(filename))] = result_key(filename)
+    results.mark_changed('keys')
+    if len(new_dirs) == 0:
+        print('No files to process in the path!')
+    else:
+        if len(data.inverted[task_id].dates) == 0:
+            # Get the first file from the list
+            filename = new_dirs.pop(0)
+            x, z, res, charg = read_res2dinv_xyz_single(filename)
+            data.inverted[task_id].dates = np.array([pd.to_datetime(os.path.basename(filename)[:-4], format='%Y_%m_%d_%H_%M_%S')], dtype='datetime64[h]')
+            data.inverted[task_id].x = x
+            data.inverted[task_id].depth = z
+            data.inverted[task_id].resistivity = res
+            data.inverted[task_id].chargeability = charg
+        for filename in new_dirs:
+            dt = np.array([pd.to_datetime(os.path.basename(filename)[:-4], format='%Y_%m_%d_%H_%M_%S')], dtype='datetime64[h]')
+            _, _, res, charg = read_res2dinv_xyz_single(filename)
+            data.inverted[task_id].extend(dt, res, charg)
+    monitor_results(data.inverted[task_id], task_id, new_dates)
+
+def plot_pseudo_task(data: GeophysicalTimeSeries, task_id: int) -> None:
+    task = f"task_{task_id}"
+
+    fullpath = os.path.join(PATH_TO_PSEUDO, task)
+    os.makedirs(fullpath, exist_ok=True)
+
+    indices = np.sort(data.raw.metadata.task_indices(task_id))
+    x = data.raw.focus_x[indices]
+    depth = data.raw.focus_z[indices]
+    grid = p.SectionGrid.from_points(x, depth)
+    for index, dt in enumerate(data.raw.dates):
+        res_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_res.png')
+        charg_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_charg.png')
+        res = data.raw.apres[indices, index]
+        charg = data.raw.chargeability[indices, index]
+        title = str(dt).replace('T', ' ')[:-6] + ':00:00'
+        if not os.path.isfile(res_filename):
+            p.plot_2d_section(x, depth, res, res_filename, vmin=10, vmax=300, title=title, grid=grid)
+        if not os.path.isfile(charg_filename):
+            p.plot_2d_section(x, depth, charg, charg_filename, vmin=1, vmax=8, title=title, log=False, grid=grid)
+
+def plot_results_task(data: GeophysicalTimeSeries, task_id: int) -> None:
+    task = f"task_{task_id}"
+
+    fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual', task)
+
+    x = data.inverted[task_id].x
+    depth = data.inverted[task_id].depth
+    grid = None
+    for index, dt in enumerate(data.inverted[task_id].dates):
+        res_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_res.png')
+        charg_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_charg.png')
+        res = data.inverted[task_id].resistivity[:, index]
+        charg = data.inverted[task_id].chargeability[:, index]
+        title = str(dt)
+        if grid is None:
+            grid = p.SectionGrid.from_points(x, depth)
+        if not os.path.isfile(res_filename):
+            p.plot_2d_section(x, depth, res, res_filename, vmin=10, vmax=300, title=title, grid=grid)
+        if not os.path.isfile(charg_filename):
+            p.plot_2d_section(x, depth, charg, charg_filename, vmin=1, vmax=8, title=title, log=False, grid=grid)
 
 
 @my_timer
-def write_dats_timelapse():
-
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+def write_dats_indivual():
 
-    fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'timelapse')
-    if not os.path.exists(fullpath):
-        os.mkdir(fullpath)
+    data = load_data()
 
     for task_id in TASK_IDS:
-        files_written = []
-        task = f"task_{task_id}"
-        if not os.path.exists(os.path.join(fullpath, task)):
-            os.mkdir(os.path.join(fullpath, task))
-        # Write Res2DInv dat files
-        for index_day in range(5, data.raw.resistance.shape[1]):
-            dt = data.raw.dates[index_day]
-            filename = os.path.join(fullpath, task, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00.dat')
-            if os.path.isfile(filename[:-4] + '.xyz'):
-                continue
-            files_written.append(filename)
-            w.write_dat_timelapse(data, filename, task_id,
-                                index_to_write=index_day,
-                                index_for_baseline=0)
-        # Copy inversion parameters file (if not there already)
-        params_file = os.path.join(fullpath, task, os.path.basename(INVERSION_PARAMS))
-        if not os.path.isfile(params_file):
-            copyfile(INVERSION_PARAMS, params_file)
-        # Write Res2DInv Batch File (if at least 1 new file present)
-        if len(files_written) > 0:
-            batch_file = os.path.join(fullpath, task, 'batch.bth')
-            params_file = os.path.join(fullpath, task, os.path.basename(INVERSION_PARAMS))
-            with open(batch_file, 'w') as fout:
-                fout.writelines(str(len(files_written)) + '\n')
-                fout.writelines('INVERSION PARAMETERS FILES USED \n')
-                for index_file in range(len(files_written)):
-                    fout.writelines(f'DATA FILE {index_file} \n')
-                    fout.writelines(files_written[index_file] + '\n')
-                    fout.writelines(files_written[index_file].replace('.dat', '.inv') + '\n')
-                    fout.writelines(params_file + '\n')
+        write_dats_task(data, task_id, 'individual')
 
 
+@my_timer
+def write_dats_timelapse():
+
+    data = load_data()
+
+    for task_id in TASK_IDS:
+        write_dats_task(data, task_id, 'timelapse')
+
 
 @my_timer
 def invert_single():
 
     for task_id in TASK_IDS:
-        task = f"task_{task_id}"
-        fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual')
-        batch_file = os.path.join(fullpath, task, 'batch.bth')
-        if os.path.isfile(batch_file):
-            invert_batch_file(batch_file)
-            os.remove(batch_file)
+        invert_task(task_id, 'individual')
 
 @my_timer
 def invert_timelapse():
 
     for task_id in TASK_IDS:
-        task = f"task_{task_id}"
-        fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'timelapse')
-        batch_file = os.path.join(fullpath, task, 'batch.bth')
-        if os.path.isfile(batch_file):
-            invert_batch_file(batch_file)
-            os.remove(batch_file)
+        invert_task(task_id, 'timelapse')
 
 
 @my_timer
 def read_results_single():
 
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+    data = load_data()
 
     for task_id in TASK_IDS:
-        task = f"task_{task_id}"
+        read_results_task(data, task_id)
 
-        fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual', task)
-        root, dirs, files = next(os.walk(fullpath))
+    save_data(data)
 
-        xyz_files = []
-        for f in files:
-            if f.endswith('.xyz'):
-                xyz_files.append(os.path.join(root, f))
+@my_timer
+def plot_pseudo_single():
 
-        new_dirs = [fpathdir for fpathdir in xyz_files if np.datetime64(pd.to_datetime(os.path.basename(fpathdir)[:-4], format='%Y_%m_%d_%H_%M_%S')) not in data.inverted[task_id].dates]
-        if len(new_dirs) == 0:
-            print('No files to process in the path!')
-        else:
-            if len(data.inverted[task_id].dates) == 0:
-                # Get the first file from the list
-                filename = new_dirs.pop(0)
-                x, z, res, charg = read_res2dinv_xyz_single(filename)
-                data.inverted[task_id].dates = np.array([pd.to_datetime(os.path.basename(filename)[:-4], format='%Y_%m_%d_%H_%M_%S')], dtype='datetime64[h]')
-                data.inverted[task_id].x = x
-                data.inverted[task_id].depth = z
-                data.inverted[task_id].resistivity = res
-                data.inverted[task_id].chargeability = charg
-            for filename in new_dirs:
-                dt = np.array([pd.to_datetime(os.path.basename(filename)[:-4], format='%Y_%m_%d_%H_%M_%S')], dtype='datetime64[h]')
-                _, _, res, charg = read_res2dinv_xyz_single(filename)
-                data.inverted[task_id].extend(dt, res, charg)
-
-    data.save(PICKLE_FULLPATH)
+    data = load_data()
+
+    for task_id in TASK_IDS:
+        plot_pseudo_task(data, task_id)
 
 @my_timer
-def plot_pseudo_single():
+def plot_results_single():
 
+    data = load_data()
+
+    for task_id in TASK_IDS:
+        plot_results_task(data, task_id)
+
+def process_task(task_id: int) -> tuple[int, GeophysicalTimeSeriesResults, dict[str, int]]:
+    """ Write, invert, read and plot one task (run in a worker process)
+
+    Args:
+        task_id (int): task
+
+    Returns:
+        tuple[int, GeophysicalTimeSeriesResults, dict[str, int]]: task, its inverted results and the
+            instrumentation counters incremented for it (merged by the main process)
+    """
+    # Forked workers start with a copy of the counters of the main process
+    before = dict(instrumentation.counters)
+    # Each worker reads the pickle, only the main process saves it
+    data = load_data()
+    write_dats_task(data, task_id, 'individual')
+    write_dats_task(data, task_id, 'timelapse')
+    invert_task(task_id, 'individual')
+    invert_task(task_id, 'timelapse')
+    read_results_task(data, task_id)
+    plot_pseudo_task(data, task_id)
+    plot_results_task(data, task_id)
+    counters = {name: value - before.get(name, 0) for name, value in instrumentation.counters.items()
+                if value != before.get(name, 0)}
+    return task_id, data.inverted[task_id], counters
+
+@my_timer
+def process_tasks_concurrently(max_workers: int = None):
+    """ Per-task chain of all tasks in parallel, the results are merged into data.inverted """
+    os.makedirs(os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual'), exist_ok=True)
+    os.makedirs(os.path.join(PATH_TO_INVERSION_OUTPUT, 'timelapse'), exist_ok=True)
+    max_workers = min(max_workers or TASK_WORKERS, len(TASK_IDS))
+    # Processes: pyplot is not thread-safe
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(process_task, TASK_IDS))
+
+    data = load_data()
+    for task_id, inverted, counters in results:
+        for name, value in counters.items():
+            count(name, value)
+        # Field by field, so only the new models are journaled
+        for name in ('dates', 'x', 'depth', 'resistivity', 'chargeability', 'keys'):
+            setattr(data.inverted[task_id], name, getattr(inverted, name))
+    save_data(data)
+
+@my_timer
+def compact_data():
+
+    # Fold the journal of incremental saves into the pickle
+    if SHARD_PERIOD != '':
+        shard_store().compact()
+        return
     data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+    data.compact(PICKLE_FULLPATH)
+
+@my_timer
+def plot_pseudo_timelapse(extension: str = '.npz'):
+
+    data = load_data()
 
     for task_id in TASK_IDS:
         task = f"task_{task_id}"
@@ -220,83 +832,66 @@ def plot_pseudo_single():
         if not os.path.exists(fullpath):
             os.mkdir(fullpath)
 
-        dpids = data.raw.task_dpid_lookup[task_id]
-        indices = np.sort([data.raw.geometry_lookuptable[dpid] for dpid in dpids])
-        for index, dt in enumerate(data.raw.dates):
-            res_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_res.png')
-            charg_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_charg.png')
-            x = data.raw.focus_x[indices]
-            depth = data.raw.focus_z[indices]
-            res = data.raw.apres[indices, index]
-            charg = data.raw.chargeability[indices, index]
-            title = str(dt).replace('T', ' ')[:-6] + ':00:00'
-            if not os.path.isfile(res_filename):
-                p.plot_2d_section(x, depth, res, res_filename, vmin=10, vmax=300, title=title)
-            if not os.path.isfile(charg_filename):
-                p.plot_2d_section(x, depth, charg, charg_filename, vmin=1, vmax=8, title=title, log=False)
-    data.save(PICKLE_FULLPATH)
+        # One artifact per task and quantity with every timestep
+        indices = np.sort(data.raw.metadata.task_indices(task_id))
+        x = data.raw.focus_x[indices]
+        depth = data.raw.focus_z[indices]
+        grid = p.SectionGrid.from_points(x, depth)
+        p.write_section_timelapse(x, depth, data.raw.apres[indices, :], data.raw.dates,
+                                  os.path.join(fullpath, 'timelapse_res' + extension),
+                                  vmin=10, vmax=300, grid=grid)
+        p.write_section_timelapse(x, depth, data.raw.chargeability[indices, :], data.raw.dates,
+                                  os.path.join(fullpath, 'timelapse_charg' + extension),
+                                  vmin=1, vmax=8, log=False, grid=grid)
 
 @my_timer
-def plot_results_single():
+def plot_results_timelapse(extension: str = '.npz'):
 
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+    data = load_data()
 
     for task_id in TASK_IDS:
         task = f"task_{task_id}"
 
         fullpath = os.path.join(PATH_TO_INVERSION_OUTPUT, 'individual', task)
 
-        for index, dt in enumerate(data.inverted[task_id].dates):
-            res_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_res.png')
-            charg_filename = os.path.join(fullpath, np.datetime_as_string(dt, unit='h').replace('-', '_').replace('T', '_') + '_00_00_charg.png')
-            x = data.inverted[task_id].x
-            depth = data.inverted[task_id].depth
-            res = data.inverted[task_id].resistivity[:, index]
-            charg = data.inverted[task_id].chargeability[:, index]
-            title = str(dt)
-            if not os.path.isfile(res_filename):
-                p.plot_2d_section(x, depth, res, res_filename, vmin=10, vmax=300, title=title)
-            if not os.path.isfile(charg_filename):
-                p.plot_2d_section(x, depth, charg, charg_filename, vmin=1, vmax=8, title=title, log=False)
-    data.save(PICKLE_FULLPATH)
+        results = data.inverted[task_id]
+        if len(results.dates) == 0:
+            continue
+        # A single inverted timestep is stored as a 1-D array
+        resistivity = results.resistivity.reshape(len(results.x), -1)
+        chargeability = results.chargeability.reshape(len(results.x), -1)
+        grid = p.SectionGrid.from_points(results.x, results.depth)
+        p.write_section_timelapse(results.x, results.depth, resistivity, results.dates,
+                                  os.path.join(fullpath, 'timelapse_res' + extension),
+                                  vmin=10, vmax=300, grid=grid)
+        p.write_section_timelapse(results.x, results.depth, chargeability, results.dates,
+                                  os.path.join(fullpath, 'timelapse_charg' + extension),
+                                  vmin=1, vmax=8, log=False, grid=grid)
 
 
 @my_timer
 def data_to_csv():
-    data = GeophysicalTimeSeries.load(PICKLE_FULLPATH)
+    data = load_data()
+
+    dpids = data.raw.metadata.dpid
+    tids = data.raw.metadata.task_id
+
+    def measurements_to_csv(filename, dates, apres, chargeability, valid):
+        # Day-major rows of the valid (measurement, day) entries only
+        index_day, index_data = np.nonzero(valid.T)
+        dt = np.char.add(np.char.replace(np.datetime_as_string(dates, unit='h'), 'T', ' '), ':00:00')
+        frame = pd.DataFrame({'dt': dt[index_day], 'dpid': dpids[index_data], 'tid': tids[index_data],
+                              'fx': data.raw.focus_x[index_data], 'fz': data.raw.focus_z[index_data],
+                              'apres': apres.T[valid.T], 'charg': chargeability.T[valid.T]})
+        frame.to_csv(filename, index=False)
 
     # data-raw
     filename_raw = os.path.join(PATH_TO_PICKLE, 'data_raw.csv')
-    with open(filename_raw, 'w') as fout:
-        fout.writelines("dt,dpid,tid,fx,fz,apres,charg\n")
-        number_of_data, number_of_days = data.raw.apres.shape
-        for index_day in range(number_of_days):
-            for index_data in range(number_of_data):
-                dpid = data.raw.geometry_lookuptable_reverse[index_data]
-                fout.writelines("{},{},{},{},{},{},{}\n".format(
-                    np.datetime_as_string(data.raw.dates[index_day], unit='h').replace('T', ' ') + ':00:00',
-                    dpid, data.raw.task_dpid_lookup_reverse[dpid],
-                    data.raw.focus_x[index_data],
-                    data.raw.focus_z[index_data],
-                    data.raw.apres[index_data, index_day],
-                    data.raw.chargeability[index_data, index_day]
-                ))
-    # data-filtered
+    measurements_to_csv(filename_raw, data.raw.dates, data.raw.apres, data.raw.chargeability, data.raw.valid)
+    # data-filtered (NaN outside the interpolated range of a measurement)
     filename_filtered = os.path.join(PATH_TO_PICKLE, 'data_filtered.csv')
-    with open(filename_filtered, 'w') as fout:
-        fout.writelines("dt,dpid,tid,fx,fz,apres,charg\n")
-        number_of_data, number_of_days = data.filtered.apres.shape
-        for index_day in range(number_of_days):
-            for index_data in range(number_of_data):
-                dpid = data.raw.geometry_lookuptable_reverse[index_data]
-                fout.writelines("{},{},{},{},{},{}\n".format(
-                    np.datetime_as_string(data.filtered.dates[index_day], unit='h').replace('T', ' ') + ':00:00',
-                    dpid, data.raw.task_dpid_lookup_reverse[dpid],
-                    data.raw.focus_x[index_data],
-                    data.raw.focus_z[index_data],
-                    data.filtered.apres[index_data, index_day],
-                    data.filtered.chargeability[index_data, index_day]
-                ))
+    measurements_to_csv(filename_filtered, data.filtered.dates, data.filtered.apres, data.filtered.chargeability,
+                        ~np.isnan(data.filtered.apres))
     # data-inverted
     filename_inverted = os.path.join(PATH_TO_PICKLE, 'data_inverted.csv')
     with open(filename_inverted, 'w') as fout:
@@ -313,23 +908,31 @@ def data_to_csv():
                         data.inverted[task_id].resistivity[index_data, index_day],
                         data.inverted[task_id].chargeability[index_data, index_day]
                     ))
+    count('files_written', 3)
 
 def process_new_data():
     extend_data()
+    quality_control()
     filterr()
-    write_dats_indivual()
-    write_dats_timelapse()
-    invert_single()
-    invert_timelapse()
-    read_results_single()
-    plot_pseudo_single()
-    plot_results_single()
+    if CHANGE_THRESHOLD > 0:
+        select_timesteps()
+    if TASK_WORKERS > 1 and len(TASK_IDS) > 1:
+        process_tasks_concurrently()
+    else:
+        write_dats_indivual()
+        write_dats_timelapse()
+        invert_single()
+        invert_timelapse()
+        read_results_single()
+        plot_pseudo_single()
+        plot_results_single()
     data_to_csv()
 
 
 if __name__ == "__main__":
     #read_data()
     extend_data()
+    quality_control()
     filterr()
     plot()
     write_dats_indivual()
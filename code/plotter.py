@@ -1,21 +1,28 @@
+from __future__ import annotations
 import os
 
+from dataclasses import dataclass
+
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
 import matplotlib.colors as colors
+from PIL import Image
 
 from tools.geodata import GeophysicalTimeSeries
+from tools.decay_fit import gate_times
+from tools.history import measurement_history, measurement_metadata, measurement_aggregates, level_for
+from tools.instrumentation import count
+
+
+YLABELS = {'resistance': 'Resistance [Ohm]',
+           'apres': 'App. Resistivity [Ohm.m.]',
+           'chargeability': 'Chargeability [mV/V]'}
 
 
 def plot_raw_data(data: GeophysicalTimeSeries, type_of_plot: str, path: str):
 
-    valid_types = {'resistance', 'apres', 'chargeability'}
-    ylabels = {'resistance': 'Resistance [Ohm]',
-               'apres': 'App. Resistivity [Ohm.m.]',
-               'chargeability': 'Chargeability [mV/V]'}
-    
-    if type_of_plot in valid_types:
+    if type_of_plot in YLABELS:
         values = getattr(data.raw, type_of_plot)
         try:
             values_filtered = getattr(data.filtered, type_of_plot)
@@ -33,74 +40,185 @@ def plot_raw_data(data: GeophysicalTimeSeries, type_of_plot: str, path: str):
         fname = os.path.join(path, str(index)+'.png')
         if os.path.exists(fname):
             continue
-        print(index)
-        plt.figure()
-        plt.plot(dates, values[index, :], 'ko', markersize=2)
-        if values_filtered is not None:
-            plt.plot(dates_filtered, values_filtered[index, :], 'g--', linewidth=1)
-            plt.legend(['raw', 'filtered'])
-        dpid = data.raw.geometry_lookuptable_reverse[index]
-        plt.title("DPID={} K={:.2f} \nA={:1f} B={:1f} M={:1f} N={:1f}".format(
-            dpid, data.raw.dpid_geometric_factor_lookup[dpid], *data.raw.dpid_abmn_lookup[dpid]))
-        plt.xlabel('Date')
-        plt.ylabel(ylabels[type_of_plot])
-        plt.xticks(rotation=15)
-        plt.grid('on')
-        plt.savefig(fname, dpi=300)
-        plt.close()
+        plot_measurement(dates, values[index, :], data.raw.metadata.rows[index], YLABELS[type_of_plot], fname,
+                         dates_filtered, None if values_filtered is None else values_filtered[index, :])
     
 
+def plot_measurement_history(filenames, dpid: int, type_of_plot: str, path: str,
+                             resolution: np.timedelta64 = None) -> None:
+    """ Time series of one DPID read from the history stores (see tools.history), without loading the pickle
+
+    Args:
+        filenames: pickle file, or the pickles of all shards
+        dpid (int): DPID of the measurement
+        type_of_plot (str): 'resistance', 'apres' or 'chargeability'
+        path (str): output folder
+        resolution (np.timedelta64): coarsest time resolution needed, plotted from the coarsest
+            aggregation level that satisfies it (mean with the min-max range); None plots every sample
+    """
+    metadata = measurement_metadata(filenames, dpid)
+    if metadata is None or type_of_plot not in YLABELS:
+        print('No history of DPID {} ({})'.format(dpid, type_of_plot))
+        return
+    level = None if resolution is None else level_for(resolution)
+    fname = os.path.join(path, f'dpid_{dpid}.png' if level is None else f'dpid_{dpid}_{level}.png')
+    if level is None:
+        dates, values = measurement_history(filenames, dpid, type_of_plot)
+        dates_filtered, values_filtered = measurement_history(filenames, dpid, type_of_plot, part='filtered')
+        band = None
+    else:
+        dates, statistics = measurement_aggregates(filenames, dpid, type_of_plot, level)
+        values, band = statistics['mean'], (statistics['min'], statistics['max'])
+        dates_filtered, statistics = measurement_aggregates(filenames, dpid, type_of_plot, level, part='filtered')
+        values_filtered = statistics['mean']
+    plot_measurement(dates, values, metadata, YLABELS[type_of_plot], fname,
+                     dates_filtered, values_filtered if len(values_filtered) > 0 else None, band=band)
+
+
+def plot_measurement(dates: np.ndarray, values: np.ndarray, metadata: np.void, ylabel: str, fname: str,
+                     dates_filtered: np.ndarray = None, values_filtered: np.ndarray = None,
+                     band: tuple[np.ndarray, np.ndarray] = None) -> None:
+    """ Time series of one measurement
+
+    Args:
+        dates (np.ndarray): dates of the raw values
+        values (np.ndarray): raw values
+        metadata (np.void): MeasurementTable row of the measurement
+        ylabel (str): axis label
+        fname (str): image file
+        dates_filtered (np.ndarray): dates of the filtered values
+        values_filtered (np.ndarray): filtered values (None: raw values only)
+        band (tuple[np.ndarray, np.ndarray]): min and max of aggregated values, shaded around them
+    """
+    plt.figure()
+    if band is not None:
+        plt.fill_between(dates, band[0], band[1], color='0.8', step='mid')
+    plt.plot(dates, values, 'ko', markersize=2)
+    if values_filtered is not None:
+        plt.plot(dates_filtered, values_filtered, 'g--', linewidth=1)
+        plt.legend(['raw', 'filtered'])
+    plt.title("DPID={} K={:.2f} \nA={:1f} B={:1f} M={:1f} N={:1f}".format(
+        metadata['dpid'], metadata['k'], metadata['a'], metadata['b'], metadata['m'], metadata['n']))
+    plt.xlabel('Date')
+    plt.ylabel(ylabel)
+    plt.xticks(rotation=15)
+    plt.grid('on')
+    plt.savefig(fname, dpi=300)
+    plt.close()
+    count('files_written')
+
+
 def plot_decays(data: GeophysicalTimeSeries, path: str):
 
     values = data.raw.decay
-    number_of_measurements = values.shape[0]
+    number_of_measurements, number_of_days, number_of_gates = values.shape
+    gates_width = data.raw.ip_window_list()
+    if len(gates_width) > 0:
+        time = gate_times(gates_width)
+    else:
+        time = np.array([0.03, 0.07, 0.13, 0.21, 0.31, 0.45, 0.63, 0.89, 1.29, 1.89, 2.77, 3.97])[:number_of_gates]
+    # Gate time and day of every point of a measurement's (days, gates) decays
+    xdata, ydata = np.meshgrid(time, np.arange(number_of_days))
+    xdata, ydata = xdata.ravel(), ydata.ravel()
     for meas_id in range(number_of_measurements):
         ax = plt.axes(projection='3d')
-        print(meas_id)
         # Data for three-dimensional scattered points
-        time = np.array([0.03, 0.07, 0.13, 0.21, 0.31, 0.45, 0.63, 0.89, 1.29, 1.89, 2.77, 3.97])
-        xdata = []
-        ydata = []
-        zdata = []
-        
-        for i in range(len(data.raw.dates)):
-            for j in range(12):
-                xdata.append(time[j])
-                ydata.append(i)
-                zdata.append(values[meas_id, i, j])
-        
+        zdata = np.asarray(values[meas_id]).ravel()
         ax.scatter3D(xdata, ydata, zdata, c=zdata, cmap='jet');
         ax.set_xlabel("Time (seconds)")
         ax.set_ylabel("Measurement Date")
         ax.set_zlabel("Chargeability (mV/V)")
         plt.savefig('Line4_{:04d}_3d_decay'.format(meas_id), dpi=400, figsize=(1400, 800))
 
+def section_norm(vmin: float, vmax: float, log: bool = True) -> colors.Normalize:
+    """ Fixed colormap normalisation shared by all section plots
+
+    Args:
+        vmin (float): lower bound of the colour scale
+        vmax (float): upper bound of the colour scale
+        log (bool): symmetric-log scale (resistivity) or linear scale (chargeability)
+
+    Returns:
+        colors.Normalize: the normalisation used by pcolormesh and the time-lapse cubes
+    """
+    if log:
+        return colors.SymLogNorm(linthresh=0.03, linscale=0.03, vmin=vmin, vmax=vmax)
+    return colors.Normalize(vmin=vmin, vmax=vmax)
+
+
+@dataclass
+class SectionGrid:
+    """ Regular plotting grid and the interpolation weights from the scattered section points
+
+    The Delaunay triangulation of the (x, y) points is computed once, so any number of
+    timesteps sharing the same geometry can be gridded with a single matrix product.
+    """
+
+    xgrid: np.ndarray
+    ygrid: np.ndarray
+    extent: tuple[float, float, float, float]
+    vertices: np.ndarray
+    weights: np.ndarray
+    inside: np.ndarray
+
+    @classmethod
+    def from_points(cls, x: np.ndarray, y: np.ndarray, max_depth: int = 0, size: int = 100) -> SectionGrid:
+        # Convert to negative
+        if min(y) > 0:
+            y = -y
+        # Find bounds
+        x1, x2 = min(x), max(x)
+        y1, y2 = min(y), max(y)
+        if max_depth == 0:
+            y2 = max_depth
+        xgrid, ygrid = np.meshgrid(np.linspace(x1, x2, size), np.linspace(y1, y2, size))
+        # Barycentric weights of every grid node (same as griddata(method='linear'))
+        points = np.column_stack((x, y))
+        tri = Delaunay(points)
+        nodes = np.column_stack((xgrid.ravel(), ygrid.ravel()))
+        simplex = tri.find_simplex(nodes)
+        inside = simplex >= 0
+        transform = tri.transform[simplex]
+        delta = nodes - transform[:, 2]
+        bary = np.einsum('ijk,ik->ij', transform[:, :2, :], delta)
+        weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+        vertices = tri.simplices[simplex]
+        weights[~inside] = 0
+        return cls(xgrid, ygrid, (x1, x2, y1, y2), vertices, weights, inside)
+
+    def interpolate(self, c: np.ndarray) -> np.ndarray:
+        """ Grid the values of one (npoints,) or many (npoints, ndays) timesteps
+
+        Args:
+            c (np.ndarray): values at the scattered points
+
+        Returns:
+            np.ndarray: gridded values, (ny, nx) or (ndays, ny, nx), NaN outside the hull
+        """
+        c = np.asarray(c, dtype=float)
+        ny, nx = self.xgrid.shape
+        if c.ndim == 1:
+            cgrid = np.einsum('ij,ij->i', c[self.vertices], self.weights)
+            cgrid[~self.inside] = np.nan
+            return cgrid.reshape(ny, nx)
+        cgrid = np.einsum('ijt,ij->ti', c[self.vertices], self.weights)
+        cgrid[:, ~self.inside] = np.nan
+        return cgrid.reshape(-1, ny, nx)
+
+
 def plot_2d_section(x: np.ndarray, y: np.ndarray, c: np.ndarray, filename: str, vmin: int, vmax: int, 
-                    title: str = None, max_depth: int = 0, log: bool = True) -> None: 
-
-    # Convert to negative
-    if min(y) > 0:
-        y = -y
-    # Find bounds
-    x1, x2 = min(x), max(x)
-    y1, y2 = min(y), max(y)
-    if max_depth == 0:
-        y2 = max_depth
-    # Grid the data for plotting
-    xgrid = np.linspace(x1, x2, 100)
-    ygrid = np.linspace(y1, y2, 100)
-    xgrid, ygrid = np.meshgrid(xgrid, ygrid)
-    cgrid = griddata((x, y), c, (xgrid, ygrid), method='linear')
+                    title: str = None, max_depth: int = 0, log: bool = True,
+                    grid: SectionGrid = None) -> None: 
+
+    # Grid the data for plotting (reuse the grid if the geometry is shared)
+    if grid is None:
+        grid = SectionGrid.from_points(x, y, max_depth=max_depth)
+    x1, x2, y1, y2 = grid.extent
+    cgrid = grid.interpolate(c)
     
     fig = plt.figure(figsize=(12, 8), facecolor='w')
-    if log:
-        pcm = plt.pcolormesh(xgrid, ygrid, cgrid,
-                             norm=colors.SymLogNorm(linthresh=0.03, linscale=0.03,
-                                                    vmin=vmin, vmax=vmax), cmap='jet')
-        fig.colorbar(pcm, orientation="horizontal", extend='both')
-    else:
-        pcm = plt.pcolormesh(xgrid, ygrid, cgrid, cmap='jet', vmin=vmin, vmax=vmax)
-        fig.colorbar(pcm, orientation="horizontal", extend='both')
+    pcm = plt.pcolormesh(grid.xgrid, grid.ygrid, cgrid, norm=section_norm(vmin, vmax, log), cmap='jet')
+    fig.colorbar(pcm, orientation="horizontal", extend='both')
     
     # 'beauty' plots
     plt.xlabel('X (m)')
@@ -109,4 +227,59 @@ def plot_2d_section(x: np.ndarray, y: np.ndarray, c: np.ndarray, filename: str,
     plt.axis('scaled')
     plt.title(title)
     plt.savefig(filename, dpi=300)
-    plt.close()
\ No newline at end of file
+    plt.close()
+    count('files_written')
+
+
+def write_section_timelapse(x: np.ndarray, y: np.ndarray, c: np.ndarray, dates: np.ndarray, filename: str,
+                            vmin: int, vmax: int, max_depth: int = 0, log: bool = True,
+                            grid: SectionGrid = None, cmap: str = 'jet', frame_duration: int = 200) -> None:
+    """ Render all timesteps of a section into a single artifact
+
+    The sections are gridded once, colour-mapped with the fixed normalisation and stored as a
+    uint8 index cube (days, ny, nx) plus a 256-entry RGBA lookup table. Index 255 marks cells
+    outside the data hull. A '.npz' filename writes the cube, a '.gif' filename an animation.
+
+    Args:
+        x (np.ndarray): x-position of the section points
+        y (np.ndarray): depth of the section points
+        c (np.ndarray): values (npoints, ndays)
+        dates (np.ndarray): date of each timestep
+        filename (str): output file ('.npz' or '.gif')
+        vmin (int): lower bound of the colour scale
+        vmax (int): upper bound of the colour scale
+        max_depth (int): same as in plot_2d_section
+        log (bool): symmetric-log or linear colour scale
+        grid (SectionGrid): precomputed grid for this geometry
+        cmap (str): matplotlib colormap name
+        frame_duration (int): duration of each GIF frame in ms
+    """
+    if grid is None:
+        grid = SectionGrid.from_points(x, y, max_depth=max_depth)
+    cgrid = grid.interpolate(c)
+    if cgrid.ndim == 2:
+        cgrid = cgrid[np.newaxis]
+
+    # Colour-map with the fixed normalisation into 255 colours + 1 'no data' index
+    norm = section_norm(vmin, vmax, log)
+    scaled = np.ma.filled(norm(np.ma.masked_invalid(cgrid.ravel())), np.nan).reshape(cgrid.shape)
+    cube = np.full(cgrid.shape, 255, dtype=np.uint8)
+    valid = np.isfinite(scaled)
+    cube[valid] = np.rint(np.clip(scaled[valid], 0, 1) * 254).astype(np.uint8)
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    lut[:255] = np.rint(plt.get_cmap(cmap, 255)(np.arange(255)) * 255).astype(np.uint8)
+    # Image rows top-down (shallowest first)
+    cube = cube[:, ::-1, :]
+
+    if filename.endswith('.gif'):
+        # Palette images of the colour indices as they are (no conversion or quantisation)
+        frames = [Image.frombytes('P', (frame.shape[1], frame.shape[0]), frame.tobytes()) for frame in cube]
+        for frame in frames:
+            frame.putpalette(lut[:, :3].ravel().tolist())
+        frames[0].save(filename, save_all=True, append_images=frames[1:], duration=frame_duration,
+                       loop=0, transparency=255)
+    else:
+        np.savez_compressed(filename, cube=cube, lut=lut,
+                            dates=np.asarray(dates, dtype='datetime64[s]'),
+                            extent=np.array(grid.extent), vmin=vmin, vmax=vmax, log=log)
+    count('files_written')
@@ -5,11 +5,15 @@ import numpy as np
 import pandas as pd
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import repeat
 
-from tools.lib import db_connect, geometric_factor, focus_point
+from tools.lib import ConnectionPool, db_connect, db_session, focus_point
 from tools.database_io import read_task, read_dpid_mapper, read_geometry_mapper, read_task_mapper, read_focus_point_mapper
-from tools.geodata import GeophysicalTimeSeries, GeophysicalTimeSeriesRaw
+from tools.read_mpt_data import read_mpt_data_vectorized
+from tools.read_inversion_data import read_aarhusinv_tx2, read_res2dinv_dat
+from tools.instrumentation import count
+from tools.geodata import GeophysicalTimeSeries, GeophysicalTimeSeriesRaw, MeasurementTable
 
 from settings.config import PATH_TO_PICKLE
 
@@ -24,6 +28,10 @@ class GeneralReader(ABC):
     def extend(self, path_to_data: str, data: GeophysicalTimeSeriesRaw) -> GeophysicalTimeSeriesRaw:
         pass
 
+    def default_structure(self, source: str) -> None:
+        # Take the structure of the measurements from an acquisition if none is configured
+        pass
+
     def save_data(self, filename: str):
         outfile = os.path.join(PATH_TO_PICKLE, filename)
         self.data.save(outfile)
@@ -36,9 +44,13 @@ class GeneralReader(ABC):
 
 class TerrameterDatabase(GeneralReader):
 
-    def __init__(self, task_ids: tuple[int] = (1), structure_database: str = ''):
+    def __init__(self, task_ids: tuple[int] = (1,), structure_database: str = '', immutable: bool = True,
+                 value_dtype: str = 'float64', date_unit: str = 's'):
         self.task_ids = task_ids
+        self.value_dtype = value_dtype
+        self.date_unit = date_unit
         self.structure_database = structure_database
+        self.immutable = immutable  # project databases of finished acquisitions do not change (not the newest)
         self.data = GeophysicalTimeSeries()
 
     def read_data(self, path_to_data: str):
@@ -46,26 +58,36 @@ class TerrameterDatabase(GeneralReader):
         root, dirs, files = next(os.walk(path_to_data))
 
         # Get structure from specific database
-        if self.structure_database == '':
-            self.structure_database = os.path.join(root, dirs[0], 'project.db')
+        self.default_structure(os.path.join(root, dirs[0]))
         
         # full path to each folder
         fullpath_dirs = list(map(os.path.join, repeat(root), dirs))
         self.data.raw = self.make_data(fullpath_dirs)
 
     def extend(self, path_to_data: str) -> None:
+        new_data = self.read_new(path_to_data, self.data.raw.dates)
+        if new_data is not None:
+            # Merge the old and new GeophysicalTimeSeries to a new object
+            self.data.raw.extend(new_data)
+
+    def default_structure(self, source: str) -> None:
+        if self.structure_database == '':
+            self.structure_database = os.path.join(source, 'project.db')
+
+    def list_new(self, path_to_data: str, known_dates: np.ndarray) -> list[str]:
         # Read the folder with ALL available dates
         root, dirs, files = next(os.walk(path_to_data))
-        # Find the dates that are not included in data 
-        new_dirs = [fpathdir for fpathdir in dirs if np.datetime64(pd.to_datetime(fpathdir, format='%Y%m%d_%H%M%S')) not in self.data.raw.dates]
-        fullpath_dirs = list(map(os.path.join, repeat(root), new_dirs))
+        # Find the dates that are not included in data (chronological)
+        new_dirs = [fpathdir for fpathdir in sorted(dirs) if np.datetime64(pd.to_datetime(fpathdir, format='%Y%m%d_%H%M%S')) not in known_dates]
+        return list(map(os.path.join, repeat(root), new_dirs))
+
+    def read_new(self, path_to_data: str, known_dates: np.ndarray) -> GeophysicalTimeSeriesRaw:
+        fullpath_dirs = self.list_new(path_to_data, known_dates)
         if len(fullpath_dirs) == 0:
             print('No new data available!')
-        else:
-            # Make a new GeophysicalTimesSeries object
-            new_data = self.make_data(fullpath_dirs)
-            # Merge the old and new GeophysicalTimeSeries to a new object
-            self.data.raw.extend(new_data)
+            return None
+        # Make a new GeophysicalTimesSeries object
+        return self.make_data(fullpath_dirs)
 
     def extend_single(self, fullpath_directory: str) -> None:
         name = os.path.basename(fullpath_directory)
@@ -80,7 +102,7 @@ class TerrameterDatabase(GeneralReader):
             cursor = connection.cursor()
             cursor.execute("SELECT Value From AcqSettings \
                             WHERE Setting='IP_WindowSecList' \
-                            AND key2={}".format(self.task_ids[0]))
+                            AND key2=?", (self.task_ids[0],))
             result = cursor.fetchall()
             if result is None:
                 return None
@@ -90,6 +112,14 @@ class TerrameterDatabase(GeneralReader):
             return None
         
     def make_data(self, fullpath_dirs: str) -> GeophysicalTimeSeries :
+        # One read-only connection per database for the whole ingest. The newest acquisition may still
+        # be written by the instrument (the watchdog starts on its creation): it is not opened immutable
+        newest = max(fullpath_dirs, key=os.path.basename, default=None)
+        mutable = () if newest is None else (os.path.join(newest, 'project.db'),)
+        with db_session(immutable=self.immutable, mutable=mutable) as pool:
+            return self._make_data(fullpath_dirs, pool)
+
+    def _make_data(self, fullpath_dirs: str, pool: ConnectionPool) -> GeophysicalTimeSeries :
         
         if self.structure_database != '':
             # Read structure
@@ -97,92 +127,352 @@ class TerrameterDatabase(GeneralReader):
             dpid_abmn_lookup = read_dpid_mapper(self.structure_database, self.task_ids)
             geometry_lookuptable, geometry_lookuptable_reverse = read_geometry_mapper(
                 self.structure_database, self.task_ids)
-            # Calculate geometric factor and focus points
-            dpid_geometric_factor_lookup = {dpid: geometric_factor(*dpid_abmn_lookup[dpid]) for dpid in dpid_abmn_lookup.keys()}
+            # Metadata of the DPIDs measured in the structure database, in measurement-index order
             focus_point_lookup = read_focus_point_mapper(self.structure_database, self.task_ids)
+            dpids = [geometry_lookuptable_reverse[index] for index in range(len(geometry_lookuptable_reverse))]
+            metadata = MeasurementTable.from_columns(
+                dpids, [task_dpid_lookup_reverse[dpid] for dpid in dpids], [dpid_abmn_lookup[dpid] for dpid in dpids],
+                [focus_point_lookup[dpid][0] for dpid in dpids], [focus_point_lookup[dpid][1] for dpid in dpids])
             # Get array sizes
-            number_of_measurements = len(geometry_lookuptable)
+            number_of_measurements = len(metadata)
             number_of_days = len(fullpath_dirs)
-            number_of_ip_windows = len(self.querry_ip_window_list(self.structure_database)) - 1
-            focus_x = np.empty([number_of_measurements])
-            focus_z = np.empty([number_of_measurements])
-            for key in focus_point_lookup:
-                x, z = focus_point_lookup[key]
-                index = geometry_lookuptable[key]
-                focus_x[index] = x
-                focus_z[index] = z
+            ip_window_list = self.querry_ip_window_list(self.structure_database)
+            number_of_ip_windows = len(ip_window_list) - 1
+            acquisition_settings = {'IP_WindowSecList': ' '.join(map(str, ip_window_list))}
         elif self.data.raw is not None:  # Read structure from data
             number_of_measurements, _, number_of_ip_windows = self.data.raw.decay.shape
             number_of_days = len(fullpath_dirs)
-            geometry_lookuptable = self.data.raw.geometry_lookuptable
-            geometry_lookuptable_reverse = self.data.raw.geometry_lookuptable_reverse
-            task_dpid_lookup = self.data.raw.task_dpid_lookup
-            task_dpid_lookup_reverse = self.data.raw.task_dpid_lookup_reverse
-            dpid_abmn_lookup = self.data.raw.dpid_abmn_lookup
-            dpid_geometric_factor_lookup = self.data.raw.dpid_geometric_factor_lookup
-            focus_x = self.data.raw.focus_x
-            focus_z = self.data.raw.focus_z
+            metadata = self.data.raw.metadata
+            acquisition_settings = self.data.raw.acquisition_settings
         else:
             print('Initialize the object before you can extend it!')
             return None
         
-        # Initialize numpy arrays
-        voltage = np.empty([number_of_measurements, number_of_days])
-        current = np.empty([number_of_measurements, number_of_days])
-        resistance = np.empty([number_of_measurements, number_of_days])
-        apres = np.empty([number_of_measurements, number_of_days])
-        chargeability = np.empty([number_of_measurements, number_of_days])
-        decay = np.empty([number_of_measurements, number_of_days, number_of_ip_windows])
+        # Initialize numpy arrays (missing measurements stay NaN and invalid)
+        voltage = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        current = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        resistance = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        apres = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        chargeability = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        decay = np.full([number_of_measurements, number_of_days, number_of_ip_windows], np.nan, dtype=self.value_dtype)
+        repeat_error = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        valid = np.zeros([number_of_measurements, number_of_days], dtype=bool)
         dates = np.empty(number_of_days, dtype='datetime64[s]')
         
-        # Read each database in pandas dataframe and fill in the numpy matrices
-        # this part can be optimized for speed
+        # Read each database in pandas dataframe and scatter it into the numpy matrices
         for project_index, directory in enumerate(fullpath_dirs):
             dt = pd.to_datetime(os.path.basename(directory), format='%Y%m%d_%H%M%S')
             dates[project_index] = dt
             project = os.path.join(directory, 'project.db')
-            print(project)
             df = read_task(project, ids=self.task_ids)
+            if project != self.structure_database:
+                pool.release(project)
             if df is None:
                 continue
+            count('databases_read')
+            count('rows_ingested', len(df))
             ipstart = df.columns.get_loc('IP1')
             ipend = df.columns.get_loc('SDev')
-            for row_index, row in df.iterrows():
-                key = row["DPID"]
-                if key in geometry_lookuptable:
-                    meas_id = geometry_lookuptable[key]
-                    voltage[meas_id, project_index] = row['volt']
-                    current[meas_id, project_index] = row['current']
-                    resistance[meas_id, project_index] = row['res']
-                    apres[meas_id, project_index] = row['apres']
-                    chargeability[meas_id, project_index] = row['charg']
-                    decay[meas_id, project_index, :] = row[ipstart:ipend].values
-                    #print(geometry_lookuptable[key])
-                else:
-                    print('Measurement is a ghost!')
-
-        data = GeophysicalTimeSeriesRaw(dates, geometry_lookuptable, geometry_lookuptable_reverse, 
-                                        task_dpid_lookup, task_dpid_lookup_reverse, dpid_abmn_lookup, dpid_geometric_factor_lookup, focus_x, focus_z,
-                                        voltage, current, resistance, apres, chargeability, decay)
+            meas_ids = metadata.index_of(df['DPID'].to_numpy())
+            known = meas_ids >= 0
+            count('ghosts', int((~known).sum()))
+            rows = meas_ids[known]
+            voltage[rows, project_index] = df['volt'].to_numpy()[known]
+            current[rows, project_index] = df['current'].to_numpy()[known]
+            resistance[rows, project_index] = df['res'].to_numpy()[known]
+            apres[rows, project_index] = df['apres'].to_numpy()[known]
+            chargeability[rows, project_index] = df['charg'].to_numpy()[known]
+            decay[rows, project_index, :] = df.iloc[:, ipstart:ipend].to_numpy(dtype=float)[known]
+            repeat_error[rows, project_index] = df['res_sdev'].to_numpy()[known]
+            valid[rows, project_index] = True
+
+        data = GeophysicalTimeSeriesRaw(dates, metadata,
+                                        voltage, current, resistance, apres, chargeability, decay,
+                                        value_dtype=self.value_dtype, date_unit=self.date_unit, validity=valid,
+                                        repeat_error=repeat_error)
+        data.acquisition_settings = acquisition_settings
         return data
 
 
-class MPTDAS(GeneralReader):
-    
-    def __init__(self, structure_database: str = ''):
-        pass
+class FileReader(GeneralReader):
+    """ Directory of data files, one acquisition per file dated by the file name """
+
+    extension = ''
+
+    def __init__(self, structure_file: str = '', task_id: int = 1,
+                 date_format: str = '%Y%m%d_%H%M%S', max_workers: int = None,
+                 value_dtype: str = 'float64', date_unit: str = 's'):
+        self.task_ids = (task_id,)
+        self.value_dtype = value_dtype
+        self.date_unit = date_unit
+        self.structure_file = structure_file
+        self.date_format = date_format
+        self.max_workers = max_workers
+        self.data = GeophysicalTimeSeries()
+
+    def _list_files(self, path_to_data: str) -> list[str]:
+        root, dirs, files = next(os.walk(path_to_data))
+        return sorted(os.path.join(root, f) for f in files if f.endswith(self.extension))
+
+    def _date(self, filename: str) -> np.datetime64:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return np.datetime64(pd.to_datetime(name, format=self.date_format), 's')
 
     def read_data(self, path_to_data: str):
-        pass
+        self.data.raw = self.make_data(self._list_files(path_to_data))
 
     def extend(self, path_to_data: str) -> None:
-        pass
+        new_data = self.read_new(path_to_data, self.data.raw.dates)
+        if new_data is not None:
+            self.data.raw.extend(new_data)
 
-    def extend_single(self, fullpath_directory: str) -> None:
+    def list_new(self, path_to_data: str, known_dates: np.ndarray) -> list[str]:
+        # Find the files that are not included in data (chronological)
+        new_files = [f for f in self._list_files(path_to_data) if self._date(f) not in known_dates]
+        return sorted(new_files, key=self._date)
+
+    def read_new(self, path_to_data: str, known_dates: np.ndarray) -> GeophysicalTimeSeriesRaw:
+        new_files = self.list_new(path_to_data, known_dates)
+        if len(new_files) == 0:
+            print('No new data available!')
+            return None
+        return self.make_data(new_files)
+
+    def extend_single(self, fullpath_file: str) -> None:
+        new_data = self.make_data([fullpath_file,])
+        self.data.raw.extend(new_data)
+
+    @staticmethod
+    def _quadrupole_keys(abmn: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        # Encode the (A, B, M, N) x-positions as a single integer (-1 if an electrode is unknown)
+        index = np.clip(np.searchsorted(positions, abmn), 0, len(positions) - 1)
+        known = (positions[index] == abmn).all(axis=1)
+        base = len(positions)
+        keys = ((index[:, 0] * base + index[:, 1]) * base + index[:, 2]) * base + index[:, 3]
+        keys[~known] = -1
+        return keys
+
+    @abstractmethod
+    def make_data(self, fullpath_files: list[str]) -> GeophysicalTimeSeriesRaw:
         pass
 
 
-    
+class MPTDAS(FileReader):
+
+    extension = '.Ohm'
+
+    def default_structure(self, source: str) -> None:
+        if self.structure_file == '':
+            self.structure_file = source
+
+    def read_data(self, path_to_data: str):
+
+        fullpath_files = self._list_files(path_to_data)
+
+        # Get structure from specific file
+        self.default_structure(fullpath_files[0])
+
+        self.data.raw = self.make_data(fullpath_files)
+
+    def make_data(self, fullpath_files: list[str]) -> GeophysicalTimeSeriesRaw:
+
+        if self.data.raw is None:
+            if self.structure_file == '':
+                print('Initialize the object before you can extend it!')
+                return None
+            # Read structure: the quadrupoles of the structure file, DPID = row + 1
+            meas, elecs = read_mpt_data_vectorized(self.structure_file)
+            meas = meas[~np.isnan(meas[:, :4]).any(axis=1)]
+            abmn = elecs[meas[:, :4].astype(int), 0]
+            _, first = np.unique(abmn, axis=0, return_index=True)
+            abmn = abmn[np.sort(first)]
+            task_id = self.task_ids[0]
+            focus = np.array([focus_point(*quadrupole) for quadrupole in abmn]).reshape(-1, 2)
+            metadata = MeasurementTable.from_columns(np.arange(1, len(abmn) + 1), task_id, abmn, focus[:, 0], focus[:, 1])
+        else:  # Read structure from data
+            metadata = self.data.raw.metadata
+            abmn = metadata.abmn
+
+        # Sorted quadrupole keys of the structure for searchsorted matching
+        positions = np.unique(abmn)
+        structure_keys = self._quadrupole_keys(abmn, positions)
+        order = np.argsort(structure_keys)
+        sorted_keys = structure_keys[order]
+
+        number_of_measurements = len(metadata)
+        number_of_days = len(fullpath_files)
+        # Initialize numpy arrays (missing measurements stay NaN)
+        voltage = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        current = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        resistance = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        apres = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        chargeability = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        decay = np.empty([number_of_measurements, number_of_days, 0], dtype=self.value_dtype)
+        repeat_error = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        valid = np.zeros([number_of_measurements, number_of_days], dtype=bool)
+        dates = np.array([self._date(f) for f in fullpath_files], dtype='datetime64[s]')
+
+        # Parse the files in parallel and scatter each one into its column
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for project_index, (meas, elecs) in enumerate(executor.map(read_mpt_data_vectorized, fullpath_files)):
+                meas = meas[~np.isnan(meas).any(axis=1)]
+                count('files_read')
+                count('rows_ingested', len(meas))
+                keys = self._quadrupole_keys(elecs[meas[:, :4].astype(int), 0], positions)
+                position = np.clip(np.searchsorted(sorted_keys, keys), 0, len(sorted_keys) - 1)
+                found = sorted_keys[position] == keys
+                count('ghosts', int((~found).sum()))
+                meas_id = order[position[found]]
+                meas = meas[found]
+                voltage[meas_id, project_index] = meas[:, 7]
+                current[meas_id, project_index] = meas[:, 9]
+                resistance[meas_id, project_index] = meas[:, 5]
+                apres[meas_id, project_index] = meas[:, 4]
+                # Standard deviation of the resistance in Ohm, stored relative [%]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    repeat_error[meas_id, project_index] = meas[:, 6] / np.abs(meas[:, 5]) * 100
+                valid[meas_id, project_index] = True
+
+        data = GeophysicalTimeSeriesRaw(dates, metadata,
+                                        voltage, current, resistance, apres, chargeability, decay,
+                                        value_dtype=self.value_dtype, date_unit=self.date_unit, validity=valid,
+                                        repeat_error=repeat_error)
+        return data
+
+
+class InversionFileReader(FileReader):
+    """ Input files of inversion software: quadrupoles given by their electrode positions
+
+    Without a structure file the quadrupoles of all files read first, in order of appearance,
+    make the geometry (DPID = row + 1). Later files are matched to it by electrode positions.
+    """
+
+    # Parser of a file: measurements (INVERSION_DATA_COLUMNS), decays and acquisition settings
+    parse = None
+    # Files parsed at once while the geometry of a directory is collected
+    STRUCTURE_CHUNK = 256
+    # Quadrupoles, number of gates and acquisition settings set by default_structure
+    structure = None
+
+    def default_structure(self, source: str) -> None:
+        """ Geometry of all files in the directory of source, as read_data would make it
+
+        Used when the files are read in batches (backfill), so quadrupoles that only appear in
+        later files are not dropped. The files are parsed in chunks and only their quadrupoles kept.
+        """
+        if self.structure_file != '':
+            return
+        files = self._list_files(os.path.dirname(source))
+        abmn, number_of_gates, acquisition_settings = [], 0, None
+        for start in range(0, len(files), self.STRUCTURE_CHUNK):
+            for meas, decay, settings in self._parse_files(files[start:start + self.STRUCTURE_CHUNK]):
+                abmn.append(self._unique_quadrupoles(meas[:, :4]))
+                number_of_gates = max(number_of_gates, decay.shape[1])
+                acquisition_settings = dict(settings) if acquisition_settings is None else acquisition_settings
+            abmn = [self._unique_quadrupoles(np.concatenate(abmn))]
+        self.structure = (abmn[0] if abmn else np.empty([0, 4]), number_of_gates, acquisition_settings or {})
+
+    @staticmethod
+    def _unique_quadrupoles(abmn: np.ndarray) -> np.ndarray:
+        # Complete quadrupoles without repetitions, in order of appearance
+        abmn = abmn[~np.isnan(abmn).any(axis=1)]
+        _, first = np.unique(abmn, axis=0, return_index=True)
+        return abmn[np.sort(first)]
+
+    def _parse_files(self, fullpath_files: list[str]) -> list[tuple[np.ndarray, np.ndarray, dict[str, str]]]:
+        # Text parsing holds the GIL, so the files are parsed by processes
+        if len(fullpath_files) == 1 or self.max_workers == 1:
+            return [self.parse(f) for f in fullpath_files]
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.parse, fullpath_files, chunksize=8))
+
+    def make_data(self, fullpath_files: list[str]) -> GeophysicalTimeSeriesRaw:
+
+        parsed = self._parse_files(fullpath_files)
+        if self.data.raw is None:
+            # Read structure: the quadrupoles of the structure file, of the directory (see
+            # default_structure) or of all files
+            if self.structure is not None:
+                abmn, number_of_gates, acquisition_settings = self.structure
+            else:
+                tables = parsed if self.structure_file == '' else [self.parse(self.structure_file)]
+                abmn = self._unique_quadrupoles(np.concatenate([meas[:, :4] for meas, _, _ in tables]))
+                number_of_gates = max(decay.shape[1] for _, decay, _ in tables)
+                acquisition_settings = dict(tables[0][2])
+            task_id = self.task_ids[0]
+            focus = np.array([focus_point(*quadrupole) for quadrupole in abmn]).reshape(-1, 2)
+            metadata = MeasurementTable.from_columns(np.arange(1, len(abmn) + 1), task_id, abmn, focus[:, 0], focus[:, 1])
+        else:  # Read structure from data
+            metadata = self.data.raw.metadata
+            abmn = metadata.abmn
+            number_of_gates = self.data.raw.decay.shape[2]
+            acquisition_settings = self.data.raw.acquisition_settings
+
+        # Sorted quadrupole keys of the structure for searchsorted matching
+        positions = np.unique(abmn)
+        structure_keys = self._quadrupole_keys(abmn, positions)
+        order = np.argsort(structure_keys)
+        sorted_keys = structure_keys[order]
+
+        number_of_measurements = len(metadata)
+        number_of_days = len(fullpath_files)
+        # Initialize numpy arrays (missing measurements stay NaN)
+        voltage = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        current = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        resistance = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        apres = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        chargeability = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        decay = np.full([number_of_measurements, number_of_days, number_of_gates], np.nan, dtype=self.value_dtype)
+        repeat_error = np.full([number_of_measurements, number_of_days], np.nan, dtype=self.value_dtype)
+        valid = np.zeros([number_of_measurements, number_of_days], dtype=bool)
+        dates = np.array([self._date(f) for f in fullpath_files], dtype='datetime64[s]')
+
+        # Scatter each file into its column
+        for project_index, (meas, gates, _) in enumerate(parsed):
+            usable = ~np.isnan(meas[:, :4]).any(axis=1) & ~np.isnan(meas[:, 4])
+            meas, gates = meas[usable], gates[usable]
+            count('files_read')
+            count('rows_ingested', len(meas))
+            keys = self._quadrupole_keys(meas[:, :4], positions)
+            position = np.clip(np.searchsorted(sorted_keys, keys), 0, len(sorted_keys) - 1)
+            found = sorted_keys[position] == keys
+            count('ghosts', int((~found).sum()))
+            meas_id = order[position[found]]
+            meas, gates = meas[found], gates[found, :number_of_gates]
+            resistance[meas_id, project_index] = meas[:, 4]
+            apres[meas_id, project_index] = meas[:, 5]
+            chargeability[meas_id, project_index] = meas[:, 6]
+            voltage[meas_id, project_index] = meas[:, 7]
+            current[meas_id, project_index] = meas[:, 8]
+            repeat_error[meas_id, project_index] = meas[:, 9]
+            decay[meas_id, project_index, :gates.shape[1]] = gates
+            valid[meas_id, project_index] = True
+
+        data = GeophysicalTimeSeriesRaw(dates, metadata,
+                                        voltage, current, resistance, apres, chargeability, decay,
+                                        value_dtype=self.value_dtype, date_unit=self.date_unit, validity=valid,
+                                        repeat_error=repeat_error)
+        data.acquisition_settings = acquisition_settings
+        return data
+
+
+class Res2DInvDat(InversionFileReader):
+    """ Res2DInv general array files, named by date as the dat files written by the pipeline """
+
+    extension = '.dat'
+    parse = staticmethod(read_res2dinv_dat)
+
+    def __init__(self, structure_file: str = '', task_id: int = 1,
+                 date_format: str = '%Y_%m_%d_%H_%M_%S', max_workers: int = None,
+                 value_dtype: str = 'float64', date_unit: str = 's'):
+        super().__init__(structure_file, task_id, date_format, max_workers, value_dtype, date_unit)
+
+
+class AarhusInvTx2(InversionFileReader):
+
+    extension = '.tx2'
+    parse = staticmethod(read_aarhusinv_tx2)
+
 
 def read_res2dinv_xyz_single(filename: str) -> np.ndarray:
     with open(filename, 'r') as fin:
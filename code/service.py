@@ -0,0 +1,289 @@
+"""
+Read-only HTTP/JSON queries on the stored time series, for dashboards.
+
+    python service.py [--host 127.0.0.1] [--port 8050] [--cache-mb 64]
+
+Every query reads the history stores next to the pickle (or its shards, see tools.history), so a
+request only touches the chunks it needs and never waits for the pickle. Requests are served on
+threads while the pipeline keeps saving: a query sees the stores as of its start and is read again
+if a store was replaced meanwhile. Responses are kept in a least recently used cache, keyed by the
+versions of the stores they were read from, so new data is served as soon as it is saved.
+
+GET /dpids                                               DPIDs and tasks
+GET /dates?part=raw                                      stored days ('raw', 'filtered', 'inverted_<task>')
+GET /history?dpid=&quantity=apres&part=raw&level=        history of a measurement (level: D, W or M aggregates)
+GET /cell?task=&x=&depth=&quantity=resistivity&level=    history of the inverted cell nearest to (x, depth)
+GET /section?task=&date=&kind=pseudo&quantity=&part=raw  pseudo or inverted section of the day nearest to date
+GET /slice?start=&end=&quantity=apres&part=raw&dpids=    all measurements (or some DPIDs) between two dates
+"""
+import argparse
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from tools.history import HistoryStore, LEVELS, cell_aggregates, cell_history, date_range, measurement_aggregates
+from tools.history import measurement_history, measurement_metadata, section
+from tools.shards import ShardedTimeSeries
+
+from main import PICKLE_FULLPATH, PATH_TO_SHARDS, SHARD_PERIOD
+
+
+class QueryError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    """ Least recently used responses, shared by the request threads """
+
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> bytes:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class QueryService:
+
+    # Attempts of a query while the pipeline replaces the stores it reads
+    ATTEMPTS = 3
+
+    def __init__(self, filenames, cache_bytes: int = 64 * 1024 ** 2):
+        self.filenames = filenames  # callable returning the pickles with a history store
+        self.cache = ResponseCache(cache_bytes)
+        self.endpoints = {'/dpids': self.dpids, '/dates': self.dates, '/history': self.history,
+                          '/cell': self.cell, '/section': self.section, '/slice': self.slice}
+
+    def handle(self, path: str, params: dict[str, str]) -> bytes:
+        """
+        JSON response of a query.
+
+        :param path: endpoint
+        :param params: query parameters
+        :return: UTF-8 encoded JSON
+        """
+        if path not in self.endpoints:
+            raise QueryError(404, 'Unknown endpoint {}'.format(path))
+        try:
+            store, query = self.endpoints[path](params)
+        except (KeyError, ValueError) as error:
+            raise QueryError(400, 'Invalid parameters: {}'.format(error))
+        filenames = self.filenames()
+        for attempt in range(self.ATTEMPTS):
+            version = self.version(filenames, store)
+            key = (path, tuple(sorted(params.items())), version)
+            body = self.cache.get(key)
+            if body is not None:
+                return body
+            try:
+                body = json.dumps(query(filenames)).encode()
+            except KeyError as error:
+                raise QueryError(404, 'Not stored: {}'.format(error))
+            except (OSError, ValueError):
+                # A store replaced while it was read; anything else is reported
+                if self.version(filenames, store) == version:
+                    raise
+                continue
+            if self.version(filenames, store) == version:
+                self.cache.put(key, body)
+                return body
+        raise QueryError(503, 'Store is being updated, retry')
+
+    @staticmethod
+    def version(filenames: list[str], store: str) -> tuple:
+        # Index files of a store are replaced (new inode) on every update
+        version = []
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(filename + '.history', store, 'index.pickle'))
+                version.append((filename, stat.st_ino, stat.st_mtime_ns))
+            except FileNotFoundError:
+                version.append((filename, None, None))
+        return tuple(version)
+
+    def dpids(self, params: dict):
+        def query(filenames):
+            metadata = None
+            for filename in filenames:
+                metadata = HistoryStore(os.path.join(filename + '.history', 'raw')).index.get('metadata', metadata)
+            if metadata is None:
+                raise QueryError(404, 'No data stored')
+            return {'dpids': metadata['dpid'].tolist(), 'tasks': np.unique(metadata['task_id']).tolist()}
+        return 'raw', query
+
+    def dates(self, params: dict):
+        part = params.get('part', 'raw')
+
+        def query(filenames):
+            dates = [HistoryStore(os.path.join(filename + '.history', part)).dates for filename in filenames]
+            dates = np.sort(np.concatenate([np.array([], dtype='datetime64[s]')] + dates).astype('datetime64[s]'))
+            return {'part': part, 'dates': _dates(dates)}
+        return part, query
+
+    def history(self, params: dict):
+        dpid = int(params['dpid'])
+        quantity = params.get('quantity', 'apres')
+        part = params.get('part', 'raw')
+        level = _level(params)
+
+        def query(filenames):
+            if measurement_metadata(filenames, dpid) is None:
+                raise QueryError(404, 'Unknown DPID {}'.format(dpid))
+            if level is None:
+                return _series(*measurement_history(filenames, dpid, quantity, part), dpid=dpid)
+            return _aggregated(*measurement_aggregates(filenames, dpid, quantity, level, part), dpid=dpid)
+        return part if level is None else f'{part}_{level}', query
+
+    def cell(self, params: dict):
+        task_id = int(params['task'])
+        x, depth = float(params['x']), float(params['depth'])
+        quantity = params.get('quantity', 'resistivity')
+        level = _level(params)
+        if level is None:
+            return f'inverted_{task_id}', lambda filenames: _series(
+                *cell_history(filenames, task_id, x, depth, quantity))
+        return f'inverted_{task_id}_{level}', lambda filenames: _aggregated(
+            *cell_aggregates(filenames, task_id, x, depth, quantity, level))
+
+    def section(self, params: dict):
+        task_id = int(params['task'])
+        date = np.datetime64(params['date'])
+        kind = params.get('kind', 'pseudo')
+        if kind not in ('pseudo', 'inverted'):
+            raise ValueError('kind must be pseudo or inverted')
+        part = params.get('part', 'raw') if kind == 'pseudo' else f'inverted_{task_id}'
+        quantity = params.get('quantity', 'apres' if kind == 'pseudo' else 'resistivity')
+
+        def query(filenames):
+            day, values, index = section(filenames, part, quantity, date)
+            if day is None:
+                raise QueryError(404, 'No {} data stored'.format(part))
+            if kind == 'pseudo':
+                metadata = index.get('metadata')
+                if metadata is None:  # filtered stores have DPIDs only, the geometry is in the raw store
+                    metadata = HistoryStore(os.path.join(filenames[-1] + '.history', 'raw')).index['metadata']
+                rows = {dpid: row for row, dpid in enumerate(metadata['dpid'].tolist())}
+                rows = np.array([rows[dpid] for dpid in index['labels'].tolist()])
+                task = metadata['task_id'][rows] == task_id
+                x, depth = metadata['focus_x'][rows][task], metadata['focus_z'][rows][task]
+                return {'task': task_id, 'date': _dates(day), 'dpids': index['labels'][task].tolist(),
+                        'x': _values(x), 'depth': _values(depth), 'values': _values(values[task])}
+            return {'task': task_id, 'date': _dates(day), 'x': _values(index['x']), 'depth': _values(index['depth']),
+                    'values': _values(values)}
+        return part, query
+
+    def slice(self, params: dict):
+        start = np.datetime64(params['start']) if 'start' in params else None
+        end = np.datetime64(params['end']) if 'end' in params else None
+        quantity = params.get('quantity', 'apres')
+        part = params.get('part', 'raw')
+        dpids = [int(dpid) for dpid in params['dpids'].split(',')] if 'dpids' in params else None
+
+        def query(filenames):
+            labels, dates, values = date_range(filenames, part, quantity, start, end)
+            if dpids is not None and labels is not None:
+                rows = np.array([np.flatnonzero(labels == dpid)[0] for dpid in dpids if dpid in labels], dtype=np.int64)
+                labels, values = labels[rows], values[rows]
+            return {'part': part, 'dates': _dates(dates), 'labels': None if labels is None else labels.tolist(),
+                    'values': _values(values)}
+        return part, query
+
+
+def _level(params: dict) -> str:
+    level = params.get('level', '')
+    if level != '' and level not in [unit for unit, _ in LEVELS]:
+        raise ValueError('level must be one of {}'.format(', '.join(unit for unit, _ in LEVELS)))
+    return level or None
+
+
+def _dates(dates):
+    return np.datetime_as_string(dates).tolist()
+
+
+def _values(values: np.ndarray) -> list:
+    # NaN (not acquired or rejected) as null
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def _series(dates, values, **keys) -> dict:
+    return dict(keys, dates=_dates(dates), values=_values(values))
+
+
+def _aggregated(bins, statistics, **keys) -> dict:
+    return dict(keys, dates=_dates(bins), **{statistic: _values(values) for statistic, values in statistics.items()})
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    service: QueryService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            body, status = self.service.handle(url.path, params), 200
+        except QueryError as error:
+            body, status = json.dumps({'error': str(error)}).encode(), error.status
+        except Exception as error:
+            body, status = json.dumps({'error': repr(error)}).encode(), 500
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def stored_files() -> list[str]:
+    # Pickles with a history store, without splitting a single pickle into shards
+    if SHARD_PERIOD == '':
+        return [PICKLE_FULLPATH]
+    store = ShardedTimeSeries(PATH_TO_SHARDS, SHARD_PERIOD)
+    return [store.filename(key) for key in store.keys()]
+
+
+def serve(host: str = '127.0.0.1', port: int = 8050, cache_bytes: int = 64 * 1024 ** 2) -> None:
+    handler = type('Handler', (QueryHandler,), {'service': QueryService(stored_files, cache_bytes)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print('Serving on http://{}:{}'.format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--cache-mb', type=float, default=64, help='size of the response cache')
+    args = parser.parse_args()
+    serve(args.host, args.port, int(args.cache_mb * 1024 ** 2))
@@ -0,0 +1,43 @@
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from benchmark.run import write_config
+from tools.geodata import GeophysicalTimeSeries, GeophysicalTimeSeriesRaw, MeasurementTable
+
+
+@pytest.fixture(scope='session')
+def main(tmp_path_factory):
+    # main.py with a scratch settings package (as benchmark.run does)
+    root = str(tmp_path_factory.mktemp('pipeline'))
+    write_config(root)
+    for name in ('data', 'plot', 'pseudo', 'pickle', 'inversion'):
+        os.makedirs(os.path.join(root, name))
+    with open(os.path.join(root, 'inversion_params.ini'), 'w') as fout:
+        fout.write('synthetic\n')
+    sys.path.insert(0, root)
+    try:
+        yield importlib.import_module('main')
+    finally:
+        sys.path.remove(root)
+
+
+def make_series(dates, measurements: int = 5, gates: int = 0, value_dtype: str = 'float64',
+                seed: int = 0) -> GeophysicalTimeSeries:
+    # One task of surface quadrupoles acquired and accepted on every date, every value different
+    rng = np.random.default_rng(seed)
+    dates = np.asarray(dates, dtype='datetime64[s]')
+    abmn = np.array([[row, row + 3, row + 1, row + 2] for row in range(measurements)], dtype=float)
+    metadata = MeasurementTable.from_columns(np.arange(1, measurements + 1), np.ones(measurements, dtype=int), abmn,
+                                             abmn[:, 2:].mean(axis=1), np.ones(measurements))
+    values = [rng.uniform(1, 10, [measurements, len(dates)]).round(4) for _ in range(5)]
+    data = GeophysicalTimeSeries()
+    decay = rng.uniform(1, 10, [measurements, len(dates), gates])
+    data.raw = GeophysicalTimeSeriesRaw(dates, metadata, *values, decay, value_dtype=value_dtype,
+                                        validity=np.ones([measurements, len(dates)], dtype=bool),
+                                        repeat_error=np.zeros([measurements, len(dates)]))
+    data.raw.rejected = np.zeros([measurements, len(dates)], dtype=bool)
+    return data
@@ -0,0 +1,56 @@
+import numpy as np
+
+from tools.anomaly import AnomalyDetector
+
+
+def daily(days: int) -> np.ndarray:
+    return np.datetime64('2024-01-01T00:00:00', 's') + np.arange(days) * np.timedelta64(1, 'D')
+
+
+def series(days: int = 200, step_day: int = 100, step: float = 0.5, seed: int = 0) -> np.ndarray:
+    # Three rows around 100 with 1% noise, the first one with a step from step_day on
+    rng = np.random.default_rng(seed)
+    values = 100 * (1 + 0.01 * rng.standard_normal([3, days]))
+    values[0, step_day:] *= 1 + step
+    return values
+
+
+def kinds(alerts: list[dict], label: int) -> list[str]:
+    return [alert['kind'] for alert in alerts if alert['label'] == label]
+
+
+def test_step_change_is_a_shift_then_relevelled(tmp_path):
+    values = series()
+    alerts = AnomalyDetector(str(tmp_path)).update('raw_apres', daily(200), values)
+    step = kinds(alerts, 0)
+    assert 'shift_up' in step
+    # A few spikes until the new level is adopted, not one per day
+    assert step.count('spike') <= 3
+    assert len(kinds(alerts, 1)) == 0 and len(kinds(alerts, 2)) == 0
+    # Quiet once the level restarted
+    late = [alert for alert in alerts if alert['label'] == 0 and alert['date'] >= str(daily(200)[110])]
+    assert late == []
+
+
+def test_step_down(tmp_path):
+    alerts = AnomalyDetector(str(tmp_path)).update('raw_apres', daily(200), series(step=-0.5))
+    assert 'shift_down' in kinds(alerts, 0)
+    assert kinds(alerts, 0).count('spike') <= 3
+
+
+def test_single_spike_is_not_a_shift(tmp_path):
+    values = series(step=0)
+    values[1, 150] *= 2
+    alerts = AnomalyDetector(str(tmp_path)).update('raw_apres', daily(200), values)
+    assert kinds(alerts, 1) == ['spike']
+    assert alerts[0]['date'] == str(daily(200)[150])
+
+
+def test_detection_resumes_from_the_saved_state(tmp_path):
+    values, dates = series(), daily(200)
+    whole = AnomalyDetector(str(tmp_path / 'whole')).update('raw_apres', dates, values)
+    detector = AnomalyDetector(str(tmp_path / 'parts'))
+    parts = detector.update('raw_apres', dates[:120], values[:, :120])
+    # Days already processed are ignored
+    parts += detector.update('raw_apres', dates[100:], values[:, 100:])
+    assert parts == whole
@@ -0,0 +1,35 @@
+import numpy as np
+
+from tools.decay_fit import fit_block, gate_times, stretched_exponential
+
+
+TIMES = gate_times([0.02] + [0.02] * 4 + [0.04] * 4 + [0.08] * 4 + [0.16] * 4)
+
+
+def test_fit_recovers_known_parameters():
+    m0 = np.array([[40.0, 12.0], [25.0, 8.0]])
+    tau = np.array([[0.1, 0.5], [0.05, 1.0]])
+    c = np.array([[0.5, 0.8], [0.3, 1.0]])
+    decays = stretched_exponential(TIMES, m0[..., None], tau[..., None], c[..., None])
+    decays[1, 0, [3, 7]] = np.nan  # missing gates are ignored
+
+    fitted = fit_block(decays, TIMES, iterations=100)
+    assert fitted['valid'].all()
+    np.testing.assert_allclose(fitted['m0'], m0, rtol=1e-3)
+    np.testing.assert_allclose(fitted['tau'], tau, rtol=1e-3)
+    np.testing.assert_allclose(fitted['c'], c, rtol=1e-3)
+    assert (fitted['misfit'] < 1e-4).all()
+
+
+def test_noisy_or_incomplete_decays():
+    rng = np.random.default_rng(0)
+    decays = stretched_exponential(TIMES, 30.0, 0.2, 0.6) * (1 + 0.01 * rng.standard_normal([50, len(TIMES)]))
+    fitted = fit_block(decays, TIMES)
+    assert fitted['valid'].all()
+    assert abs(np.median(fitted['tau']) / 0.2 - 1) < 0.05
+
+    # Fewer gates than min_gates, or no decay at all
+    short = np.full([2, len(TIMES)], np.nan)
+    short[0, :3] = decays[0, :3]
+    fitted = fit_block(short, TIMES)
+    assert not fitted['valid'].any() and np.isnan(fitted['m0']).all()
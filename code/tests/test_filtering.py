@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from scipy.signal import medfilt
+
+from filtering import Butterworth, Median
+
+
+@pytest.mark.parametrize('strategy', [Median(), Butterworth()])
+def test_gaps_only_drop_their_days(strategy):
+    values = np.random.default_rng(0).random([4, 120])
+    complete = strategy.filter(values)
+    values[1, 0] = values[2, -1] = values[3, 60] = np.nan
+    filtered = strategy.filter(values)
+
+    np.testing.assert_array_equal(np.isnan(filtered), np.isnan(values))
+    np.testing.assert_allclose(filtered[0], complete[0])
+    # Each side of a gap is filtered on its own
+    np.testing.assert_allclose(filtered[3, :60], strategy.filter(values[3:, :60])[0])
+    np.testing.assert_allclose(filtered[3, 61:], strategy.filter(values[3:, 61:])[0])
+
+
+def test_median_of_a_short_run():
+    values = np.array([[1.0, np.nan, 4.0, 2.0, 9.0, np.nan]])
+    np.testing.assert_array_equal(Median().filter(values), [[1.0, np.nan, *medfilt([4.0, 2.0, 9.0], 3), np.nan]])
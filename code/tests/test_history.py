@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from tools.history import aggregate_table, calendar_bins, update_aggregates
+
+
+def write_shard(path: str, name: str, start: str, days: int, labels: np.ndarray) -> np.ndarray:
+    # Daily values of the labelled rows, the value of a row is its label
+    dates = np.datetime64(start, 's') + np.arange(days) * np.timedelta64(1, 'D')
+    values = np.repeat(labels.astype(float)[:, np.newaxis], days, axis=1)
+    update_aggregates(os.path.join(path, name + '.history', 'raw'), dates, {'apres': values}, labels=labels)
+    return dates
+
+
+def test_weeks_start_on_monday():
+    dates = np.array(['2024-01-07', '2024-01-08', '2024-01-14', '2024-01-15'], dtype='datetime64[s]')
+    np.testing.assert_array_equal(calendar_bins(dates, 'W'),
+                                  np.array(['2024-01-01', '2024-01-08', '2024-01-08', '2024-01-15'], dtype='datetime64[D]'))
+
+
+def test_aggregate_table_matches_rows_by_label(tmp_path):
+    write_shard(str(tmp_path), 'a', '2024-01-01', 31, np.array([10, 20, 30]))
+    write_shard(str(tmp_path), 'b', '2024-02-01', 29, np.array([30, 40, 10]))
+    filenames = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+
+    labels, bins, statistics = aggregate_table(filenames, 'apres', 'M')
+    np.testing.assert_array_equal(labels, [30, 40, 10])
+    np.testing.assert_array_equal(bins, np.array(['2024-01', '2024-02'], dtype='datetime64[M]'))
+    np.testing.assert_array_equal(statistics['count'], [[31, 29], [0, 29], [31, 29]])
+    np.testing.assert_array_equal(statistics['mean'], [[30, 30], [np.nan, 40], [10, 10]])
+
+    # The week across both shards (Monday 2024-01-29) combines the days of each row
+    labels, bins, statistics = aggregate_table(filenames, 'apres', 'W')
+    week = np.flatnonzero(bins == np.datetime64('2024-01-29'))[0]
+    np.testing.assert_array_equal(statistics['count'][:, week], [7, 4, 7])
+    np.testing.assert_array_equal(statistics['min'][:, week], [30, 40, 10])
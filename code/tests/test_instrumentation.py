@@ -0,0 +1,29 @@
+import json
+
+import numpy as np
+
+from tools.instrumentation import Instrumentation
+
+
+def test_nested_span_keeps_the_peak_of_the_enclosing_span(tmp_path):
+    log = tmp_path / 'metrics.jsonl'
+    instrumentation = Instrumentation()
+    instrumentation.enable(str(log), trace_memory=True)
+    try:
+        with instrumentation.span('outer'):
+            block = np.ones(4_000_000)  # 32 MB before the inner spans
+            del block
+            with instrumentation.span('inner'):
+                block = np.ones(500_000)  # 4 MB
+                del block
+            with instrumentation.span('inner'):
+                pass
+    finally:
+        instrumentation.disable()
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    peaks = {}
+    for record in records:
+        peaks.setdefault(record['span'], []).append(record['peak_memory_bytes'])
+    assert peaks['outer'][0] >= 32_000_000
+    assert 4_000_000 <= peaks['inner'][0] < 32_000_000
+    assert peaks['inner'][1] < 4_000_000
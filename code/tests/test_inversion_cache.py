@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+import writter as w
+from conftest import make_series
+from tools.inversion_cache import InversionCache
+
+
+@pytest.fixture
+def params_file(tmp_path):
+    filename = str(tmp_path / 'params.ini')
+    with open(filename, 'w') as fout:
+        fout.write('damping 0.1\n')
+    return filename
+
+
+def invert(dat_file: str, params_file: str, cache: InversionCache) -> None:
+    # Outputs of a finished inversion
+    with open(dat_file[:-4] + '.xyz', 'w') as fout:
+        fout.write('model\n')
+    cache.store(dat_file, params_file)
+
+
+def test_params_change_makes_outputs_stale(tmp_path, params_file):
+    cache = InversionCache(str(tmp_path / 'cache'), backend='res2dinv 1')
+    dat_file = str(tmp_path / 'day.dat')
+    text = 'day.dat\n1\n11\n4 0 0 3 0 1 0 2 0 5.0\n'
+    with open(dat_file, 'w') as fout:
+        fout.write(text)
+    assert not cache.up_to_date(dat_file, text, params_file)
+    invert(dat_file, params_file, cache)
+    assert cache.up_to_date(dat_file, text, params_file)
+
+    with open(params_file, 'a') as fout:
+        fout.write('iterations 7\n')
+    assert not cache.up_to_date(dat_file, text, params_file)
+    # So does another backend
+    assert not InversionCache(cache.path, backend='res2dinv 2').up_to_date(dat_file, text, params_file)
+
+
+def test_only_changed_days_are_formatted(main, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, 'PATH_TO_INVERSION_OUTPUT', str(tmp_path / 'inversion'))
+    monkeypatch.setattr(main, 'PATH_TO_INVERSION_CACHE', str(tmp_path / 'cache'))
+    data = make_series(np.datetime64('2024-03-01T00', 's') + np.arange(4) * np.timedelta64(1, 'h'))
+    formatted = []
+    format_dat = w.format_dat
+    monkeypatch.setattr(w, 'format_dat', lambda data, filename, *args, **kwargs:
+                        formatted.append(os.path.basename(filename)) or format_dat(data, filename, *args, **kwargs))
+
+    main.write_dats_task(data, 1)
+    folder = os.path.join(main.PATH_TO_INVERSION_OUTPUT, 'individual', 'task_1')
+    params_file = os.path.join(folder, os.path.basename(main.INVERSION_PARAMS))
+    dat_files = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.dat'))
+    assert len(formatted) == len(dat_files) == 4
+    for dat_file in dat_files:
+        invert(dat_file, params_file, main.inversion_cache())
+    os.remove(os.path.join(folder, 'batch.bth'))
+
+    # Checked once against the outputs, then skipped without formatting
+    main.write_dats_task(data, 1)
+    main.write_dats_task(data, 1)
+    assert len(formatted) == 8 and not os.path.isfile(os.path.join(folder, 'batch.bth'))
+
+    data.raw.resistance[2, 1] *= 2
+    main.write_dats_task(data, 1)
+    assert formatted[8:] == [os.path.basename(dat_files[1])]
+    with open(os.path.join(folder, 'batch.bth')) as fin:
+        assert dat_files[1] in fin.read()
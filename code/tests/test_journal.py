@@ -0,0 +1,64 @@
+import os
+import shutil
+
+import numpy as np
+
+from conftest import make_series
+from tools.geodata import GeophysicalTimeSeries
+
+
+def day(index: int) -> np.datetime64:
+    return np.datetime64('2024-03-01T00', 's') + index * np.timedelta64(1, 'h')
+
+
+def assert_same(actual: GeophysicalTimeSeries, expected: GeophysicalTimeSeries) -> None:
+    np.testing.assert_array_equal(actual.raw.dates, expected.raw.dates)
+    for name in ('resistance', 'apres', 'chargeability', 'valid', 'rejected'):
+        np.testing.assert_array_equal(getattr(actual.raw, name), getattr(expected.raw, name), err_msg=name)
+    np.testing.assert_array_equal(actual.raw.decay_slice(), expected.raw.decay_slice())
+    np.testing.assert_array_equal(actual.filtered.apres, expected.filtered.apres)
+
+
+def update(data: GeophysicalTimeSeries) -> None:
+    # Two new days, a rejection of a stored day and new filtered values
+    data.raw.extend(make_series([day(4), day(5)], gates=3, seed=1).raw)
+    rejected = data.raw.rejected
+    rejected[2, 1] = True
+    data.raw.rejected = rejected
+    data.filtered.dates = data.raw.dates.copy()
+    for name in ('resistance', 'apres', 'chargeability'):
+        setattr(data.filtered, name, getattr(data.raw, name) * 2)
+
+
+def test_replay_after_crash_before_compaction(tmp_path):
+    filename = str(tmp_path / 'data.pickle')
+    data = make_series([day(index) for index in range(4)], gates=3)
+    data.save(filename, compact=True)
+
+    data = GeophysicalTimeSeries.load(filename)
+    update(data)
+    data.save(filename, compact=False)
+    # The pickle is the one of the first save, the changes are in the journal only
+    assert os.path.getsize(filename + '.journal') > 0
+    assert len(GeophysicalTimeSeries.load(filename).raw.dates) == 6
+    assert_same(GeophysicalTimeSeries.load(filename), data)
+
+    # A torn append (crash while writing the journal) keeps the complete records
+    with open(filename + '.journal', 'ab') as fout:
+        fout.write(b'\x80\x04\x95torn')
+    assert_same(GeophysicalTimeSeries.load(filename), data)
+
+
+def test_journal_of_an_older_generation_is_ignored(tmp_path):
+    filename = str(tmp_path / 'data.pickle')
+    data = make_series([day(index) for index in range(4)], gates=3)
+    data.save(filename, compact=True)
+    data = GeophysicalTimeSeries.load(filename)
+    update(data)
+    data.save(filename, compact=False)
+    shutil.copy(filename + '.journal', str(tmp_path / 'old.journal'))
+
+    # Crash after the compacted pickle was written, before the old journal was removed
+    data.compact(filename)
+    shutil.copy(str(tmp_path / 'old.journal'), filename + '.journal')
+    assert_same(GeophysicalTimeSeries.load(filename), data)
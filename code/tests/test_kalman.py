@@ -0,0 +1,48 @@
+import numpy as np
+
+from filtering import KalmanSmoother, KalmanState
+
+
+def series(days: int = 40, measurements: int = 6):
+    rng = np.random.default_rng(0)
+    dates = np.datetime64('2024-03-01T00', 's') + np.cumsum(rng.integers(1, 30, days)) * np.timedelta64(1, 'h')
+    values = 100 * np.exp(np.cumsum(0.01 * rng.standard_normal([measurements, days]), axis=1))
+    values *= 1 + 0.02 * rng.standard_normal(values.shape)
+    valid = rng.random(values.shape) > 0.1
+    valid[0, :5] = False  # a measurement starting late
+    errors = rng.uniform(0, 0.05, values.shape)
+    return dates, values, valid, errors
+
+
+def test_update_over_new_days_ends_as_a_full_smooth():
+    dates, values, valid, errors = series()
+    smoother = KalmanSmoother()
+    _, smoothed, smoothed_std, state = smoother.smooth(dates, values, valid, errors)
+
+    # An earlier run filtered the first days, this one continues from its state over the new days
+    old = slice(0, 25)
+    new = slice(25, None)
+    initial = smoother.initial_state(np.where(valid, values, np.nan))
+    _, _, _, earlier = smoother.update(initial, dates[old], values[:, old], valid[:, old], errors[:, old])
+    new_dates, filtered, filtered_std, updated = smoother.update(earlier, dates[new], values[:, new], valid[:, new],
+                                                                 errors[:, new])
+
+    np.testing.assert_array_equal(new_dates, dates[new])
+    # The last day of a smooth is the filtered one; both continue to the same state
+    np.testing.assert_allclose(filtered[:, -1], smoothed[:, -1])
+    np.testing.assert_allclose(filtered_std[:, -1], smoothed_std[:, -1])
+    assert updated.date == state.date
+    np.testing.assert_allclose(updated.mean, state.mean)
+    np.testing.assert_allclose(updated.variance, state.variance)
+
+
+def test_state_round_trip(tmp_path):
+    dates, values, valid, errors = series()
+    _, _, _, state = KalmanSmoother().smooth(dates, values, valid, errors)
+    filename = str(tmp_path / 'state.npz')
+    state.save(filename)
+    loaded = KalmanState.load(filename)
+    assert loaded.date == state.date
+    for name in ('mean', 'variance', 'scale'):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(state, name))
+    assert KalmanState.load(str(tmp_path / 'missing.npz')) is None
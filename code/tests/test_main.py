@@ -0,0 +1,17 @@
+import numpy as np
+
+from conftest import make_series
+
+
+def test_integrated_chargeability_keeps_the_storage_dtype(main, monkeypatch):
+    data = make_series(np.datetime64('2024-03-01T00', 's') + np.arange(3) * np.timedelta64(1, 'h'), gates=4,
+                       value_dtype='float32')
+    data.raw.acquisition_settings['IP_WindowSecList'] = '0.02 0.1 0.1 0.2 0.2'
+    saved = []
+    monkeypatch.setattr(main, 'load_data', lambda: data)
+    monkeypatch.setattr(main, 'save_data', saved.append)
+    main.integrate_chargeability()
+
+    assert saved == [data]
+    assert data.raw.chargeability.dtype == np.float32
+    assert np.isfinite(data.raw.chargeability).all()
@@ -0,0 +1,27 @@
+import warnings
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from plotter import write_section_timelapse
+
+
+def test_gif_frames_are_the_colour_indices(tmp_path):
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.arange(0.0, 20.0, 1.0), np.arange(0.5, 6.0, 1.0))
+    x, y = x.ravel(), y.ravel()
+    c = rng.uniform(10, 1000, [len(x), 3])
+    dates = np.datetime64('2024-03-01T00', 's') + np.arange(3) * np.timedelta64(1, 'D')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        write_section_timelapse(x, y, c, dates, str(tmp_path / 'section.npz'), 10, 1000)
+        write_section_timelapse(x, y, c, dates, str(tmp_path / 'section.gif'), 10, 1000)
+
+    stored = np.load(str(tmp_path / 'section.npz'))
+    cube, lut = stored['cube'], stored['lut']
+    with Image.open(str(tmp_path / 'section.gif')) as gif:
+        assert gif.n_frames == 3
+        for index, frame in enumerate(ImageSequence.Iterator(gif)):
+            colours = np.array(frame.convert('RGB'))
+            inside = cube[index] != 255
+            np.testing.assert_array_equal(colours[inside], lut[cube[index][inside], :3])
@@ -0,0 +1,68 @@
+import numpy as np
+
+import writter as w
+from conftest import make_series
+from tools.lib import geometric_factor
+from tools.read_inversion_data import INVERSION_DATA_COLUMNS, read_aarhusinv_tx2, read_res2dinv_dat
+
+
+COLUMNS = {name: column for column, name in enumerate(INVERSION_DATA_COLUMNS)}
+
+
+def series():
+    data = make_series(np.datetime64('2024-03-01T00', 's') + np.arange(3) * np.timedelta64(1, 'D'))
+    rejected = data.raw.rejected
+    rejected[1, 2] = True  # not written
+    data.raw.rejected = rejected
+    return data
+
+
+def assert_measurements(measurements: np.ndarray, data, rows: np.ndarray, day: int) -> None:
+    abmn = data.raw.metadata.abmn[rows]
+    np.testing.assert_array_equal(measurements[:, :4], abmn)
+    np.testing.assert_allclose(measurements[:, COLUMNS['resistance']], data.raw.resistance[rows, day])
+    np.testing.assert_allclose(measurements[:, COLUMNS['chargeability']], data.raw.chargeability[rows, day])
+    # Completed from the resistance (surface array)
+    np.testing.assert_allclose(measurements[:, COLUMNS['apres']],
+                               geometric_factor(*abmn.T) * data.raw.resistance[rows, day])
+
+
+def test_dat_written_by_format_dat(tmp_path):
+    data = series()
+    filename = str(tmp_path / 'day.dat')
+    w.write_dat(data, filename, 1, index_to_write=2)
+    measurements, decay, settings = read_res2dinv_dat(filename)
+
+    assert_measurements(measurements, data, np.array([0, 2, 3, 4]), 2)
+    assert decay.shape == (4, 0)
+    assert settings == {'IP_WindowSecList': '0.02 4'}
+
+
+def test_timelapse_dat_gives_its_first_section(tmp_path):
+    data = series()
+    filename = str(tmp_path / 'timelapse.dat')
+    w.TimelapseWriter(data, 1).write(filename, [0, 1, 2])
+    measurements, _, _ = read_res2dinv_dat(filename)
+    assert_measurements(measurements, data, np.array([0, 2, 3, 4]), 0)
+
+    w.TimelapseWriter(data, 1, include_chargeability=False).write(filename, [0, 1])
+    measurements, _, settings = read_res2dinv_dat(filename)
+    np.testing.assert_allclose(measurements[:, COLUMNS['resistance']], data.raw.resistance[:, 0])
+    assert np.isnan(measurements[:, COLUMNS['chargeability']]).all() and settings == {}
+
+
+def test_tx2_columns_gates_and_missing_values(tmp_path):
+    filename = str(tmp_path / 'day.tx2')
+    with open(filename, 'w') as fout:
+        fout.write('% AarhusInv data\n'
+                   'xA xB xM xN Rho Dev IP1 IP2 IP3 Note\n'
+                   '0 3 1 2 120.5 0.02 30 20 10 a\n'
+                   '1 4 2 3 * 0.05 31 * 11 b\n')
+    measurements, decay, settings = read_aarhusinv_tx2(filename)
+
+    np.testing.assert_array_equal(measurements[:, :4], [[0, 3, 1, 2], [1, 4, 2, 3]])
+    np.testing.assert_allclose(measurements[0, COLUMNS['resistance']], 120.5 / geometric_factor(0, 3, 1, 2))
+    assert np.isnan(measurements[1, [COLUMNS['resistance'], COLUMNS['apres']]]).all()
+    np.testing.assert_allclose(measurements[:, COLUMNS['res_std']], [2, 5])
+    np.testing.assert_array_equal(decay, [[30, 20, 10], [31, np.nan, 11]])
+    assert settings == {}
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+import pytest
+
+import writter as w
+from conftest import make_series
+
+
+@pytest.fixture
+def reader(main):
+    # reader.py reads the settings package of main
+    import reader
+    return reader
+
+
+@pytest.fixture
+def archive(main, tmp_path):
+    # Dat files of three days, the last quadrupoles only appear in later files
+    data = make_series(np.datetime64('2024-03-01T00', 's') + np.arange(3) * np.timedelta64(1, 'h'))
+    rejected = data.raw.rejected
+    rejected[3:, 0] = rejected[4, 1] = True
+    data.raw.rejected = rejected
+    for day in range(3):
+        w.write_dat(data, main.dat_filename(str(tmp_path), data.raw.dates[day]), 1, index_to_write=day)
+    return data, str(tmp_path)
+
+
+def test_batch_structure_has_the_quadrupoles_of_all_files(reader, archive):
+    data, path = archive
+    dat_reader = reader.Res2DInvDat(max_workers=1)
+    files = dat_reader.list_new(path, np.array([], dtype='datetime64[s]'))
+    dat_reader.default_structure(files[0])
+    raw = dat_reader.make_data(files[:1])
+
+    np.testing.assert_array_equal(raw.metadata.abmn, data.raw.metadata.abmn)
+    np.testing.assert_array_equal(raw.valid[:, 0], [True, True, True, False, False])
+    np.testing.assert_allclose(raw.resistance[:3, 0], data.raw.resistance[:3, 0])
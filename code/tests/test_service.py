@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture
+def service(main):
+    # service.py reads the store locations of main
+    import service
+    return service
+
+
+def test_unknown_dpid_is_not_found(service, tmp_path):
+    queries = service.QueryService(lambda: [str(tmp_path / 'data.pickle')])
+    with pytest.raises(service.QueryError) as error:
+        queries.handle('/history', {'dpid': '7'})
+    assert error.value.status == 404
+
+
+def test_store_replaced_on_every_attempt(service, monkeypatch, tmp_path):
+    queries = service.QueryService(lambda: [str(tmp_path / 'data.pickle')])
+    versions = iter(range(100))
+    monkeypatch.setattr(queries, 'version', lambda filenames, store: next(versions))
+
+    def replaced(params):
+        def query(filenames):
+            raise OSError('replaced while read')
+        return 'raw', query
+    monkeypatch.setitem(queries.endpoints, '/dates', replaced)
+    with pytest.raises(service.QueryError) as error:
+        queries.handle('/dates', {})
+    assert error.value.status == 503
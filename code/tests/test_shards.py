@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from tools.geodata import GeophysicalTimeSeries, GeophysicalTimeSeriesRaw, MeasurementTable
+from tools.shards import ShardedTimeSeries
+
+
+MEASUREMENTS, GATES = 6, 4
+
+
+def make_raw(start: str, days: int, seed: int = 0) -> GeophysicalTimeSeriesRaw:
+    # Daily acquisitions from start, every value different
+    rng = np.random.default_rng(seed)
+    dates = np.datetime64(start, 's') + np.arange(days) * np.timedelta64(1, 'D')
+    abmn = np.array([[0, 3 + row, 1, 2] for row in range(MEASUREMENTS)], dtype=float)
+    metadata = MeasurementTable.from_columns(np.arange(1, MEASUREMENTS + 1), 1, abmn, abmn[:, 2:].mean(axis=1),
+                                             np.ones(MEASUREMENTS))
+    values = [rng.random([MEASUREMENTS, days]) for _ in range(5)]
+    decay = rng.random([MEASUREMENTS, days, GATES])
+    raw = GeophysicalTimeSeriesRaw(dates, metadata, *values, decay, validity=rng.random([MEASUREMENTS, days]) > 0.1,
+                                   repeat_error=rng.random([MEASUREMENTS, days]))
+    raw.rejected = np.zeros([MEASUREMENTS, days], dtype=bool)
+    return raw
+
+
+def assert_same_raw(actual: GeophysicalTimeSeriesRaw, expected: GeophysicalTimeSeriesRaw) -> None:
+    np.testing.assert_array_equal(actual.dates, expected.dates)
+    for name in ('voltage', 'current', 'resistance', 'apres', 'chargeability', 'repeat_error', 'valid', 'rejected'):
+        np.testing.assert_array_equal(getattr(actual, name), getattr(expected, name), err_msg=name)
+    np.testing.assert_array_equal(actual.decay_slice(), expected.decay_slice())
+
+
+@pytest.fixture
+def archive():
+    # Three months of days in one time series
+    data = GeophysicalTimeSeries()
+    data.raw = make_raw('2024-01-10', 80)
+    return data
+
+
+def test_split_and_query_round_trip(tmp_path, archive):
+    store = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    store.split(archive)
+    assert store.keys() == ['2024-01', '2024-02', '2024-03']
+    reopened = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    np.testing.assert_array_equal(reopened.dates(), archive.raw.dates)
+    assert_same_raw(reopened.query().raw, archive.raw)
+    # Only the shards overlapping the range
+    february = reopened.query('2024-02-05', '2024-02-20').raw
+    np.testing.assert_array_equal(february.dates, archive.raw.dates[(archive.raw.dates >= np.datetime64('2024-02-01'))
+                                                                    & (archive.raw.dates < np.datetime64('2024-03-01'))])
+
+
+def test_query_keeps_decays_on_disk(tmp_path, archive):
+    store = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    store.split(archive)
+    raw = store.query().raw
+    assert not raw.decay_loaded()
+    # The decays of the later shards are mapped from their files, not read
+    blocks = raw._decay_blocks()
+    assert len(blocks) == 3
+    assert all(isinstance(block, np.memmap) or isinstance(block.base, np.memmap) for block in blocks)
+    days = [0, 25, 30, 79, 55]
+    np.testing.assert_array_equal(raw.decay_slice(measurements=[1, 4], days=days),
+                                  archive.raw.decay[[1, 4]][:, days])
+
+
+def test_append_to_existing_and_new_shards(tmp_path, archive):
+    store = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    store.split(archive)
+    new = make_raw('2024-03-30', 10, seed=1)  # end of March and April
+    assert store.append(new) == ['2024-03', '2024-04']
+    assert store.stale('qc') == ['2024-03', '2024-04']
+    expected = archive.raw.take(slice(None))
+    expected.extend(new)
+    assert_same_raw(ShardedTimeSeries(str(tmp_path / 'shards'), 'M').query().raw, expected)
+
+
+def test_update_writes_changes_to_their_shards(tmp_path, archive):
+    store = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    store.split(archive)
+    data = store.open(['2024-02', '2024-03'])
+    rejected = data.raw.rejected.copy()
+    rejected[:, -5:] = True  # last days of March
+    data.raw.rejected = rejected
+    store.update(data)
+    store.mark_done('qc', '2024-03')
+
+    reopened = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    assert reopened.stale('qc') == []
+    raw = reopened.query().raw
+    expected = archive.raw.rejected.copy()
+    expected[:, -5:] = True
+    np.testing.assert_array_equal(raw.rejected, expected)
+    # Untouched values and decays
+    np.testing.assert_array_equal(raw.resistance, archive.raw.resistance)
+    np.testing.assert_array_equal(raw.decay_slice(), archive.raw.decay)
+
+
+def test_update_outside_opened_shards_is_refused(tmp_path, archive):
+    store = ShardedTimeSeries(str(tmp_path / 'shards'), 'M')
+    store.split(archive)
+    data = store.open(['2024-02'])
+    data.raw.dates = data.raw.dates + np.timedelta64(40, 'D')
+    with pytest.raises(ValueError, match='outside the opened shards'):
+        store.update(data)
@@ -0,0 +1,25 @@
+import numpy as np
+
+import writter as w
+from conftest import make_series
+
+
+def test_timelapse_sections_are_chronological(main, tmp_path):
+    dates = np.datetime64('2024-03-01T00', 's') + np.array([0, 1, 2, 4, 7, 8, 12]) * np.timedelta64(1, 'D')
+    data = make_series(dates[::-1])  # stored in any order
+    schedule = main.timelapse_schedule(data.raw.dates, sections=4, baseline=0, start=1)
+    order = np.argsort(data.raw.dates)
+    assert schedule == [[order[0], *order[1:4]], [order[0], *order[4:7]]]
+
+    filename = str(tmp_path / 'timelapse.dat')
+    w.TimelapseWriter(data, 1).write(filename, schedule[1])
+    with open(filename) as fin:
+        lines = [line.strip() for line in fin.read().splitlines()]
+    start = lines.index('Number of time sections')
+    assert lines[start + 1] == '4'
+    # Baseline (day 0) first, then days 7, 8 and 12
+    assert lines[start + 4:start + 10] == ['Second time section interval', '7', 'Third time section interval', '1',
+                                           'Fourth time section interval', '4']
+    first_row = lines[start + 10].split()
+    np.testing.assert_array_equal(np.array(first_row[9:13], dtype=float),
+                                  data.raw.resistance[0, schedule[1]])
@@ -0,0 +1,158 @@
+"""
+Online anomaly detection on the measurements and inverted cells.
+
+A stream (e.g. the apparent resistivity of all measurements, or the resistivity of the cells of a
+task) keeps running statistics per row, updated with every new acquisition in O(rows): an
+exponentially weighted mean (EWMA) following the level of the values, the mean and variance
+(Welford) of the innovations (value minus the EWMA before it), and two-sided CUSUM sums of the
+standardized innovations. A single value far from the level is a spike; a run of deviations that
+drives a CUSUM sum above its limit is a persistent shift. Slow drifts, which the EWMA follows, raise
+neither. Spikes are not learned into the statistics but enter the CUSUM sums clipped to the spike
+threshold, so a step beyond it is reported as a shift. After a shift, or a run of consecutive
+spikes, the level restarts from the new value.
+
+Alerts are appended to alerts.jsonl and the state of each stream is a small npz file in the
+monitoring directory, so the detection resumes where it stopped after a restart. Days not after
+the last processed day of a stream are ignored.
+"""
+import json
+import os
+
+import numpy as np
+
+
+# Per-row state of a stream
+STATE_FIELDS = ('count', 'mean', 'm2', 'ewma', 'cusum_up', 'cusum_down', 'outliers')
+
+
+class AnomalyDetector:
+
+    def __init__(self, path: str, threshold: float = 5.0, alpha: float = 0.05, drift: float = 0.5,
+                 limit: float = 10.0, warmup: int = 20, floor: float = 1e-3, relevel: int = 3):
+        self.path = path
+        self.threshold = threshold  # z-score of a spike
+        self.alpha = alpha  # weight of a new value in the EWMA
+        self.drift = drift  # CUSUM allowance, in standard deviations of the innovations
+        self.limit = limit  # CUSUM sum of a shift
+        self.warmup = warmup  # values learned before a row is tested
+        self.floor = floor  # smallest standard deviation relative to the level (constant series)
+        self.relevel = relevel  # consecutive spikes after which the level restarts from the value
+
+    def update(self, stream: str, dates: np.ndarray, values: np.ndarray, labels: np.ndarray = None,
+               valid: np.ndarray = None) -> list[dict]:
+        """
+        Test and learn new days of a stream.
+
+        :param stream: name of the stream (e.g. 'raw_apres', 'inverted_1_resistivity')
+        :param dates: dates of the new days
+        :param values: (rows, days) values, NaN where not acquired
+        :param labels: label of each row (e.g. the DPIDs), rows are numbered if None
+        :param valid: (rows, days) mask of the values to use
+        :return: alerts (date, stream, label, kind, value, score), also appended to alerts.jsonl
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(len(values), -1)
+        if valid is not None:
+            values = np.where(valid, values, np.nan)
+        labels = np.arange(len(values)) if labels is None else np.asarray(labels)
+        state = self.load(stream, labels)
+        alerts = []
+        for day in np.argsort(dates, kind='stable'):
+            date = np.datetime64(dates[day], 's')
+            if not np.isnat(state['date']) and date <= state['date']:
+                continue
+            alerts += self._step(state, values[:, day], stream, date, labels)
+            state['date'] = date
+        self.save(stream, state)
+        if len(alerts) > 0:
+            with open(os.path.join(self.path, 'alerts.jsonl'), 'a') as fout:
+                fout.write(''.join(json.dumps(alert) + '\n' for alert in alerts))
+        return alerts
+
+    def load(self, stream: str, labels: np.ndarray) -> dict:
+        """
+        State of a stream for some rows.
+
+        Rows are matched by label, new rows start without history.
+
+        :param stream: name of the stream
+        :param labels: label of each row
+        :return: STATE_FIELDS arrays, labels and the last processed date
+        """
+        rows = len(labels)
+        state = {name: np.zeros(rows) for name in STATE_FIELDS}
+        state['count'] = np.zeros(rows, dtype=np.int64)
+        state['outliers'] = np.zeros(rows, dtype=np.int64)
+        state['ewma'] = np.full(rows, np.nan)
+        state.update(labels=labels, date=np.datetime64('NaT', 's'))
+        filename = self._filename(stream)
+        if not os.path.isfile(filename):
+            return state
+        with np.load(filename) as stored:
+            position = {label: row for row, label in enumerate(stored['labels'].tolist())}
+            found = np.array([position.get(label, -1) for label in labels.tolist()], dtype=np.int64)
+            known = found >= 0
+            for name in STATE_FIELDS:
+                if name in stored:  # states saved before a field existed start it from zero
+                    state[name][known] = stored[name][found[known]]
+            state['date'] = stored['date'][()]
+        return state
+
+    def save(self, stream: str, state: dict) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._filename(stream)[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp, **state)
+        os.replace(tmp, self._filename(stream))
+
+    def _step(self, state: dict, values: np.ndarray, stream: str, date: np.datetime64,
+              labels: np.ndarray) -> list[dict]:
+        # Test one day against the state, then learn it
+        observed = np.isfinite(values)
+        started = observed & ~np.isnan(state['ewma'])
+        innovation = values - state['ewma']
+        tested = started & (state['count'] >= self.warmup)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.maximum(np.sqrt(state['m2'] / (state['count'] - 1)), self.floor * np.abs(state['ewma']))
+            z = (innovation - state['mean']) / std
+        spike = tested & (np.abs(z) > self.threshold)
+
+        # CUSUM of the standardized innovations, those of spikes clipped to the threshold
+        clipped = np.clip(z, -self.threshold, self.threshold)
+        state['cusum_up'][tested] = np.maximum(0, state['cusum_up'][tested] + clipped[tested] - self.drift)
+        state['cusum_down'][tested] = np.maximum(0, state['cusum_down'][tested] - clipped[tested] - self.drift)
+        shift_up = tested & (state['cusum_up'] > self.limit)
+        shift_down = tested & (state['cusum_down'] > self.limit)
+        scores = {'spike': z, 'shift_up': state['cusum_up'].copy(), 'shift_down': state['cusum_down'].copy()}
+
+        # A shift or a run of spikes is a new level: restart the level and the sums from the value
+        state['outliers'][spike] += 1
+        state['outliers'][observed & ~spike] = 0
+        relevel = shift_up | shift_down | (state['outliers'] >= self.relevel)
+        state['ewma'][relevel] = values[relevel]
+        state['cusum_up'][relevel] = 0
+        state['cusum_down'][relevel] = 0
+        state['outliers'][relevel] = 0
+
+        # Welford statistics of the innovations, the level follows the values (spikes and new levels excluded)
+        learned = started & ~spike & ~relevel
+        x = innovation[learned]
+        count = state['count'][learned] + 1
+        delta = x - state['mean'][learned]
+        mean = state['mean'][learned] + delta / count
+        state['m2'][learned] += delta * (x - mean)
+        state['mean'][learned] = mean
+        state['count'][learned] = count
+        # Running mean of the first values, then exponentially weighted
+        state['ewma'][learned] += np.maximum(self.alpha, 1 / (count + 1)) * innovation[learned]
+        # The first value of a row sets its level
+        first = observed & np.isnan(state['ewma'])
+        state['ewma'][first] = values[first]
+
+        alerts = []
+        for kind, flagged in (('spike', spike), ('shift_up', shift_up), ('shift_down', shift_down)):
+            for row in np.flatnonzero(flagged):
+                alerts.append({'date': str(date), 'stream': stream, 'label': labels[row].item(), 'kind': kind,
+                               'value': float(values[row]), 'score': float(scores[kind][row])})
+        return alerts
+
+    def _filename(self, stream: str) -> str:
+        return os.path.join(self.path, stream + '.npz')
@@ -6,6 +6,10 @@ from collections import namedtuple, defaultdict
 from tools.lib import my_timer
 from tools.lib import db_connect
 
+def placeholders(ids):
+    # '?, ?, ?' for a parameterised 'IN (...)' clause
+    return ', '.join('?' * len(ids))
+
 def read_dpid_mapper(database, ids):
     with db_connect(database) as connection:
         cursor = connection.cursor()
@@ -19,7 +23,7 @@ def read_dpid_mapper(database, ids):
         #print(spacing)
         
         cursor.execute("SELECT ID, APosX, BPosX, MPosX, NPosX \
-                        FROM DP_ABMN WHERE TaskID in {}".format(str(ids)))
+                        FROM DP_ABMN WHERE TaskID in ({})".format(placeholders(ids)), tuple(ids))
         result = cursor.fetchall()
         dpid_abmn_lookup = dict()        
         for row in result:
@@ -34,7 +38,7 @@ def read_geometry_mapper(database, ids):
         
         cursor.execute("SELECT DPID FROM DPV \
                        WHERE DatatypeID=5 AND Channel>0 \
-                       AND TaskID in {}".format(str(ids)))
+                       AND TaskID in ({})".format(placeholders(ids)), tuple(ids))
         result = cursor.fetchall()
         
         geometry_lookuptable = dict()
@@ -50,7 +54,7 @@ def read_focus_point_mapper(database, ids):
         cursor = connection.cursor()
         
         cursor.execute("SELECT ID, FocusX, FocusZ \
-                        FROM DP_ABMN WHERE TaskID in {}".format(str(ids)))
+                        FROM DP_ABMN WHERE TaskID in ({})".format(placeholders(ids)), tuple(ids))
         result = cursor.fetchall()
         focus_point_lookup = dict()        
         for row in result:
@@ -67,8 +71,8 @@ def read_task_mapper(database, ids):
         cursor = connection.cursor()
         
         cursor.execute("SELECT TaskID, ID \
-                        FROM DP_ABMN WHERE TaskID in {} \
-                        ORDER BY ID".format(str(ids)))
+                        FROM DP_ABMN WHERE TaskID in ({}) \
+                        ORDER BY ID".format(placeholders(ids)), tuple(ids))
         result = cursor.fetchall()
         
         for row in result:
@@ -138,7 +142,8 @@ def meas_info(cursor, tinfo, ids):
         sum(CASE WHEN DatatypeID = 7 THEN DPV.Datavalue ELSE 0 END) AS voltage, \
         injections.DataValue as current, \
         sum(CASE WHEN DatatypeID = 5 THEN DPV.Datavalue ELSE 0 END) AS res, \
-        sum(CASE WHEN DatatypeID = 2 THEN DPV.Datavalue ELSE 0 END) AS apres \
+        sum(CASE WHEN DatatypeID = 2 THEN DPV.Datavalue ELSE 0 END) AS apres, \
+        sum(CASE WHEN DatatypeID = 5 THEN DataSDev ELSE 0 END) AS res_sdev \
         {} \
         FROM DPV \
         INNER JOIN Datatype \
@@ -151,13 +156,14 @@ def meas_info(cursor, tinfo, ids):
                     FROM DPV \
                     WHERE DPV.DatatypeID=6 AND DPV.Channel=14) injections\
         ON DPV.MeasureID = injections.MeasureID \
-        WHERE Channel NOT IN (0, 13, 14) AND DPV.TaskID in {}\
+        WHERE Channel NOT IN (0, 13, 14) AND DPV.TaskID in ({})\
         GROUP BY DPV.MeasureID, Channel \
         ORDER BY DPID --MeasureID, Channel \n\
-        --LIMIT 10;".format(ipquery, str(ids)))
+        --LIMIT 10;".format(ipquery, placeholders(ids)), tuple(ids))
     # Save data in pandas DataFrame object
+    # (res_sdev, the stacking error of the resistance, before the IP1..SDev and SD1..SDn blocks)
     str_label = "Time TaskID MeasureID DPID APosX APosY APosZ BPosX BPosY BPosZ MPosX MPosY MPosZ NPosX NPosY NPosZ FocusX FocusY FocusZ Channel \
-                 volt current res apres"
+                 volt current res apres res_sdev"
     for i in range(1, n+1):
         str_label += " IP{}".format(i)
     str_label += " SDev"
@@ -172,18 +178,73 @@ def meas_info(cursor, tinfo, ids):
     return data
 
 
+def gate_weights(gates_width, ngates, windows=((1, 0),)):
+    """ Integration weights of one or more gate windows
+
+    Args:
+        gates_width: delay time followed by the IP window widths (as in IP_WindowSecList)
+        ngates (int): number of IP gates in the data
+        windows: (sgate, egate) pairs, 1-indexed and inclusive, egate=0 means the last gate
+
+    Returns:
+        np.ndarray: weights (ngates, nwindows); data @ weights gives the chargeability in mV/V
+    """
+    gates_width = np.asarray(gates_width, dtype=float)
+    weights = np.zeros([ngates, len(windows)])
+    for index, (sgate, egate) in enumerate(windows):
+        if egate == 0:
+            egate = ngates
+        if sgate > egate:
+            raise ValueError('Starting gate needs to be smaller than end gate')
+        sgate -= 1  # 'Zero-Index' data
+        widths = gates_width[1+sgate:1+egate]
+        weights[sgate:egate, index] = widths / widths.sum() * 1000
+    return weights
+
+
 def integral(data, gates_width, sgate=1, egate=0):
     sgatedata = data.columns.get_loc('IP1')
     egatedata = data.columns.get_loc('SDev')
-    if egate == 0:
-        egate = egatedata - sgatedata
-    if sgate > egate:
-        raise ValueError('Starting gate needs to be smaller than end gate')
-    sgate -= 1  # 'Zero-Index' data
-    ngates = egate - sgate
-    widths = gates_width[1+sgate:1+egate]
-    charg = (data.iloc[:, sgatedata+sgate:sgatedata+sgate+ngates] * widths).apply(sum, axis=1) / sum(widths) * 1000
-    return charg
+    weights = gate_weights(gates_width, egatedata - sgatedata, windows=((sgate, egate),))
+    charg = data.iloc[:, sgatedata:egatedata].to_numpy(dtype=float) @ weights[:, 0]
+    return pd.Series(charg, index=data.index)
+
+
+def integral_windows(data, gates_width, windows):
+    """ Integrated chargeability of several gate windows at once
+
+    Args:
+        data (pd.DataFrame): output of meas_info
+        gates_width: delay time followed by the IP window widths
+        windows: (sgate, egate) pairs, see gate_weights
+
+    Returns:
+        pd.DataFrame: one column per window
+    """
+    sgatedata = data.columns.get_loc('IP1')
+    egatedata = data.columns.get_loc('SDev')
+    weights = gate_weights(gates_width, egatedata - sgatedata, windows=windows)
+    charg = data.iloc[:, sgatedata:egatedata].to_numpy(dtype=float) @ weights
+    return pd.DataFrame(charg, index=data.index, columns=[f'charg_{sgate}_{egate}' for sgate, egate in windows])
+
+
+def integral_decay(decay, gates_width, sgate=1, egate=0, windows=None):
+    """ Integrated chargeability over the decay cube of GeophysicalTimeSeriesRaw
+
+    Args:
+        decay (np.ndarray): IP decays (measurements, days, gates)
+        gates_width: delay time followed by the IP window widths
+        sgate (int): first gate (1-indexed)
+        egate (int): last gate (inclusive), 0 means the last gate
+        windows: optional (sgate, egate) pairs to integrate several windows at once
+
+    Returns:
+        np.ndarray: chargeability (measurements, days), or (measurements, days, windows) if windows is given
+    """
+    ngates = decay.shape[-1]
+    if windows is None:
+        return decay @ gate_weights(gates_width, ngates, windows=((sgate, egate),))[:, 0]
+    return decay @ gate_weights(gates_width, ngates, windows=windows)
 
 
 def find_gates(data, sgate=1, egate=0):
@@ -202,7 +263,8 @@ def find_gates(data, sgate=1, egate=0):
 
 def find_gates_error(data, sgate=1, egate=0):
     sgatedata = data.columns.get_loc('SD1')
-    egatedata = len(data.columns)
+    # End of the SD1..SDn block (columns such as charg may follow it)
+    egatedata = sgatedata + sum(1 for column in data.columns if column[:2] == 'SD' and column[2:].isdigit())
     if egate == 0:
         egate = egatedata - sgatedata
     if sgate > egate:
@@ -0,0 +1,186 @@
+"""
+Parametric fit of the IP decays of every measurement and day.
+
+Each decay is fitted with a stretched exponential m(t) = m0 * exp(-(t / tau) ** c), the usual
+time-domain approximation of a Cole-Cole response (c is the frequency exponent, tau the time
+constant, m0 the chargeability at t = 0). All decays of a block are fitted together: the
+Levenberg-Marquardt iterations are array operations over (decays, gates), with a damping factor per
+decay. The decay cube is read in blocks of days from its file, and the blocks can be fitted by
+several processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from tools.geodata import GeophysicalTimeSeriesRaw
+
+
+# Fitted parameters and quality measures, (measurements, days) arrays each
+FIT_FIELDS = ('m0', 'tau', 'c', 'misfit', 'valid')
+# Bounds of the frequency exponent
+EXPONENT_RANGE = (0.05, 1.0)
+
+
+def gate_times(gates_width) -> np.ndarray:
+    """
+    Centre time of each IP gate.
+
+    :param gates_width: delay time followed by the IP window widths [s] (as in IP_WindowSecList)
+    :return: (gates,) times after the current switch-off [s]
+    """
+    gates_width = np.asarray(gates_width, dtype=np.float64)
+    widths = gates_width[1:]
+    return gates_width[0] + np.cumsum(widths) - widths / 2
+
+
+def stretched_exponential(times: np.ndarray, m0, tau, c) -> np.ndarray:
+    """
+    Decay model.
+
+    :param times: gate times
+    :param m0: chargeability at t = 0, broadcast against times
+    :param tau: time constant
+    :param c: exponent
+    :return: modelled chargeability at each time
+    """
+    return m0 * np.exp(-(times / tau) ** c)
+
+
+def fit_block(decays: np.ndarray, times: np.ndarray, iterations: int = 30, min_gates: int = 4,
+              max_misfit: float = 0.1) -> dict[str, np.ndarray]:
+    """
+    Fit a batch of decays.
+
+    :param decays: (..., gates) chargeability of each gate, NaN gates are ignored
+    :param times: (gates,) gate times
+    :param iterations: maximum Levenberg-Marquardt iterations
+    :param min_gates: minimum number of finite gates of a decay
+    :param max_misfit: largest misfit (residual norm relative to the data norm) of a valid fit
+    :return: FIT_FIELDS arrays of shape decays.shape[:-1]
+    """
+    shape = decays.shape[:-1]
+    data = np.asarray(decays, dtype=np.float64).reshape(-1, decays.shape[-1])
+    mask = np.isfinite(data)
+    data = np.where(mask, data, 0.0)
+    log_times = np.log(times)
+
+    params = _initial_guess(data, mask, times)
+    active = np.isfinite(params).all(axis=1) & (mask.sum(axis=1) >= min_gates)
+    params[~active] = np.nan
+    damping = np.full(len(data), 1e-2)
+    cost = np.full(len(data), np.inf)
+    cost[active] = _cost(params[active], data[active], mask[active], log_times)
+    for _ in range(iterations):
+        rows = np.flatnonzero(active)
+        if len(rows) == 0:
+            break
+        p, d, w = params[rows], data[rows], mask[rows]
+        model, jacobian = _model_and_jacobian(p, log_times)
+        residual = np.where(w, d - model, 0.0)
+        jacobian = jacobian * w[..., None]
+        normal = np.einsum('ngi,ngj->nij', jacobian, jacobian)
+        gradient = np.einsum('ngi,ng->ni', jacobian, residual)
+        diagonal = np.maximum(np.einsum('nii->ni', normal), 1e-12)
+        step = np.linalg.solve(normal + np.einsum('ni,ij->nij', damping[rows, None] * diagonal, np.eye(3)),
+                               gradient[..., None])[..., 0]
+        trial = p + step
+        trial[:, 2] = np.clip(trial[:, 2], *EXPONENT_RANGE)
+        trial_cost = _cost(trial, d, w, log_times)
+        better = trial_cost < cost[rows]
+        # Stop once a decay no longer improves noticeably (or cannot improve at all)
+        done = (better & (cost[rows] - trial_cost <= 1e-8 * cost[rows])) | (damping[rows] > 1e8)
+        params[rows[better]] = trial[better]
+        cost[rows[better]] = trial_cost[better]
+        damping[rows] = np.where(better, damping[rows] / 10, damping[rows] * 10)
+        active[rows[done]] = False
+
+    energy = np.einsum('ng,ng->n', data, data)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        misfit = np.sqrt(cost / energy)
+        m0, tau, c = np.exp(params[:, 0]), np.exp(params[:, 1]), params[:, 2]
+    valid = (np.isfinite(params).all(axis=1) & (misfit <= max_misfit)
+             & (tau >= times.min() / 10) & (tau <= times.max() * 100))
+    fields = {'m0': m0, 'tau': tau, 'c': c, 'misfit': misfit, 'valid': valid}
+    return {name: values.reshape(shape) for name, values in fields.items()}
+
+
+def fit_decays(raw: GeophysicalTimeSeriesRaw, times: np.ndarray = None, days=slice(None), chunk_days: int = 32,
+               max_workers: int = 1, **options) -> dict[str, np.ndarray]:
+    """
+    Fit the decays of all measurements on some days.
+
+    The cube is read chunk_days days at a time (contiguous in the decay file) and at most two
+    chunks per worker are in memory at once.
+
+    :param raw: raw data with its decay cube
+    :param times: gate times, from the IP window list of raw if None
+    :param days: day indices (slice or array)
+    :param chunk_days: days fitted together
+    :param max_workers: processes fitting chunks in parallel
+    :param options: see fit_block
+    :return: FIT_FIELDS arrays (measurements, days)
+    """
+    if times is None:
+        times = gate_times(raw.ip_window_list())
+    days = np.arange(len(raw.dates))[days]
+    measurements = len(raw.metadata)
+    chunks = [days[start:start + chunk_days] for start in range(0, len(days), chunk_days)]
+    result = {name: np.full([measurements, len(days)], np.nan) for name in FIT_FIELDS}
+    result['valid'] = np.zeros([measurements, len(days)], dtype=bool)
+
+    def store(position, fitted):
+        for name, values in fitted.items():
+            result[name][:, position:position + values.shape[1]] = values
+
+    if max_workers <= 1:
+        for position, chunk in zip(range(0, len(days), chunk_days), chunks):
+            store(position, fit_block(raw.decay_slice(days=chunk), times, **options))
+        return result
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = []
+        for position, chunk in zip(range(0, len(days), chunk_days), chunks):
+            if len(pending) >= 2 * max_workers:
+                done_position, future = pending.pop(0)
+                store(done_position, future.result())
+            pending.append((position, executor.submit(fit_block, raw.decay_slice(days=chunk), times, **options)))
+        for position, future in pending:
+            store(position, future.result())
+    return result
+
+
+def _initial_guess(data: np.ndarray, mask: np.ndarray, times: np.ndarray) -> np.ndarray:
+    # Exponential (c = 1) through the positive gates: least squares line of log(m) against t
+    weights = mask & (data > 0)
+    log_data = np.log(np.where(weights, data, 1.0))
+    count = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_t = (weights * times).sum(axis=1) / count
+        mean_log = (weights * log_data).sum(axis=1) / count
+        dt = np.where(weights, times - mean_t[:, None], 0.0)
+        slope = (dt * (log_data - mean_log[:, None])).sum(axis=1) / (dt ** 2).sum(axis=1)
+        log_m0 = mean_log - slope * mean_t
+    # Non-decaying curves start with a time constant of the last gate
+    tau = np.where(slope < 0, -1 / np.minimum(slope, -1e-12), times.max())
+    params = np.stack([log_m0, np.log(np.clip(tau, times.min() / 10, times.max() * 100)), np.ones(len(data))], axis=1)
+    params[count < 2] = np.nan
+    return params
+
+
+def _model_and_jacobian(params: np.ndarray, log_times: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Model of the parameters (log m0, log tau, c) and its derivatives
+    log_m0, log_tau, c = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    scaled = log_times - log_tau
+    with np.errstate(over='ignore', invalid='ignore'):
+        # Diverging trial steps give inf/NaN costs and are rejected
+        u = np.exp(c * scaled)  # (t / tau) ** c
+        model = np.exp(log_m0 - u)
+        jacobian = np.stack([model, model * u * c, -model * u * scaled], axis=-1)
+    return model, jacobian
+
+
+def _cost(params: np.ndarray, data: np.ndarray, mask: np.ndarray, log_times: np.ndarray) -> np.ndarray:
+    model, _ = _model_and_jacobian(params, log_times)
+    with np.errstate(over='ignore', invalid='ignore'):
+        cost = np.where(mask, data - model, 0.0)
+        cost = np.einsum('ng,ng->n', cost, cost)
+    return np.where(np.isfinite(cost), cost, np.inf)
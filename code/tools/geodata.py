@@ -1,25 +1,329 @@
 from __future__ import annotations
 import numpy as np
+import pandas as pd
 
 import os
 import pickle
+import shutil
 
 from dataclasses import dataclass, field
 from collections import defaultdict
+from collections.abc import Mapping
+
+from tools.lib import geometric_factor
+from tools.history import HistoryStore, update_aggregates
+
+
+# Measured quantities of GeophysicalTimeSeriesRaw stored in the configurable value dtype
+VALUE_FIELDS = ('voltage', 'current', 'resistance', 'apres', 'chargeability', 'decay', 'repeat_error')
+# Arrays of GeophysicalTimeSeriesFiltered, the uncertainties may be None
+FILTERED_FIELDS = ('resistance', 'apres', 'chargeability', 'resistance_std', 'apres_std', 'chargeability_std')
+
+
+# The pickle of GeophysicalTimeSeries.save is rewritten (compacted) once its journal grows
+# beyond this fraction of the pickle size
+JOURNAL_COMPACTION_RATIO = 0.5
+
+
+# Columns of MeasurementTable, one row per measurement index
+METADATA_DTYPE = np.dtype([('dpid', np.int64), ('task_id', np.int64),
+                           ('a', np.float64), ('b', np.float64), ('m', np.float64), ('n', np.float64),
+                           ('k', np.float64), ('focus_x', np.float64), ('focus_z', np.float64)])
+
+
+@dataclass(eq=False)
+class MeasurementTable:
+    """ Measurement metadata in measurement-index order
+
+    Rows are METADATA_DTYPE records. DPIDs are looked up with searchsorted on a sorted copy,
+    and the measurements of a task are a slice of an index ordered by (task, DPID).
+    """
+
+    rows: np.ndarray
+    sorted_dpids: np.ndarray = field(init=False, repr=False)
+    dpid_order: np.ndarray = field(init=False, repr=False)
+    task_order: np.ndarray = field(init=False, repr=False)
+    task_slices: dict[int, slice] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.rows = np.asarray(self.rows, dtype=METADATA_DTYPE)
+        self.dpid_order = np.argsort(self.rows['dpid'], kind='stable')
+        self.sorted_dpids = self.rows['dpid'][self.dpid_order]
+        self.task_order = np.lexsort((self.rows['dpid'], self.rows['task_id']))
+        tasks, starts, sizes = np.unique(self.rows['task_id'][self.task_order], return_index=True, return_counts=True)
+        self.task_slices = {int(task): slice(int(start), int(start + size)) for task, start, size in zip(tasks, starts, sizes)}
+
+    @classmethod
+    def from_columns(cls, dpid, task_id, abmn, focus_x, focus_z, k=None) -> MeasurementTable:
+        """ Table from columns in measurement-index order
+
+        Args:
+            dpid: DPIDs
+            task_id: task of each measurement
+            abmn: (measurements, 4) electrode x-positions
+            focus_x: focus point x
+            focus_z: focus point depth
+            k: geometric factors, computed from abmn if None
+
+        Returns:
+            MeasurementTable: the table
+        """
+        abmn = np.asarray(abmn, dtype=np.float64).reshape(-1, 4)
+        rows = np.empty(len(abmn), dtype=METADATA_DTYPE)
+        rows['dpid'] = dpid
+        rows['task_id'] = task_id
+        for column, name in enumerate('abmn'):
+            rows[name] = abmn[:, column]
+        if k is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                k = geometric_factor(*abmn.T)
+        rows['k'] = k
+        rows['focus_x'] = focus_x
+        rows['focus_z'] = focus_z
+        return cls(rows)
+
+    @classmethod
+    def from_lookups(cls, geometry_lookuptable_reverse: dict, task_dpid_lookup_reverse: dict,
+                     dpid_abmn_lookup: dict, dpid_geometric_factor_lookup: dict,
+                     focus_x: np.ndarray, focus_z: np.ndarray) -> MeasurementTable:
+        # Table from the dict lookups of objects pickled before the table existed
+        dpids = [geometry_lookuptable_reverse[index] for index in range(len(geometry_lookuptable_reverse))]
+        nan = [np.nan] * 4
+        return cls.from_columns(dpids, [task_dpid_lookup_reverse.get(dpid, -1) for dpid in dpids],
+                                [dpid_abmn_lookup.get(dpid, nan) for dpid in dpids], focus_x, focus_z,
+                                k=[dpid_geometric_factor_lookup.get(dpid, np.nan) for dpid in dpids])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def dpid(self) -> np.ndarray:
+        return self.rows['dpid']
+
+    @property
+    def task_id(self) -> np.ndarray:
+        return self.rows['task_id']
+
+    @property
+    def abmn(self) -> np.ndarray:
+        # (measurements, 4) electrode x-positions
+        return np.stack([self.rows[name] for name in 'abmn'], axis=1)
+
+    @property
+    def k(self) -> np.ndarray:
+        return self.rows['k']
+
+    @property
+    def focus_x(self) -> np.ndarray:
+        return self.rows['focus_x']
+
+    @property
+    def focus_z(self) -> np.ndarray:
+        return self.rows['focus_z']
+
+    def index_of(self, dpids) -> np.ndarray:
+        """ Measurement indices of DPIDs, -1 for DPIDs not in the table """
+        dpids = np.asarray(dpids, dtype=np.int64)
+        if len(self.sorted_dpids) == 0:
+            return np.full(dpids.shape, -1, dtype=np.int64)
+        position = np.clip(np.searchsorted(self.sorted_dpids, dpids), 0, len(self.sorted_dpids) - 1)
+        return np.where(self.sorted_dpids[position] == dpids, self.dpid_order[position], -1)
+
+    def task_indices(self, task_id: int) -> np.ndarray:
+        """ Measurement indices of a task, ordered by DPID """
+        return self.task_order[self.task_slices.get(task_id, slice(0, 0))]
+
+
+class _TableView(Mapping):
+    # Read-only dict view over MeasurementTable, for code written against the lookup dicts
+
+    def __init__(self, table: MeasurementTable):
+        self.table = table
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(self.__class__.__name__, dict(self))
+
+
+class _DpidIndexView(_TableView):
+    # DPID -> INDEX
+
+    def __getitem__(self, dpid):
+        index = int(self.table.index_of(dpid))
+        if index < 0:
+            raise KeyError(dpid)
+        return index
+
+    def __iter__(self):
+        return iter(self.table.dpid.tolist())
+
+    def __len__(self):
+        return len(self.table)
+
+
+class _IndexView(_TableView):
+    # INDEX -> column value
+
+    def __init__(self, table: MeasurementTable, column: str):
+        super().__init__(table)
+        self.column = column
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.table):
+            raise KeyError(index)
+        return self.table.rows[self.column][index].item()
+
+    def __iter__(self):
+        return iter(range(len(self.table)))
+
+    def __len__(self):
+        return len(self.table)
+
+
+class _DpidColumnView(_DpidIndexView):
+    # DPID -> column value(s), a list for several columns
+
+    def __init__(self, table: MeasurementTable, columns):
+        super().__init__(table)
+        self.columns = columns
+
+    def __getitem__(self, dpid):
+        row = self.table.rows[super().__getitem__(dpid)]
+        if isinstance(self.columns, str):
+            return row[self.columns].item()
+        return [row[column].item() for column in self.columns]
+
+
+class _TaskDpidView(_TableView):
+    # TASKID -> List[DPID] (empty for unknown tasks, as the defaultdict it replaces)
+
+    def __getitem__(self, task_id):
+        return self.table.dpid[self.table.task_indices(task_id)].tolist()
+
+    def __contains__(self, task_id):
+        return task_id in self.table.task_slices
+
+    def __iter__(self):
+        return iter(self.table.task_slices)
+
+    def __len__(self):
+        return len(self.table.task_slices)
+
+
+def _first_change(old, new, axis: int):
+    # Index along axis from which new differs from old: None if equal, 0 if not comparable
+    if axis is None or not isinstance(old, np.ndarray) or not isinstance(new, np.ndarray) or old.ndim != new.ndim \
+            or old.ndim <= axis or np.delete(old.shape, axis).tolist() != np.delete(new.shape, axis).tolist() \
+            or not (old.dtype == new.dtype or old.dtype.kind == new.dtype.kind == 'U'):
+        return 0
+    n = min(old.shape[axis], new.shape[axis])
+    before = np.moveaxis(old, axis, 0)[:n].reshape(n, -1)
+    after = np.moveaxis(new, axis, 0)[:n].reshape(n, -1)
+    same = before == after
+    if before.dtype.kind in 'fc':
+        same |= np.isnan(before) & np.isnan(after)
+    changed = np.flatnonzero(~same.all(axis=1))
+    if len(changed) > 0:
+        return int(changed[0])
+    return None if old.shape[axis] == new.shape[axis] else n
+
+
+def _same(old, new) -> bool:
+    # Equal attribute values (a whole-value change is not journaled if equal)
+    if isinstance(old, MeasurementTable) and isinstance(new, MeasurementTable):
+        return old is new or np.array_equal(old.rows, new.rows)
+    if isinstance(old, np.ndarray) or isinstance(new, np.ndarray):
+        return isinstance(old, np.ndarray) and isinstance(new, np.ndarray) and old.shape == new.shape \
+            and old.dtype == new.dtype and np.array_equal(old, new, equal_nan=old.dtype.kind in 'fc')
+    try:
+        return bool(old == new)
+    except ValueError:
+        return False
+
+
+class Journaled:
+    """ Tracks the attributes changed since the last save, for the journal of GeophysicalTimeSeries
+
+    JOURNAL_AXES maps array attributes to the axis along which they grow (the days). When such an
+    attribute is reassigned, it is journaled from the first changed index along that axis on (e.g. only
+    the days appended by extend). Other public attributes are journaled whole when reassigned, and the
+    JOURNAL_PRIVATE attributes whenever their value changed. Arrays modified in place must be reported
+    with mark_changed.
+    """
+
+    JOURNAL_AXES = {}
+    JOURNAL_PRIVATE = ()
+    JOURNAL_SKIP = ()
+
+    def __setattr__(self, name, value):
+        changes = self.__dict__.get('_changes')
+        if changes is not None and not name.startswith('_') and name not in self.JOURNAL_SKIP \
+                and not isinstance(getattr(type(self), name, None), property):
+            old = self.__dict__.get(name)
+            if value is not old:
+                start = _first_change(old, value, self.JOURNAL_AXES.get(name))
+                if start is not None:
+                    self.mark_changed(name, start)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_changes', None)
+        state.pop('_saved_private', None)
+        return state
+
+    def mark_changed(self, name: str, start: int = 0) -> None:
+        """ Journal an attribute on the next save
+
+        Args:
+            name (str): attribute
+            start (int): first changed index along its JOURNAL_AXES axis (0: the whole attribute)
+        """
+        changes = self.__dict__.get('_changes')
+        if changes is not None:
+            changes[name] = min(start, changes.get(name, start))
+
+    def assign(self, other: Journaled) -> None:
+        """ Take over the public attributes of another object, journaling only what changed """
+        for name, value in other.__dict__.items():
+            if name.startswith('_') or name in self.JOURNAL_SKIP:
+                continue
+            if name not in self.JOURNAL_AXES and _same(self.__dict__.get(name), value):
+                continue
+            setattr(self, name, value)
+
+    def _journal_start(self) -> None:
+        # Changes are tracked from here on (after a save or load)
+        self.__dict__['_changes'] = dict()
+        self.__dict__['_saved_private'] = {name: self.__dict__.get(name) for name in self.JOURNAL_PRIVATE}
+
+    def _journal_records(self) -> list[tuple]:
+        # (name, start, value) of the changes, value holding the indices from start on
+        records = []
+        for name, start in self.__dict__.get('_changes', dict()).items():
+            value = self.__dict__.get(name)
+            if start > 0:
+                value = value[(slice(None),) * self.JOURNAL_AXES[name] + (slice(start, None),)]
+            records.append((name, start, value))
+        saved = self.__dict__.get('_saved_private', dict())
+        for name in self.JOURNAL_PRIVATE:
+            if self.__dict__.get(name) != saved.get(name):
+                records.append((name, 0, self.__dict__.get(name)))
+        return records
+
+    def _journal_apply(self, name: str, start: int, value) -> None:
+        # Replay one record of _journal_records
+        if start > 0:
+            axis = self.JOURNAL_AXES[name]
+            old = self.__dict__[name][(slice(None),) * axis + (slice(None, start),)]
+            value = np.concatenate((old, value), axis=axis)
+        self.__dict__[name] = value
 
 
 @dataclass
-class GeophysicalTimeSeriesRaw:
-    
+class GeophysicalTimeSeriesRaw(Journaled):
+        
     dates: np.ndarray
-    geometry_lookuptable: dict[int, int]  # DPID -> INDEX
-    geometry_lookuptable_reverse: dict[int, int]  # INDEX -> DPID
-    task_dpid_lookup: dict[int, list[int]]  # TASKID -> List[DPID]
-    task_dpid_lookup_reverse: dict[int, int]  # DPID -> TASKID
-    dpid_abmn_lookup: dict[int, tuple[float, float, float, float]]  # DPID -> (Ax, Bx, Mx, Nx)
-    dpid_geometric_factor_lookup: dict[int, float]  # DPID -> G.Factor
-    focus_x: np.ndarray
-    focus_z: np.ndarray
+    metadata: MeasurementTable  # DPID, task, ABMN, geometric factor and focus point of each measurement
     voltage: np.ndarray
     current: np.ndarray
     resistance: np.ndarray
@@ -27,35 +331,377 @@ class GeophysicalTimeSeriesRaw:
     chargeability: np.ndarray
     decay: np.ndarray
     acquisition_settings: dict[str, str] = field(init=False, default_factory=dict)
+    value_dtype: str = 'float64'  # storage dtype of the measured values ('float32' halves the memory)
+    date_unit: str = 's'
+    validity: np.ndarray = None  # (measurements, days) validity bitmask, packed along the days
+    repeat_error: np.ndarray = None  # (measurements, days) stacking error of the resistance [%], NaN if unknown
+    rejection: np.ndarray = None  # (measurements, days) quality-control rejections, packed along the days
+
+    JOURNAL_AXES = {'dates': 0, 'voltage': 1, 'current': 1, 'resistance': 1, 'apres': 1, 'chargeability': 1,
+                    'repeat_error': 1, 'validity': 1, 'rejection': 1}
+    # The decay cube is appended to its own file
+    JOURNAL_PRIVATE = ('_decay_days', '_decay_shape', '_decay_dtype')
+    JOURNAL_SKIP = ('decay',)
+
+    def __post_init__(self):
+        if self.repeat_error is None:
+            self.repeat_error = np.full(self.resistance.shape, np.nan)
+        self.astype(self.value_dtype, self.date_unit)
+        if self.validity is None:
+            self.valid = ~np.isnan(self.resistance)
+        elif self.validity.dtype == bool:
+            self.valid = self.validity
+
+    # Dict views over the metadata table (the lookups of earlier versions)
+
+    @property
+    def geometry_lookuptable(self) -> Mapping[int, int]:  # DPID -> INDEX
+        return _DpidIndexView(self.metadata)
+
+    @property
+    def geometry_lookuptable_reverse(self) -> Mapping[int, int]:  # INDEX -> DPID
+        return _IndexView(self.metadata, 'dpid')
+
+    @property
+    def task_dpid_lookup(self) -> Mapping[int, list[int]]:  # TASKID -> List[DPID]
+        return _TaskDpidView(self.metadata)
+
+    @property
+    def task_dpid_lookup_reverse(self) -> Mapping[int, int]:  # DPID -> TASKID
+        return _DpidColumnView(self.metadata, 'task_id')
+
+    @property
+    def dpid_abmn_lookup(self) -> Mapping[int, list[float]]:  # DPID -> (Ax, Bx, Mx, Nx)
+        return _DpidColumnView(self.metadata, ('a', 'b', 'm', 'n'))
+
+    @property
+    def dpid_geometric_factor_lookup(self) -> Mapping[int, float]:  # DPID -> G.Factor
+        return _DpidColumnView(self.metadata, 'k')
+
+    @property
+    def focus_x(self) -> np.ndarray:
+        return self.metadata.focus_x
+
+    @property
+    def focus_z(self) -> np.ndarray:
+        return self.metadata.focus_z
+
+    @property
+    def valid(self) -> np.ndarray:
+        """ Boolean (measurements, days) mask, False where no measurement was acquired """
+        validity = getattr(self, 'validity', None)
+        if validity is None:
+            # Objects pickled before the bitmask existed
+            return ~np.isnan(self.resistance)
+        return np.unpackbits(validity, axis=1, count=len(self.dates)).astype(bool)
+
+    @valid.setter
+    def valid(self, mask: np.ndarray) -> None:
+        self.validity = np.packbits(np.asarray(mask, dtype=bool), axis=1)
+
+    def valid_at(self, index_day: int) -> np.ndarray:
+        """ Validity of all measurements of one day, without unpacking the whole bitmask """
+        validity = getattr(self, 'validity', None)
+        if validity is None:
+            return ~np.isnan(self.resistance[:, index_day])
+        return self._bits_at(validity, index_day)
+
+    @property
+    def rejected(self) -> np.ndarray:
+        """ Boolean (measurements, days) mask, True where quality control rejected the measurement """
+        if self.rejection is None:
+            return np.zeros(self.resistance.shape, dtype=bool)
+        return np.unpackbits(self.rejection, axis=1, count=len(self.dates)).astype(bool)
+
+    @rejected.setter
+    def rejected(self, mask: np.ndarray) -> None:
+        self.rejection = None if mask is None else np.packbits(np.asarray(mask, dtype=bool), axis=1)
+
+    @property
+    def accepted(self) -> np.ndarray:
+        """ Acquired measurements that passed quality control """
+        return self.valid & ~self.rejected
+
+    def accepted_at(self, index_day: int) -> np.ndarray:
+        """ Accepted measurements of one day, without unpacking the bitmasks """
+        if self.rejection is None:
+            return self.valid_at(index_day)
+        return self.valid_at(index_day) & ~self._bits_at(self.rejection, index_day)
+
+    def _bits_at(self, packed: np.ndarray, index_day: int) -> np.ndarray:
+        index_day = range(len(self.dates))[index_day]
+        return ((packed[:, index_day // 8] >> (7 - index_day % 8)) & 1).astype(bool)
+
+    def astype(self, value_dtype: str, date_unit: str = None) -> None:
+        """ Convert the stored arrays to a storage dtype (in place)
+
+        Args:
+            value_dtype (str): dtype of voltage, current, resistance, apres, chargeability and decay
+            date_unit (str): datetime64 unit of the dates (e.g. 's', 'm', 'h')
+        """
+        self.value_dtype = value_dtype
+        self.date_unit = getattr(self, 'date_unit', 's') if date_unit is None else date_unit
+        self.dates = self.dates.astype(f'datetime64[{self.date_unit}]', copy=False)
+        for name in VALUE_FIELDS:
+            if name == 'decay' and not self.decay_loaded() and self.__dict__['_decay_dtype'] == np.dtype(value_dtype):
+                # Keep the file-backed cube lazy if it has the right dtype already
+                continue
+            setattr(self, name, getattr(self, name).astype(value_dtype, copy=False))
 
     def extend(self, other) -> None:
         if not isinstance(other, self.__class__):
             print("Data should be of the same type.")
         else:
+            valid = np.concatenate( (self.valid, other.valid), axis=1)
+            rejected = None
+            if self.rejection is not None or other.rejection is not None:
+                rejected = np.concatenate( (self.rejected, other.rejected), axis=1)
             self.dates = np.concatenate( (self.dates, other.dates), axis=0)
             self.voltage = np.concatenate( (self.voltage, other.voltage), axis=1)
             self.current = np.concatenate( (self.current, other.current), axis=1)
             self.resistance = np.concatenate( (self.resistance, other.resistance), axis=1)
             self.apres = np.concatenate( (self.apres, other.apres), axis=1)
             self.chargeability = np.concatenate( (self.chargeability, other.chargeability), axis=1)
-            self.decay = np.concatenate( (self.decay, other.decay), axis=1)
+            self.repeat_error = np.concatenate( (self.repeat_error, other.repeat_error), axis=1)
+            if self.decay_loaded():
+                self.decay = np.concatenate( (self.decay, other.decay), axis=1)
+            else:
+                # Append the new days to the file on the next save, without reading the cube: the blocks of
+                # a file-backed cube (e.g. the shard of the next period) stay memory-mapped
+                blocks = other._decay_blocks() if not other.decay_loaded() else [other.decay.transpose(1, 0, 2)]
+                self.__dict__['_decay_tail'].extend(
+                    np.ascontiguousarray(block, dtype=self.__dict__['_decay_dtype']) for block in blocks)
+            # Objects pickled before value_dtype existed are float64
+            self.astype(getattr(self, 'value_dtype', 'float64'))
+            self.valid = valid
+            self.rejected = rejected
+
+    def take(self, days, decay: bool = True) -> GeophysicalTimeSeriesRaw:
+        """ Copy of some days
+
+        Args:
+            days: day indices (slice, list or array)
+            decay (bool): copy the decays, or leave an empty (measurements, days, 0) cube
+
+        Returns:
+            GeophysicalTimeSeriesRaw: the days in the given order
+        """
+        days = np.arange(len(self.dates))[days]
+        value_dtype = getattr(self, 'value_dtype', 'float64')
+        if decay:
+            cube = self.decay_slice(days=days)
+        else:
+            cube = np.empty([len(self.metadata), len(days), 0], dtype=value_dtype)
+        raw = GeophysicalTimeSeriesRaw(self.dates[days], self.metadata, self.voltage[:, days], self.current[:, days],
+                                       self.resistance[:, days], self.apres[:, days], self.chargeability[:, days],
+                                       cube, value_dtype=value_dtype, date_unit=getattr(self, 'date_unit', 's'),
+                                       validity=self.valid[:, days], repeat_error=self.repeat_error[:, days])
+        raw.rejected = None if self.rejection is None else self.rejected[:, days]
+        raw.acquisition_settings = dict(self.acquisition_settings)
+        return raw
+
+    # The decay cube is stored day-major (days, measurements, gates) in a raw binary file next
+    # to the pickle. After a save or load it is memory-mapped on first access, so stages that
+    # never read it do not load it, and new days are appended to the file.
+
+    def __setstate__(self, state):
+        if 'metadata' not in state:
+            # Objects pickled with the dict lookups
+            state['metadata'] = MeasurementTable.from_lookups(
+                state.pop('geometry_lookuptable_reverse'), state.pop('task_dpid_lookup_reverse'),
+                state.pop('dpid_abmn_lookup'), state.pop('dpid_geometric_factor_lookup'),
+                state.pop('focus_x'), state.pop('focus_z'))
+            state.pop('geometry_lookuptable')
+            state.pop('task_dpid_lookup')
+        if 'repeat_error' not in state:
+            # Objects pickled before quality control existed
+            state['repeat_error'] = np.full(state['resistance'].shape, np.nan, dtype=state['resistance'].dtype)
+            state['rejection'] = None
+        self.__dict__.update(state)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_decay_map', None)
+        if state.get('_decay_file') is not None and 'decay' not in state:
+            # Persisted in the decay file
+            state['_decay_tail'] = []
+        return state
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set: the lazy decay cube
+        if name == 'decay' and self.__dict__.get('_decay_file') is not None:
+            return self._decay_view()
+        raise AttributeError(name)
+
+    def decay_loaded(self) -> bool:
+        # True if the decay cube is an in-memory array (not backed by the decay file)
+        return 'decay' in self.__dict__ or self.__dict__.get('_decay_file') is None
+
+    def _decay_memmap(self) -> np.ndarray:
+        decay_map = self.__dict__.get('_decay_map')
+        if decay_map is None:
+            measurements, gates = self.__dict__['_decay_shape']
+            days = self.__dict__['_decay_days']
+            if days * measurements * gates == 0:
+                decay_map = np.empty([days, measurements, gates], dtype=self.__dict__['_decay_dtype'])
+            else:
+                decay_map = np.memmap(self.__dict__['_decay_file'], dtype=self.__dict__['_decay_dtype'],
+                                      mode='r', shape=(days, measurements, gates))
+            self.__dict__['_decay_map'] = decay_map
+        return decay_map
+
+    def _decay_blocks(self) -> list[np.ndarray]:
+        # Day-major blocks of a file-backed cube: the decay file, then the days appended since
+        return [self._decay_memmap()] + self.__dict__['_decay_tail']
+
+    def _decay_view(self) -> np.ndarray:
+        blocks = self._decay_blocks()
+        decay_map = blocks[0] if len(blocks) == 1 else np.concatenate(blocks, axis=0)
+        return decay_map.transpose(1, 0, 2)
+
+    def decay_slice(self, measurements=slice(None), days=slice(None)) -> np.ndarray:
+        """ Part of the decay cube, read from the decay file without materialising the whole cube
+
+        Args:
+            measurements: measurement indices (slice, list or array)
+            days: day indices (slice, list or array)
+
+        Returns:
+            np.ndarray: decays (measurements, days, gates)
+        """
+        if self.decay_loaded():
+            return self.decay[measurements][:, days]
+        # Day-major on disk: select the days of each block, reading only the blocks holding them
+        blocks = self._decay_blocks()
+        ends = np.cumsum([len(block) for block in blocks])
+        days = np.arange(ends[-1])[days]
+        measurements = np.arange(self.__dict__['_decay_shape'][0])[measurements]
+        selected = np.empty([len(measurements), len(days), self.__dict__['_decay_shape'][1]],
+                            dtype=self.__dict__['_decay_dtype'])
+        block_of = np.searchsorted(ends, days, side='right')
+        for block in np.unique(block_of):
+            at = np.flatnonzero(block_of == block)
+            local = days[at] - (ends[block] - len(blocks[block]))
+            selected[:, at] = blocks[block][local][:, measurements].transpose(1, 0, 2)
+        return selected
+
+    def attach_decay(self, filename: str) -> None:
+        # Decay file of a loaded object (the file lives next to the pickle)
+        if self.__dict__.get('_decay_file') is not None and 'decay' not in self.__dict__:
+            self.__dict__['_decay_file'] = filename
+            self.__dict__.pop('_decay_map', None)
+
+    def persist_decay(self, filename: str) -> None:
+        """ Write the decay cube to its file and release it from memory
+
+        Args:
+            filename (str): decay file (day-major raw binary)
+        """
+        self.__dict__.pop('_decay_map', None)
+        if 'decay' in self.__dict__:
+            # In-memory cube: (re)write the whole file
+            decay = np.ascontiguousarray(self.__dict__['decay'].transpose(1, 0, 2))
+            tmp = filename + '.tmp'
+            decay.tofile(tmp)
+            os.replace(tmp, filename)
+            self.__dict__.update(_decay_file=filename, _decay_days=decay.shape[0], _decay_shape=decay.shape[1:],
+                                 _decay_dtype=decay.dtype, _decay_tail=[])
+            del self.__dict__['decay']
+            return
+        if self.__dict__.get('_decay_file') is None:
+            return
+        if os.path.abspath(self.__dict__['_decay_file']) != os.path.abspath(filename):
+            shutil.copyfile(self.__dict__['_decay_file'], filename)
+            self.__dict__['_decay_file'] = filename
+        # Append the days added since the last save
+        tail = self.__dict__['_decay_tail']
+        if len(tail) > 0:
+            with open(filename, 'r+b') as fout:
+                # Drop bytes beyond the recorded days (an interrupted append)
+                measurements, gates = self.__dict__['_decay_shape']
+                fout.truncate(self.__dict__['_decay_days'] * measurements * gates * self.__dict__['_decay_dtype'].itemsize)
+                fout.seek(0, os.SEEK_END)
+                for block in tail:
+                    block.tofile(fout)
+                    self.__dict__['_decay_days'] += block.shape[0]
+            self.__dict__['_decay_tail'] = []
+
+    def ip_window_list(self) -> np.ndarray:
+        # Delay time followed by the IP window widths (empty if unknown)
+        return np.array(self.acquisition_settings.get('IP_WindowSecList', '').split(), dtype=float)
 
 @dataclass
-class GeophysicalTimeSeriesFiltered:
+class GeophysicalTimeSeriesFiltered(Journaled):
     
     dates: np.ndarray = field(init=False, default_factory=lambda: np.array([]))
     resistance: np.ndarray = field(init=False, default_factory=lambda: np.array([]))
     apres: np.ndarray = field(init=False, default_factory=lambda: np.array([]))
     chargeability: np.ndarray = field(init=False, default_factory=lambda: np.array([]))
+    value_dtype: str = 'float64'
+    # Standard deviation of the filtered values, None if the filtering strategy gives none
+    resistance_std: np.ndarray = field(init=False, default=None)
+    apres_std: np.ndarray = field(init=False, default=None)
+    chargeability_std: np.ndarray = field(init=False, default=None)
+
+    JOURNAL_AXES = {'dates': 0, 'resistance': 1, 'apres': 1, 'chargeability': 1,
+                    'resistance_std': 1, 'apres_std': 1, 'chargeability_std': 1}
+
+    def astype(self, value_dtype: str, date_unit: str = 'h') -> None:
+        # Convert the filtered arrays to the storage dtype (in place)
+        self.value_dtype = value_dtype
+        self.dates = self.dates.astype(f'datetime64[{date_unit}]', copy=False)
+        for name in FILTERED_FIELDS:
+            if getattr(self, name) is not None:
+                setattr(self, name, getattr(self, name).astype(value_dtype, copy=False))
+
+    def take(self, days) -> GeophysicalTimeSeriesFiltered:
+        # Copy of some days
+        filtered = GeophysicalTimeSeriesFiltered(value_dtype=self.value_dtype)
+        filtered.dates = self.dates[days]
+        for name in FILTERED_FIELDS:
+            values = getattr(self, name)
+            setattr(filtered, name, values[:, days] if values is not None and values.ndim == 2 else values)
+        return filtered
 
 @dataclass 
-class GeophysicalTimeSeriesResults:
+class GeophysicalTimeSeriesResults(Journaled):
 
     dates: np.ndarray = field(default_factory=lambda: np.array([]))
     x: np.ndarray = field(default_factory=lambda: np.array([]))
     depth: np.ndarray = field(default_factory=lambda: np.array([]))
     resistivity: np.ndarray = field(default_factory=lambda: np.array([]))
     chargeability: np.ndarray = field(default_factory=lambda: np.array([]))
+    keys: dict[str, str] = field(default_factory=dict)  # date -> inversion cache key of the result
+
+    JOURNAL_AXES = {'dates': 0, 'resistivity': 1, 'chargeability': 1}
+
+    def __setstate__(self, state):
+        # Objects pickled before the inversion cache existed
+        state.setdefault('keys', dict())
+        self.__dict__.update(state)
+
+    def replace(self, dates: np.ndarray, resistivity: np.ndarray, chargeability: np.ndarray) -> None:
+        # Overwrite the model of an already stored date (re-inverted after its inputs changed)
+        index = int(np.flatnonzero(self.dates == dates[0])[0])
+        if self.resistivity.ndim == 1:
+            self.resistivity = resistivity
+            self.chargeability = chargeability
+        else:
+            self.resistivity[:, index] = resistivity
+            self.chargeability[:, index] = chargeability
+            self.mark_changed('resistivity', index)
+            self.mark_changed('chargeability', index)
+
+    def take(self, days) -> GeophysicalTimeSeriesResults:
+        # Copy of some dates (a single date is stored as a 1-D array)
+        days = np.arange(len(self.dates))[days]
+        resistivity = self.resistivity.reshape(len(self.x), -1)[:, days]
+        chargeability = self.chargeability.reshape(len(self.x), -1)[:, days]
+        if len(days) == 1:
+            resistivity, chargeability = resistivity[:, 0], chargeability[:, 0]
+        dates = self.dates[days]
+        keys = {str(dt): self.keys[str(dt)] for dt in dates if str(dt) in self.keys}
+        return GeophysicalTimeSeriesResults(dates, self.x, self.depth, resistivity, chargeability, keys)
 
     def extend(self, dates: np.ndarray, resistivity: np.ndarray, chargeability: np.ndarray) -> None:
         if len(self.dates) == 1:
@@ -72,21 +718,249 @@ class GeophysicalTimeSeriesResults:
             self.chargeability = np.concatenate( (self.chargeability, chargeability), axis=1)
             
 
+@dataclass
+class TimestepSelection(Journaled):
+
+    dates: np.ndarray = field(default_factory=lambda: np.array([], dtype='datetime64[s]'))
+    metric: np.ndarray = field(default_factory=lambda: np.array([]))  # RMS relative change to the reference timestep
+    selected: np.ndarray = field(default_factory=lambda: np.array([], dtype=bool))
+    reason: np.ndarray = field(default_factory=lambda: np.array([], dtype=str))
+
+    JOURNAL_AXES = {'dates': 0, 'metric': 0, 'selected': 0, 'reason': 0}
+
+    def extend(self, dates: np.ndarray, metric: np.ndarray, selected: np.ndarray, reason: np.ndarray) -> None:
+        self.dates = np.concatenate( (self.dates, np.asarray(dates, dtype='datetime64[s]')), axis=0)
+        self.metric = np.concatenate( (self.metric, metric), axis=0)
+        self.selected = np.concatenate( (self.selected, selected), axis=0)
+        self.reason = np.concatenate( (self.reason, reason), axis=0)
+
+    def take(self, index) -> TimestepSelection:
+        return TimestepSelection(self.dates[index], self.metric[index], self.selected[index], self.reason[index])
+
+    def is_selected(self, dates: np.ndarray) -> np.ndarray:
+        """ True for selected dates and for dates not decided yet """
+        dates = np.asarray(dates, dtype='datetime64[s]')
+        if len(self.dates) == 0:
+            return np.ones(dates.shape, dtype=bool)
+        order = np.argsort(self.dates)
+        position = np.clip(np.searchsorted(self.dates[order], dates), 0, len(self.dates) - 1)
+        known = self.dates[order][position] == dates
+        return ~known | self.selected[order][position]
+
+    def last_selected(self) -> np.datetime64:
+        if not self.selected.any():
+            return None
+        return self.dates[self.selected].max()
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({'dt': self.dates, 'metric': self.metric, 'selected': self.selected, 'reason': self.reason})
+
+
 @dataclass
 class GeophysicalTimeSeries:
     
     raw: GeophysicalTimeSeriesRaw = field(init=False, default=None)
-    filtered: GeophysicalTimeSeriesFiltered = field(init=False, default=GeophysicalTimeSeriesFiltered())
+    filtered: GeophysicalTimeSeriesFiltered = field(init=False, default_factory=GeophysicalTimeSeriesFiltered)
     inverted: dict[int, GeophysicalTimeSeriesResults] = field(init=False, default_factory=lambda: defaultdict(GeophysicalTimeSeriesResults))
+    selection: dict[int, TimestepSelection] = field(init=False, default_factory=lambda: defaultdict(TimestepSelection))
+
+    # save appends the changes since the last save or load to a journal next to the pickle
+    # (filename + '.journal'), one pickled list of records per save, and load replays them. Each
+    # record is (part, attribute, start, value), where part is ('raw',), ('filtered',),
+    # ('inverted', task_id) or ('selection', task_id), and a whole part is recorded with attribute None.
+    # The journal belongs to one generation of the pickle, so a journal left over by an
+    # interrupted compaction is ignored.
+
+    def __setstate__(self, state):
+        # Objects pickled before the timestep selection existed
+        state.setdefault('selection', defaultdict(TimestepSelection))
+        self.__dict__.update(state)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_journal_file', '_journal_size', '_saved_parts', '_shard_keys'):
+            state.pop(name, None)
+        return state
+
+    def extend(self, other: GeophysicalTimeSeries) -> None:
+        """ Append the days of another time series (e.g. the shard of the next period) """
+        if self.raw is None:
+            self.raw = other.raw
+        elif other.raw is not None:
+            self.raw.extend(other.raw)
+        if len(other.filtered.dates) > 0:
+            if len(self.filtered.dates) == 0:
+                self.filtered = other.filtered
+            else:
+                self.filtered.dates = np.concatenate( (self.filtered.dates, other.filtered.dates), axis=0)
+                for name in FILTERED_FIELDS:
+                    mine, theirs = getattr(self.filtered, name), getattr(other.filtered, name)
+                    # Uncertainties are kept only if both parts have them
+                    setattr(self.filtered, name, None if mine is None or theirs is None else np.concatenate( (mine, theirs), axis=1))
+        for task_id, results in other.inverted.items():
+            if len(results.dates) == 0:
+                continue
+            if len(self.inverted[task_id].dates) == 0:
+                self.inverted[task_id] = results
+                continue
+            mine = self.inverted[task_id]
+            mine.dates = np.concatenate( (mine.dates, results.dates), axis=0)
+            for name in ('resistivity', 'chargeability'):
+                setattr(mine, name, np.concatenate( (getattr(mine, name).reshape(len(mine.x), -1),
+                                                     getattr(results, name).reshape(len(results.x), -1)), axis=1))
+            mine.keys = {**mine.keys, **results.keys}
+        for task_id, selection in other.selection.items():
+            self.selection[task_id].extend(selection.dates, selection.metric, selection.selected, selection.reason)
 
+    def save(self, filename: str, compact: bool = None) -> None:
+        """ Save the time series
 
-    def save(self, filename: str):
+        The changes since the last save or load of the same file are appended to the journal. The
+        pickle is rewritten and the journal emptied if compact is True, or by default when there is no
+        journal to append to or it grew beyond JOURNAL_COMPACTION_RATIO of the pickle size.
+
+        Args:
+            filename (str): pickle file
+            compact (bool): rewrite the pickle (True) or append to the journal (False)
+        """
         if self is not None:
-            with open(filename, 'wb') as pf:
-                pickle.dump(self, pf)
+            # The decay cube goes to its own file, the pickle keeps the rest
+            if self.raw is not None:
+                self.raw.persist_decay(filename + '.decay')
+            self._update_history(filename + '.history')
+            if compact is None:
+                compact = not self._journal_appendable(filename)
+            if compact:
+                self._write_snapshot(filename)
+            else:
+                self._append_journal(filename)
+            self._journal_start(filename)
+
+    def compact(self, filename: str) -> None:
+        # Fold the journal into the pickle
+        self.save(filename, compact=True)
 
     @classmethod
     def load(cls, filename: str) -> GeophysicalTimeSeries:
         if os.path.isfile(filename):
             with open(filename, 'rb') as pf:
-                return pickle.load(pf)
+                data = pickle.load(pf)
+            data._replay(filename + '.journal')
+            if data.raw is not None:
+                data.raw.attach_decay(filename + '.decay')
+            data._journal_start(filename)
+            return data
+
+    def _update_history(self, path: str) -> None:
+        # Measurement-major copies for single-measurement queries (see tools.history), from the first changed day on
+        groups = []
+        if self.raw is not None:
+            groups.append((('raw',), 'raw', ('resistance', 'apres', 'chargeability'),
+                           dict(labels=self.raw.metadata.dpid, metadata=self.raw.metadata.rows)))
+            if self.filtered.apres.ndim == 2 and len(self.filtered.apres) == len(self.raw.metadata):
+                groups.append((('filtered',), 'filtered', ('resistance', 'apres', 'chargeability'),
+                               dict(labels=self.raw.metadata.dpid)))
+        for task_id, results in self.inverted.items():
+            if len(results.dates) > 0:
+                groups.append((('inverted', task_id), f'inverted_{task_id}', ('resistivity', 'chargeability'),
+                               dict(x=results.x, depth=results.depth)))
+        saved = self.__dict__.get('_saved_parts', dict())
+        parts = self._parts()
+        for part_path, name, fields, attributes in groups:
+            part = parts[part_path]
+            start = 0
+            if saved.get(part_path) is part:
+                changes = part.__dict__.get('_changes', dict())
+                start = min([changes[field] for field in fields + ('dates',) if field in changes], default=len(part.dates))
+            store = HistoryStore(os.path.join(path, name))
+            values = {field: getattr(part, field).reshape(len(getattr(part, field)), -1) for field in fields}
+            if start < len(part.dates) or store.days != len(part.dates):
+                store.update(part.dates, values, start, **attributes)
+            # Daily, weekly and monthly min, max, sum and count
+            update_aggregates(os.path.join(path, name), part.dates, values, start,
+                              **{key: value for key, value in attributes.items() if key != 'metadata'})
+
+    def _parts(self) -> dict[tuple, Journaled]:
+        parts = {('raw',): self.raw, ('filtered',): self.filtered}
+        parts.update({('inverted', task_id): results for task_id, results in self.inverted.items()})
+        parts.update({('selection', task_id): selection for task_id, selection in self.selection.items()})
+        return {path: part for path, part in parts.items() if part is not None}
+
+    def _set_part(self, path: tuple, part: Journaled) -> None:
+        if len(path) == 1:
+            self.__dict__[path[0]] = part
+        elif part is None:
+            getattr(self, path[0]).pop(path[1], None)
+        else:
+            getattr(self, path[0])[path[1]] = part
+
+    def _journal_start(self, filename: str) -> None:
+        # Changes are tracked relative to what was just saved or loaded
+        self.__dict__['_journal_file'] = os.path.abspath(filename)
+        self.__dict__.setdefault('_journal_size', 0)
+        self.__dict__['_saved_parts'] = self._parts()
+        for part in self.__dict__['_saved_parts'].values():
+            part._journal_start()
+
+    def _journal_appendable(self, filename: str) -> bool:
+        return self.__dict__.get('_journal_file') == os.path.abspath(filename) and os.path.isfile(filename) \
+            and self.__dict__['_journal_size'] <= JOURNAL_COMPACTION_RATIO * os.path.getsize(filename)
+
+    def _journal_records(self) -> list[tuple]:
+        records = []
+        saved = self.__dict__.get('_saved_parts', dict())
+        parts = self._parts()
+        for path, part in parts.items():
+            if saved.get(path) is not part:
+                # New or replaced part
+                records.append((path, None, 0, part))
+            else:
+                records += [(path,) + record for record in part._journal_records()]
+        records += [(path, None, 0, None) for path in saved if path not in parts]
+        return records
+
+    def _write_snapshot(self, filename: str) -> None:
+        self.__dict__['_generation'] = self.__dict__.get('_generation', 0) + 1
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as pf:
+            pickle.dump(self, pf)
+            pf.flush()
+            os.fsync(pf.fileno())
+        os.replace(tmp, filename)
+        if os.path.isfile(filename + '.journal'):
+            os.remove(filename + '.journal')
+        self.__dict__['_journal_size'] = 0
+
+    def _append_journal(self, filename: str) -> None:
+        records = self._journal_records()
+        if len(records) == 0:
+            return
+        journal = filename + '.journal'
+        with open(journal, 'r+b' if os.path.isfile(journal) else 'wb') as fout:
+            # Drop what follows the replayed records (an interrupted append)
+            fout.truncate(self.__dict__['_journal_size'])
+            fout.seek(0, os.SEEK_END)
+            pickle.dump((self.__dict__.get('_generation', 0), records), fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+            self.__dict__['_journal_size'] = fout.tell()
+
+    def _replay(self, journal: str) -> None:
+        size = 0
+        if os.path.isfile(journal):
+            with open(journal, 'rb') as fin:
+                while True:
+                    try:
+                        generation, records = pickle.load(fin)
+                    except (EOFError, pickle.UnpicklingError):
+                        # End of the journal, or the torn end of an interrupted append
+                        break
+                    if generation != self.__dict__.get('_generation', 0):
+                        break
+                    for path, name, start, value in records:
+                        if name is None:
+                            self._set_part(path, value)
+                        else:
+                            self._parts()[path]._journal_apply(name, start, value)
+                    size = fin.tell()
+        self.__dict__['_journal_size'] = size
@@ -0,0 +1,483 @@
+"""
+Measurement-major copy of the time-series arrays, for the history of a single measurement.
+
+The arrays of GeophysicalTimeSeries are (rows, days): reading one row of the pickle reads all of
+it. A HistoryStore keeps every field in chunks of chunk_days days, and inside a chunk the days of a
+row are contiguous. The history of one row (a DPID or an inverted cell) reads one short run per
+chunk, independent of the number of rows, and new days are written into the last chunks only.
+"""
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+
+class HistoryStore:
+
+    def __init__(self, path: str, chunk_days: int = 64):
+        self.path = path
+        self.chunk_days = chunk_days
+        self.index = self._read_index()
+
+    @property
+    def days(self) -> int:
+        return len(self.index['dates'])
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self.index['dates']
+
+    @property
+    def labels(self) -> np.ndarray:
+        # Label of each row (DPID of a measurement), None if rows are only numbered
+        return self.index['labels']
+
+    def update(self, dates: np.ndarray, fields: dict[str, np.ndarray], start: int = 0,
+               labels: np.ndarray = None, **attributes) -> None:
+        """
+        Write the days from start on.
+
+        The whole store is rewritten if its rows or dtypes do not match the fields.
+
+        :param dates: dates of the days
+        :param fields: (rows, days) arrays by name
+        :param start: first day changed since the last update
+        :param labels: label of each row
+        :param attributes: other arrays kept in the index (e.g. the cell coordinates)
+        """
+        if not self.matches(fields) or len(dates) < self.days:
+            start = 0
+        start = min(start, self.days)
+        self.write(dates, {name: values[:, start:] for name, values in fields.items()}, start, labels, **attributes)
+
+    def matches(self, fields: dict[str, np.ndarray]) -> bool:
+        # True if the stored rows and dtypes are those of the fields
+        rows = len(next(iter(fields.values())))
+        return self.index['rows'] == rows and self.index['fields'] == {name: str(values.dtype) for name, values in fields.items()}
+
+    def write(self, dates: np.ndarray, tails: dict[str, np.ndarray], start: int,
+              labels: np.ndarray = None, **attributes) -> None:
+        """
+        Write the days from start on, given only their columns.
+
+        :param dates: dates of all days
+        :param tails: (rows, days - start) arrays by name
+        :param start: first day written (0 rewrites the store)
+        :param labels: label of each row
+        :param attributes: other arrays kept in the index
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for name, values in tails.items():
+            self._write(name, values, start, len(dates))
+        self.index.update(rows=len(next(iter(tails.values()))), chunk_days=self.chunk_days,
+                          fields={name: str(values.dtype) for name, values in tails.items()}, dates=np.array(dates),
+                          labels=None if labels is None else np.array(labels), **attributes)
+        self._write_index()
+
+    def read(self, name: str, row: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        History of one row.
+
+        :param name: field
+        :param row: row index
+        :return: dates and values in chronological order
+        """
+        data = self._memmap(name, 'r')
+        values = np.array(data[:, row, :]).reshape(-1)[:self.days]
+        order = np.argsort(self.dates, kind='stable')
+        return self.dates[order], values[order]
+
+    def row_of(self, label) -> int:
+        # Row of a label (-1 if unknown)
+        rows = np.flatnonzero(self.labels == label) if self.labels is not None else []
+        return int(rows[0]) if len(rows) > 0 else -1
+
+    def read_days(self, name: str, days) -> np.ndarray:
+        """
+        Values of all rows on some days.
+
+        :param name: field
+        :param days: day indices in stored order
+        :return: (rows, len(days)) values
+        """
+        days = np.asarray(days, dtype=np.int64)
+        data = self._memmap(name, 'r')
+        return np.array(data[days // self.index['chunk_days'], :, days % self.index['chunk_days']]).T
+
+    def _write(self, name: str, values: np.ndarray, start: int, days: int) -> None:
+        rows = len(values)
+        chunks = -(-days // self.chunk_days)
+        size = chunks * rows * self.chunk_days * values.dtype.itemsize
+        filename = os.path.join(self.path, name + '.bin')
+        # Readers may have the file mapped: a rewritten or shrunk file is written aside and swapped in
+        replace = start == 0 or not os.path.isfile(filename) or os.path.getsize(filename) > size
+        target = filename + '.tmp' if replace else filename
+        mode = 'wb'
+        if not replace:
+            mode = 'r+b'
+        elif start > 0 and os.path.isfile(filename):
+            shutil.copyfile(filename, target)
+            mode = 'r+b'
+        with open(target, mode) as fout:
+            # New chunks are allocated whole, the unused days of the last chunk are never read
+            fout.truncate(size)
+        if chunks * rows > 0:
+            data = np.memmap(target, dtype=values.dtype, mode='r+', shape=(chunks, rows, self.chunk_days))
+            for chunk in range(start // self.chunk_days, chunks):
+                first = max(start, chunk * self.chunk_days)
+                last = min(days, (chunk + 1) * self.chunk_days)
+                data[chunk, :, first - chunk * self.chunk_days:last - chunk * self.chunk_days] = values[:, first - start:last - start]
+            data.flush()
+            del data
+        if replace:
+            os.replace(target, filename)
+
+    def read_all(self, name: str) -> np.ndarray:
+        # (rows, days) array of a field, in stored order
+        data = self._memmap(name, 'r')
+        return np.array(data.transpose(1, 0, 2)).reshape(self.index['rows'], -1)[:, :self.days]
+
+    def _memmap(self, name: str, mode: str) -> np.ndarray:
+        chunks = -(-self.days // self.index['chunk_days'])
+        dtype = np.dtype(self.index['fields'][name])
+        if chunks * self.index['rows'] == 0:
+            return np.empty([chunks, self.index['rows'], self.index['chunk_days']], dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode=mode,
+                         shape=(chunks, self.index['rows'], self.index['chunk_days']))
+
+    def _read_index(self) -> dict:
+        filename = os.path.join(self.path, 'index.pickle')
+        if not os.path.isfile(filename):
+            return {'rows': 0, 'chunk_days': self.chunk_days, 'fields': dict(), 'dates': np.array([]), 'labels': None}
+        with open(filename, 'rb') as fin:
+            index = pickle.load(fin)
+        self.chunk_days = index['chunk_days']
+        return index
+
+    def _write_index(self) -> None:
+        filename = os.path.join(self.path, 'index.pickle')
+        with open(filename + '.tmp', 'wb') as fout:
+            pickle.dump(self.index, fout)
+        os.replace(filename + '.tmp', filename)
+
+
+def measurement_history(filenames, dpid: int, name: str = 'apres', part: str = 'raw') -> tuple[np.ndarray, np.ndarray]:
+    """
+    History of one measurement, read from the history stores next to the pickles.
+
+    :param filenames: pickle file, or the pickles of all shards
+    :param dpid: DPID of the measurement
+    :param name: 'resistance', 'apres' or 'chargeability'
+    :param part: 'raw' or 'filtered'
+    :return: dates and values in chronological order
+    """
+    return _history(filenames, part, name, lambda store: store.row_of(dpid))
+
+
+def measurement_metadata(filenames, dpid: int) -> np.void:
+    # MeasurementTable row of a DPID, None if not stored
+    for filename in [filenames] if isinstance(filenames, str) else filenames:
+        store = HistoryStore(os.path.join(filename + '.history', 'raw'))
+        row = store.row_of(dpid)
+        if row >= 0:
+            return store.index['metadata'][row]
+    return None
+
+
+def cell_history(filenames, task_id: int, x: float, depth: float, name: str = 'resistivity') -> tuple[np.ndarray, np.ndarray]:
+    """
+    History of the inverted cell nearest to a point.
+
+    :param filenames: pickle file, or the pickles of all shards
+    :param task_id: task
+    :param x: horizontal position
+    :param depth: depth
+    :param name: 'resistivity' or 'chargeability'
+    :return: dates and values in chronological order
+    """
+    def nearest(store):
+        return int(np.argmin((store.index['x'] - x) ** 2 + (store.index['depth'] - depth) ** 2))
+    return _history(filenames, f'inverted_{task_id}', name, nearest)
+
+
+def section(filenames, part: str, name: str, date) -> tuple[np.datetime64, np.ndarray, dict]:
+    """
+    Values of all rows on the stored day nearest to a date (e.g. a pseudo or inverted section).
+
+    :param filenames: pickle file, or the pickles of all shards
+    :param part: 'raw', 'filtered' or 'inverted_<task>'
+    :param name: field
+    :param date: requested date
+    :return: date of the day, its (rows,) values and the index of the store (labels, metadata, x, depth),
+        None and empty values if nothing is stored
+    """
+    date = np.datetime64(date)
+    nearest = None
+    for filename in [filenames] if isinstance(filenames, str) else filenames:
+        store = HistoryStore(os.path.join(filename + '.history', part))
+        if store.days == 0:
+            continue
+        day = int(np.argmin(np.abs(store.dates - date)))
+        if nearest is None or abs(store.dates[day] - date) < abs(nearest[0].dates[nearest[1]] - date):
+            nearest = (store, day)
+    if nearest is None:
+        return None, np.array([]), dict()
+    store, day = nearest
+    return store.dates[day], store.read_days(name, [day])[:, 0], store.index
+
+
+def date_range(filenames, part: str, name: str, start=None, end=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Values of all rows between two dates.
+
+    Labelled rows are matched across shards by label, in the order of the last shard.
+
+    :param filenames: pickle file, or the pickles of all shards
+    :param part: 'raw', 'filtered' or 'inverted_<task>'
+    :param name: field
+    :param start: first date (None: from the first day)
+    :param end: last date (None: up to the last day)
+    :return: row labels, dates in chronological order and the (rows, days) values
+    """
+    stores = []
+    for filename in [filenames] if isinstance(filenames, str) else filenames:
+        store = HistoryStore(os.path.join(filename + '.history', part))
+        selected = np.ones(store.days, dtype=bool)
+        if start is not None:
+            selected &= store.dates >= np.datetime64(start)
+        if end is not None:
+            selected &= store.dates <= np.datetime64(end)
+        if selected.any():
+            stores.append((store, np.flatnonzero(selected)))
+    if len(stores) == 0:
+        return None, np.array([], dtype='datetime64[s]'), np.empty([0, 0])
+    labels = stores[-1][0].labels
+    rows = stores[-1][0].index['rows']
+    dates, values = [], []
+    for store, days in stores:
+        block = _aligned(store, labels, rows, store.read_days(name, days), np.nan, part)
+        dates.append(store.dates[days])
+        values.append(block)
+    dates, values = np.concatenate(dates), np.concatenate(values, axis=1)
+    order = np.argsort(dates, kind='stable')
+    return labels, dates[order], values[:, order]
+
+
+def _aligned(store: HistoryStore, labels: np.ndarray, rows: int, block: np.ndarray, fill, part: str) -> np.ndarray:
+    # Rows of a store block in the order of labels (fill for labels the store does not have)
+    if labels is not None and not np.array_equal(store.labels, labels):
+        found = {label: row for row, label in enumerate(store.labels.tolist())}
+        positions = np.array([found.get(label, -1) for label in labels.tolist()], dtype=np.int64)
+        dtype = np.result_type(block.dtype, np.asarray(fill).dtype)
+        return np.where((positions >= 0)[:, None], block[positions].astype(dtype), fill)
+    if len(block) != rows:
+        raise ValueError('Rows of {} differ between the shards'.format(part))
+    return block
+
+
+def _history(filenames, part: str, name: str, row_of) -> tuple[np.ndarray, np.ndarray]:
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    dates, values = [np.array([], dtype='datetime64[s]')], [np.array([])]
+    for filename in filenames:
+        store = HistoryStore(os.path.join(filename + '.history', part))
+        if store.days == 0:
+            continue
+        row = row_of(store)
+        if row < 0:
+            continue
+        store_dates, store_values = store.read(name, row)
+        dates.append(store_dates)
+        values.append(store_values)
+    dates, values = np.concatenate(dates), np.concatenate(values)
+    order = np.argsort(dates, kind='stable')
+    return dates[order], values[order]
+
+
+# Aggregation levels of update_aggregates (numpy datetime units) and their nominal bin width, finest first
+LEVELS = (('D', np.timedelta64(1, 'D')), ('W', np.timedelta64(7, 'D')), ('M', np.timedelta64(30, 'D')))
+STATISTICS = ('min', 'max', 'sum', 'count')
+# Statistic of a row missing from a shard
+MISSING = {'min': np.nan, 'max': np.nan, 'sum': 0.0, 'count': 0}
+
+
+def calendar_bins(dates: np.ndarray, unit: str) -> np.ndarray:
+    """
+    Calendar bin of each date.
+
+    Weeks start on Monday and are labelled by that day (datetime64[W] weeks start on Thursday, the
+    weekday of the epoch).
+
+    :param dates: datetime64 dates
+    :param unit: numpy datetime unit of the bins ('D', 'W', 'M')
+    :return: first day of the bin ('W') or the bin in that unit
+    """
+    if unit != 'W':
+        return dates.astype(f'datetime64[{unit}]')
+    days = dates.astype('datetime64[D]')
+    monday = np.timedelta64(3, 'D')  # the epoch (1970-01-01) is a Thursday
+    return (days + monday).astype('datetime64[W]').astype('datetime64[D]') - monday
+
+
+def aggregate(dates: np.ndarray, values: np.ndarray, unit: str) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Min, max, sum and count of the values in each calendar bin (NaN values are not counted).
+
+    :param dates: dates of the days
+    :param values: (rows, days) values
+    :param unit: numpy datetime unit of the bins ('D', 'W', 'M'), see calendar_bins
+    :return: sorted bins and the (rows, bins) statistics by name
+    """
+    bins = calendar_bins(dates, unit)
+    order = np.argsort(bins, kind='stable')
+    bins = bins[order]
+    if len(bins) == 0:
+        empty = np.empty([len(values), 0])
+        return bins, {'min': empty, 'max': empty, 'sum': empty, 'count': empty.astype(np.int64)}
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    values = values[:, order].astype(np.float64)
+    finite = ~np.isnan(values)
+    return bins[starts], {'min': np.fmin.reduceat(values, starts, axis=1),
+                          'max': np.fmax.reduceat(values, starts, axis=1),
+                          'sum': np.add.reduceat(np.where(finite, values, 0.0), starts, axis=1),
+                          'count': np.add.reduceat(finite, starts, axis=1, dtype=np.int64)}
+
+
+def update_aggregates(path: str, dates: np.ndarray, fields: dict[str, np.ndarray], start: int = 0,
+                      **attributes) -> None:
+    """
+    Keep the daily, weekly and monthly aggregates of the fields (one HistoryStore per level).
+
+    Only the bins from the one of the first changed day on are computed again.
+
+    :param path: prefix of the stores (path_D, path_W, path_M)
+    :param dates: dates of the days
+    :param fields: (rows, days) arrays by name
+    :param start: first day changed since the last update
+    :param attributes: labels and other arrays kept in the index
+    """
+    rows = len(next(iter(fields.values())))
+    layout = {f'{name}_{statistic}': np.empty([rows, 0], dtype=np.int64 if statistic == 'count' else np.float64)
+              for name in fields for statistic in STATISTICS}
+    for unit, _ in LEVELS:
+        store = HistoryStore(f'{path}_{unit}')
+        bins = calendar_bins(dates, unit)
+        # Stores binned otherwise (e.g. weeks of datetime64[W]) are computed again
+        current = store.matches(layout) and store.dates.dtype == bins.dtype
+        if start >= len(dates) and current:
+            continue
+        # The bins from the first changed one on are computed from all their days
+        selected = np.ones(len(bins), dtype=bool)
+        position = 0
+        if current and start < len(dates):
+            position = int(np.searchsorted(store.dates, bins[start:].min()))
+            if position > 0:
+                selected = bins >= bins[start:].min()
+        tails = dict()
+        for name, values in fields.items():
+            new_bins, statistics = aggregate(dates[selected], values[:, selected], unit)
+            tails.update({f'{name}_{statistic}': array for statistic, array in statistics.items()})
+        store.write(np.concatenate((store.dates[:position].astype(new_bins.dtype), new_bins)), tails, position,
+                    **attributes)
+
+
+def level_for(resolution: np.timedelta64) -> str:
+    """
+    Coarsest aggregation level with bins no wider than a resolution.
+
+    :param resolution: requested time resolution
+    :return: level unit, None if the full resolution is needed
+    """
+    level = None
+    for unit, width in LEVELS:
+        if width <= resolution:
+            level = unit
+    return level
+
+
+def measurement_aggregates(filenames, dpid: int, name: str = 'apres', level: str = 'D',
+                           part: str = 'raw') -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Aggregated history of one measurement.
+
+    :param filenames: pickle file, or the pickles of all shards
+    :param dpid: DPID of the measurement
+    :param name: 'resistance', 'apres' or 'chargeability'
+    :param level: 'D', 'W' or 'M'
+    :param part: 'raw' or 'filtered'
+    :return: bins and their min, max, mean and count
+    """
+    return _aggregates(filenames, f'{part}_{level}', name, lambda store: store.row_of(dpid))
+
+
+def cell_aggregates(filenames, task_id: int, x: float, depth: float, name: str = 'resistivity',
+                    level: str = 'D') -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """ Aggregated history of the inverted cell nearest to a point (see cell_history) """
+    def nearest(store):
+        return int(np.argmin((store.index['x'] - x) ** 2 + (store.index['depth'] - depth) ** 2))
+    return _aggregates(filenames, f'inverted_{task_id}_{level}', name, nearest)
+
+
+def aggregate_table(filenames, name: str = 'apres', level: str = 'D',
+                    part: str = 'raw') -> tuple[np.ndarray, np.ndarray, dict[str, np.ndarray]]:
+    """
+    Aggregates of all rows.
+
+    Labelled rows are matched across shards by label, in the order of the last shard.
+
+    :param filenames: pickle file, or the pickles of all shards
+    :param name: field
+    :param level: 'D', 'W' or 'M'
+    :param part: 'raw', 'filtered' or 'inverted_<task>'
+    :return: row labels, bins and the (rows, bins) min, max, mean and count
+    """
+    stores = [HistoryStore(os.path.join(filename + '.history', f'{part}_{level}'))
+              for filename in ([filenames] if isinstance(filenames, str) else filenames)]
+    stores = [store for store in stores if store.days > 0]
+    if len(stores) == 0:
+        return None, calendar_bins(np.array([], dtype='datetime64[D]'), level), dict()
+    labels = stores[-1].labels
+    rows = stores[-1].index['rows']
+    bins, statistics = [], {statistic: [] for statistic in STATISTICS}
+    for store in stores:
+        bins.append(store.dates)
+        for statistic in STATISTICS:
+            statistics[statistic].append(_aligned(store, labels, rows, store.read_all(f'{name}_{statistic}'),
+                                                  MISSING[statistic], f'{part}_{level}'))
+    bins, statistics = _combine(np.concatenate(bins), {statistic: np.concatenate(arrays, axis=1)
+                                                       for statistic, arrays in statistics.items()})
+    return labels, bins, statistics
+
+
+def _aggregates(filenames, store_name: str, name: str, row_of) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    bins, statistics = [], {statistic: [] for statistic in STATISTICS}
+    for filename in [filenames] if isinstance(filenames, str) else filenames:
+        store = HistoryStore(os.path.join(filename + '.history', store_name))
+        if store.days == 0:
+            continue
+        row = row_of(store)
+        if row < 0:
+            continue
+        bins.append(store.dates)
+        for statistic in STATISTICS:
+            statistics[statistic].append(store.read(f'{name}_{statistic}', row)[1].reshape(1, -1))
+    if len(bins) == 0:
+        return np.array([], dtype='datetime64[D]'), {statistic: np.array([]) for statistic in ('min', 'max', 'mean', 'count')}
+    bins, statistics = _combine(np.concatenate(bins), {statistic: np.concatenate(arrays, axis=1)
+                                                       for statistic, arrays in statistics.items()})
+    return bins, {statistic: values[0] for statistic, values in statistics.items()}
+
+
+def _combine(bins: np.ndarray, statistics: dict[str, np.ndarray]) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    # Merge the partial bins of several shards (e.g. a week across two months) and derive the mean
+    order = np.argsort(bins, kind='stable')
+    bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    count = np.add.reduceat(statistics['count'][:, order], starts, axis=1)
+    total = np.add.reduceat(statistics['sum'][:, order], starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, np.nan)
+    return bins[starts], {'min': np.fmin.reduceat(statistics['min'][:, order], starts, axis=1),
+                          'max': np.fmax.reduceat(statistics['max'][:, order], starts, axis=1),
+                          'mean': mean, 'count': count}
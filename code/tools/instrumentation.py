@@ -0,0 +1,118 @@
+"""
+Structured instrumentation of the pipeline stages.
+
+Named spans measure the wall time (and optionally the peak traced memory) of a
+stage, counters record what the stage did (rows ingested, files written, ...).
+Records go to a JSON-lines log or to a Prometheus text file. Instrumentation is
+disabled by default, then span() and count() return immediately.
+"""
+import json
+import os
+import time
+import tracemalloc
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Instrumentation:
+
+    def __init__(self):
+        self.enabled = False
+        self.path = ''
+        self.trace_memory = False
+        self.counters = defaultdict(int)
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.stage_peak_memory = defaultdict(int)
+        self._open_spans = []
+        self._peaks = []  # peak traced memory of the open spans so far, innermost last
+
+    def enable(self, path: str, trace_memory: bool = False) -> None:
+        """
+        Start recording.
+
+        :param path: output file, '.prom' writes a Prometheus text file, anything else JSON lines
+        :param trace_memory: sample the peak Python memory of each span with tracemalloc
+        """
+        self.enabled = True
+        self.path = path
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self) -> None:
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        self.counters[name] += value
+        for span_counters in self._open_spans:
+            span_counters[name] += value
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        span_counters = defaultdict(int)
+        self._open_spans.append(span_counters)
+        if self.trace_memory:
+            # The peak so far belongs to the enclosing span, the inner span starts a new one
+            if len(self._peaks) > 0:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            self._peaks.append(0)
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            peak = None
+            if self.trace_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                # Also a peak of the enclosing span
+                if len(self._peaks) > 0:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            self._open_spans.remove(span_counters)
+            self._record(name, duration, peak, span_counters)
+
+    def _record(self, name: str, duration: float, peak: int, span_counters: dict) -> None:
+        self.stage_seconds[name] += duration
+        self.stage_calls[name] += 1
+        if peak is not None:
+            self.stage_peak_memory[name] = max(self.stage_peak_memory[name], peak)
+        if self.path.endswith('.prom'):
+            self._write_prometheus()
+        else:
+            record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'span': name,
+                      'seconds': round(duration, 6), 'counters': dict(span_counters)}
+            if peak is not None:
+                record['peak_memory_bytes'] = peak
+            with open(self.path, 'a') as fout:
+                fout.write(json.dumps(record) + '\n')
+
+    def _write_prometheus(self) -> None:
+        lines = ['# TYPE gemonpy_stage_seconds_total counter']
+        lines += ['gemonpy_stage_seconds_total{{stage="{}"}} {}'.format(k, v) for k, v in self.stage_seconds.items()]
+        lines += ['# TYPE gemonpy_stage_calls_total counter']
+        lines += ['gemonpy_stage_calls_total{{stage="{}"}} {}'.format(k, v) for k, v in self.stage_calls.items()]
+        if len(self.stage_peak_memory) > 0:
+            lines += ['# TYPE gemonpy_stage_peak_memory_bytes gauge']
+            lines += ['gemonpy_stage_peak_memory_bytes{{stage="{}"}} {}'.format(k, v) for k, v in self.stage_peak_memory.items()]
+        for name, value in self.counters.items():
+            lines += ['# TYPE gemonpy_{}_total counter'.format(name), 'gemonpy_{}_total {}'.format(name, value)]
+        # Atomic replace, a scraper never sees a half-written file
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.path)
+
+
+# Process-wide instance used by the pipeline
+instrumentation = Instrumentation()
+span = instrumentation.span
+count = instrumentation.count
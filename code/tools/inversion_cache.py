@@ -0,0 +1,174 @@
+"""
+Content-addressed cache of inversion results.
+
+A dat file is keyed by the hash of its data block (the file without its first
+line, which only holds the file name), the inversion parameter file and the
+inversion backend. The model outputs of every key are kept in the cache
+directory, so a timestep is only inverted again when its inputs changed, and a
+result of identical inputs is restored without running the inversion. The
+least recently used entries are evicted above a size limit.
+
+Formatting a dat file to hash it costs more than hashing the arrays it is made
+of, so the digest of those arrays (inputs_key) is kept next to the outputs once
+they are known to be up to date, and unchanged timesteps are skipped without
+formatting their dat file.
+"""
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from tools.instrumentation import count
+
+
+# Model outputs of Res2DInv stored for each key
+OUTPUT_EXTENSIONS = ('.xyz', '.inv')
+
+
+class InversionCache:
+
+    def __init__(self, path: str, max_bytes: int = 2 * 1024 ** 3, backend: str = ''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._params = dict()  # params file -> (mtime, size, content)
+
+    def key(self, dat_text: str, params_file: str) -> str:
+        """
+        Hash of the inversion inputs.
+
+        :param dat_text: content of the dat file (any line endings)
+        :param params_file: inversion parameter file
+        :return: hexadecimal SHA-256 digest
+        """
+        digest = hashlib.sha256()
+        # Line endings normalised: the text written and the file read back (text mode) differ in \r\n
+        dat_text = dat_text.replace('\r\n', '\n').replace('\r', '\n')
+        digest.update(dat_text.split('\n', 1)[-1].encode())
+        with open(params_file, 'rb') as fin:
+            digest.update(fin.read())
+        digest.update(self.backend.encode())
+        return digest.hexdigest()
+
+    def inputs_key(self, arrays, params_file: str) -> str:
+        """
+        Hash of the arrays a dat file is formatted from, the inversion parameter file and the backend.
+
+        :param arrays: arrays the content of the dat file depends on (values, masks, geometry)
+        :param params_file: inversion parameter file
+        :return: hexadecimal SHA-256 digest
+        """
+        digest = hashlib.sha256()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(str((array.dtype.str, array.shape)).encode())
+            digest.update(array.tobytes())
+        digest.update(self._read_params(params_file))
+        digest.update(self.backend.encode())
+        return digest.hexdigest()
+
+    def unchanged(self, dat_file: str, inputs: str) -> bool:
+        """ True if the outputs next to dat_file were up to date for the same inputs_key """
+        stem = dat_file[:-4]
+        if not os.path.isfile(stem + '.inputs') or not os.path.isfile(stem + '.xyz'):
+            return False
+        with open(stem + '.inputs', 'r') as fin:
+            return fin.read().strip() == inputs
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def up_to_date(self, dat_file: str, dat_text: str, params_file: str, inputs: str = None) -> bool:
+        """
+        True if the outputs next to dat_file belong to these inputs, restoring them from the cache if possible.
+
+        Outputs of inversions run before the cache existed (no .key file) are considered up to date.
+        The inputs_key of up to date outputs is kept for unchanged, and dropped otherwise.
+        """
+        stem = dat_file[:-4]
+        key = self.key(dat_text, params_file)
+        if os.path.isfile(stem + '.xyz'):
+            current = not os.path.isfile(stem + '.key')
+            if not current:
+                with open(stem + '.key', 'r') as fin:
+                    current = fin.read().strip() == key
+            if current:
+                self._write_inputs(stem, inputs)
+                return True
+        entry = self.entry(key)
+        if not os.path.isdir(entry):
+            count('inversion_cache_misses')
+            self._write_inputs(stem, None)
+            return False
+        for extension in OUTPUT_EXTENSIONS:
+            if os.path.isfile(os.path.join(entry, 'output' + extension)):
+                shutil.copyfile(os.path.join(entry, 'output' + extension), stem + extension)
+        # Recently used entries are evicted last
+        os.utime(entry)
+        self._write_key(stem, key)
+        self._write_inputs(stem, inputs)
+        count('inversion_cache_hits')
+        return True
+
+    def store(self, dat_file: str, params_file: str) -> None:
+        """ Keep the outputs of an inverted dat file """
+        stem = dat_file[:-4]
+        if not os.path.isfile(stem + '.xyz'):
+            return
+        with open(dat_file, 'r') as fin:
+            key = self.key(fin.read(), params_file)
+        entry = self.entry(key)
+        tmp = entry + '.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        for extension in OUTPUT_EXTENSIONS:
+            if os.path.isfile(stem + extension):
+                shutil.copyfile(stem + extension, os.path.join(tmp, 'output' + extension))
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self._write_key(stem, key)
+
+    def evict(self) -> None:
+        """ Remove the least recently used entries until the cache fits in max_bytes """
+        entries = []
+        total = 0
+        for prefix in os.scandir(self.path) if os.path.isdir(self.path) else []:
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+                except OSError:
+                    # Removed or replaced by a concurrent task
+                    continue
+                total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            count('inversion_cache_evictions')
+
+    def _write_key(self, stem: str, key: str) -> None:
+        with open(stem + '.key', 'w') as fout:
+            fout.write(key + '\n')
+
+    def _write_inputs(self, stem: str, inputs: str) -> None:
+        # None: the outputs are not (yet) those of the current inputs
+        if inputs is None:
+            if os.path.isfile(stem + '.inputs'):
+                os.remove(stem + '.inputs')
+            return
+        with open(stem + '.inputs', 'w') as fout:
+            fout.write(inputs + '\n')
+
+    def _read_params(self, params_file: str) -> bytes:
+        # Content of a parameter file, read again only once it changed
+        stat = os.stat(params_file)
+        cached = self._params.get(params_file)
+        if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(params_file, 'rb') as fin:
+                cached = (stat.st_mtime_ns, stat.st_size, fin.read())
+            self._params[params_file] = cached
+        return cached[2]
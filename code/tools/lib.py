@@ -1,37 +1,139 @@
+import os
 import sqlite3
+import threading
 import numpy as np
 import pandas as pd
 
 from contextlib import contextmanager
+from urllib.request import pathname2url
 
-import time
 from functools import wraps
 
+from tools.instrumentation import span
+
+DB_PRAGMAS = {
+    'mmap_size': 256 * 1024 * 1024,  # bytes
+    'cache_size': -64 * 1024,  # KiB
+    'temp_store': 'MEMORY',
+}
+
+
+def db_uri(name: str, immutable: bool = False) -> str:
+    """
+    Read-only SQLite URI of a database file.
+
+    :param name: path to the database
+    :param immutable: the file will not change anymore (finished acquisition),
+        SQLite can skip locking and change detection
+    :return: the URI to pass to sqlite3.connect(..., uri=True)
+    """
+    uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(name)))
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
+
+def open_readonly(name: str, immutable: bool = False, pragmas: dict = None) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_uri(name, immutable), uri=True, check_same_thread=False)
+    for pragma, value in (DB_PRAGMAS if pragmas is None else pragmas).items():
+        connection.execute('PRAGMA {}={}'.format(pragma, value))
+    return connection
+
+
+class ConnectionPool:
+    """
+    One read-only connection per database, reused by every query of an ingest.
+    """
+
+    def __init__(self, immutable: bool = False, pragmas: dict = None, mutable: tuple[str] = ()):
+        self.immutable = immutable
+        self.pragmas = DB_PRAGMAS if pragmas is None else pragmas
+        # Databases that may still be written (e.g. the newest acquisition), never opened immutable
+        self.mutable = {os.path.abspath(name) for name in mutable}
+        self._connections = dict()
+        self._lock = threading.Lock()
+
+    def connect(self, name: str) -> sqlite3.Connection:
+        key = os.path.abspath(name)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = open_readonly(name, self.immutable and key not in self.mutable, self.pragmas)
+                self._connections[key] = connection
+            return connection
+
+    def release(self, name: str) -> None:
+        # Close a database that is not needed anymore in this session
+        with self._lock:
+            connection = self._connections.pop(os.path.abspath(name), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+
+# Sessions opened by each thread (db_connect in another thread does not use them)
+_sessions = threading.local()
+
+
+def _active_pools() -> list[ConnectionPool]:
+    if not hasattr(_sessions, 'pools'):
+        _sessions.pools = []
+    return _sessions.pools
+
+
+@contextmanager
+def db_session(immutable: bool = False, pragmas: dict = None, mutable: tuple[str] = ()):
+    """
+    Share one connection per database between all db_connect calls of this thread in the block.
+
+    :param immutable: open the databases with immutable=1 (finished acquisitions)
+    :param pragmas: PRAGMA settings applied on open, DB_PRAGMAS by default
+    :param mutable: databases that may still be written, opened without immutable=1
+    :return: the ConnectionPool of the session
+    """
+    pool = ConnectionPool(immutable, pragmas, mutable)
+    _active_pools().append(pool)
+    try:
+        yield pool
+    finally:
+        _active_pools().remove(pool)
+        pool.close()
+
+
 @contextmanager
 def db_connect(name):
     """
-    Context manager for database connections.
+    Context manager for read-only database connections.
 
-    :param name:
-    :return:
+    Inside a db_session the pooled connection is returned and kept open,
+    otherwise a connection is opened and closed around the block.
+
+    :param name: path to the database
+    :return: sqlite3 connection
     """
-    connection = sqlite3.connect(name)
-    print('Connected!')
-    yield connection
-    connection.close()
-    print('Connection closed!')
+    pools = _active_pools()
+    if len(pools) > 0:
+        yield pools[-1].connect(name)
+        return
+    connection = open_readonly(name)
+    try:
+        yield connection
+    finally:
+        connection.close()
 
 def my_timer(func):
+    """
+    Record the decorated pipeline stage as an instrumentation span named after the function.
+    """
     @wraps(func)
     def decorated(*args,**kwargs):
-        # BEFORE
-        start = time.time()
-        # CALL
-        wrapped = func(*args,**kwargs)
-        # AFTER
-        end = time.time()
-        print("Time elapsed {}".format(end-start))
-        return wrapped
+        with span(func.__name__):
+            return func(*args,**kwargs)
     return decorated
 
 
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+from io import StringIO
+
+from tools.lib import geometric_factor
+
+
+# Columns of the measurements returned by the readers (electrode x-positions, values, relative error [%])
+INVERSION_DATA_COLUMNS = ('a', 'b', 'm', 'n', 'resistance', 'apres', 'chargeability', 'voltage', 'current', 'res_std')
+
+# Column names of AarhusInv .tx2 files (lower case) and the column they fill
+TX2_ALIASES = {'xa': 'a', 'xb': 'b', 'xm': 'm', 'xn': 'n',
+               'res': 'resistance', 'r': 'resistance', 'rho': 'apres', 'rhoa': 'apres',
+               'ip': 'chargeability', 'ma': 'chargeability',
+               'u': 'voltage', 'v': 'voltage', 'i': 'current', 'dev': 'res_std', 'std': 'res_std'}
+TX2_COMMENTS = ('%', '/', '#')
+
+
+def _is_number(line: str) -> bool:
+    try:
+        float(line.split()[0].replace(',', '.'))
+    except (IndexError, ValueError):
+        return False
+    return True
+
+
+def _with_apres(data: np.ndarray) -> np.ndarray:
+    # Complete the resistance or the apparent resistivity from the other one (surface array)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = geometric_factor(*data[:, :4].T)
+    columns = {name: column for column, name in enumerate(INVERSION_DATA_COLUMNS)}
+    resistance, apres = data[:, columns['resistance']], data[:, columns['apres']]
+    missing = np.isnan(apres)
+    apres[missing] = k[missing] * resistance[missing]
+    missing = np.isnan(resistance)
+    resistance[missing] = apres[missing] / k[missing]
+    return data
+
+
+def read_res2dinv_dat(filename: str) -> tuple[np.ndarray, np.ndarray, dict[str, str]]:
+    """ Vectorized reader for Res2DInv general array [.dat] files
+
+    The header is parsed line by line up to the data block, which is then converted to
+    numbers with a single call. Only the first data set of the file is read (the first
+    time section of a time-lapse file). Rows that are not 4-electrode measurements are NaN.
+
+    Args:
+        filename (str): path to the .dat file (general array, type 11)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, dict[str, str]]: measurements with columns
+            INVERSION_DATA_COLUMNS, an empty (measurements, 0) decay array and the
+            acquisition settings (IP delay and window if the file has chargeability)
+    """
+    with open(filename, 'r') as fin:
+        lines = [line.strip() for line in fin.read().splitlines()]
+
+    # Name, spacing, array type, sub-array type, measurement type comment and value
+    if int(lines[2]) != 11:
+        raise ValueError('{}: only general array (11) Res2DInv files are supported'.format(filename))
+    measurement_type = int(lines[5])  # 0 = apparent resistivity, 1 = resistance
+    row = 6
+    while not _is_number(lines[row]):  # optional settings (e.g. type of geometric factor) and their value
+        row += 2
+    number_of_measurements = int(lines[row])
+    row += 2  # type of x-location
+    has_ip = int(lines[row]) == 1
+    row += 1
+    settings = {}
+    if has_ip:  # name, unit, delay and window of the chargeability
+        settings['IP_WindowSecList'] = ' '.join(lines[row + 2].replace(',', '.').split()[:2])
+        row += 3
+    has_error = lines[row].lower().startswith('error estimate')
+    if has_error:  # Error estimate for data present, type of error estimate and its value
+        row += 3
+    sections = 1
+    if lines[row].lower().startswith('time sequence'):  # number of sections, time unit and section intervals
+        sections = int(lines[row + 2])
+        row += 5 + 2 * (sections - 1)
+
+    # Data: electrodes ax az bx bz mx mz nx nz, the value of each section, [their chargeability] [error]
+    body = '\n'.join(lines[row:row + number_of_measurements]).replace(',', ' ')
+    width = 9 + sections * (1 + has_ip) + has_error
+    table = pd.read_csv(StringIO(body), sep=r'\s+', header=None, names=range(width), dtype=float,
+                        on_bad_lines='skip').to_numpy()
+    table[table[:, 0] != 4] = np.nan
+    data = np.full([len(table), len(INVERSION_DATA_COLUMNS)], np.nan)
+    data[:, :4] = table[:, [1, 3, 5, 7]]
+    data[:, 4 + (measurement_type == 0)] = table[:, 9]
+    if has_ip:
+        data[:, 6] = table[:, 9 + sections]
+    if has_error:  # same unit as the data
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data[:, 9] = table[:, -1] / np.abs(table[:, 9]) * 100
+    return _with_apres(data), np.empty([len(data), 0]), settings
+
+
+def read_aarhusinv_tx2(filename: str) -> tuple[np.ndarray, np.ndarray, dict[str, str]]:
+    """ Vectorized reader for AarhusInv [.tx2] data files
+
+    Lines starting with TX2_COMMENTS are skipped, the first other line names the columns
+    (TX2_ALIASES, case-insensitive, IP gates as IP1, IP2, ...) and the table below it is
+    converted to numbers with a single call. Unknown columns are ignored, missing values
+    ('*') are NaN. The relative error (Dev/Std) is a fraction and returned in %.
+
+    Args:
+        filename (str): path to the .tx2 file
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, dict[str, str]]: measurements with columns
+            INVERSION_DATA_COLUMNS, the (measurements, gates) IP decays and the
+            acquisition settings (none in this format)
+    """
+    with open(filename, 'r') as fin:
+        lines = [line for line in fin.read().splitlines() if line.strip() != '' and not line.lstrip().startswith(TX2_COMMENTS)]
+    names = [name.lower() for name in lines[0].split()]
+    table = pd.read_csv(StringIO('\n'.join(lines[1:])), sep=r'\s+', header=None, names=range(len(names)),
+                        na_values=['*'], on_bad_lines='skip')
+    table = table.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+    data = np.full([len(table), len(INVERSION_DATA_COLUMNS)], np.nan)
+    for column, name in enumerate(names):
+        if name in TX2_ALIASES:
+            data[:, INVERSION_DATA_COLUMNS.index(TX2_ALIASES[name])] = table[:, column]
+    data[:, 9] *= 100
+    gates = sorted((int(name[2:]), column) for column, name in enumerate(names)
+                   if name.startswith('ip') and name[2:].isdigit())
+    decay = table[:, [column for _, column in gates]]
+    return _with_apres(data), decay, {}
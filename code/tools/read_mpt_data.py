@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 from io import StringIO
 
 
@@ -124,3 +125,65 @@ def read_mpt_data_fast(filename: str) -> tuple[np.ndarray, np.ndarray]:
                 data.append([id_a, id_b, id_m, id_n, apres, res, res_std, volt, volt_std, amp, rs])
         # convert to numpy arrays and return
         return np.array(data), np.array(elecs)
+
+
+MPT_DATA_COLUMNS = ('id_a', 'id_b', 'id_m', 'id_n', 'apres', 'res', 'res_std', 'volt', 'volt_std', 'amp', 'rs')
+
+
+def _block(text: str, start: str, ends: tuple[str], skip: int) -> list[str]:
+    """ Lines between a start marker (plus `skip` header lines) and the first end marker """
+    begin = text.find(start)
+    if begin == -1:
+        return []
+    lines = text[begin:].split('\n', skip + 1)
+    if len(lines) <= skip + 1:
+        return []
+    body = lines[-1]
+    stops = [body.find(end) for end in ends]
+    stops = [stop for stop in stops if stop != -1]
+    if len(stops) > 0:
+        body = body[:min(stops)]
+    return [line for line in body.splitlines() if line.strip() != '']
+
+
+def read_mpt_data_vectorized(filename: str) -> tuple[np.ndarray, np.ndarray]:
+    """ Vectorized reader for MPT-DAS [.Ohm] files
+
+    The electrode and data blocks are located once in the file contents, split into
+    token columns in bulk and converted to numbers with a single call per block.
+    Rows with status messages instead of numbers (e.g. 'Error_Zero_Current') are NaN.
+
+    Args:
+        filename (str): path to the .Ohm file
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: measurements with columns MPT_DATA_COLUMNS
+            (electrode indices are zero-based rows of the electrode array) and
+            the electrode positions (x, y, z)
+    """
+    with open(filename, 'r') as fin:
+        text = fin.read()
+
+    # Electrodes: ID x y z ...
+    elec_lines = _block(text, '#elec_start', ('#',), skip=1)
+    elec_tokens = pd.Series(elec_lines, dtype=object).str.split(n=4, expand=True)
+    elec_ids = pd.Index(elec_tokens[0])
+    elecs = elec_tokens.loc[:, 1:3].apply(lambda column: column.str.replace(',', '.')).astype(float).to_numpy()
+
+    # Measurements: number A B M N apres res res_std volt volt_std amp rs ...
+    data_lines = _block(text, '#data_start', ('#data_end', 'Run Compl'), skip=2)
+    data_tokens = pd.Series(data_lines, dtype=object).str.split(n=12, expand=True)
+    data = np.full([len(data_lines), len(MPT_DATA_COLUMNS)], np.nan)
+    if len(data_lines) == 0:
+        return data, elecs
+    for column in range(4):
+        data[:, column] = elec_ids.get_indexer(data_tokens[column + 1])
+    values = data_tokens.reindex(columns=range(5, 12))
+    values = values.apply(lambda column: pd.to_numeric(column.str.replace(',', '.'), errors='coerce'))
+    values = values.to_numpy(dtype=float, copy=True)
+    # A status message shifts the remaining tokens, so the whole row is unusable
+    values[np.isnan(values).any(axis=1)] = np.nan
+    data[:, 4:] = values
+    # Electrode IDs that are not in the electrode block
+    data[:, :4][data[:, :4] < 0] = np.nan
+    return data, elecs
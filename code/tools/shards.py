@@ -0,0 +1,221 @@
+"""
+Time-partitioned storage of GeophysicalTimeSeries.
+
+The raw data, filtered data, inversion results and timestep selections of each period (a month by
+default) are kept in a pickle of their own, with its decay file and journal. A query opens only the
+shards overlapping a date range, new acquisitions go to the shard of their period, and the changes a
+stage made to the opened shards are written back to the shards they belong to.
+"""
+import os
+import pickle
+import shutil
+
+from collections import defaultdict
+
+import numpy as np
+
+from tools.geodata import GeophysicalTimeSeries, GeophysicalTimeSeriesRaw
+
+
+# Bitmasks of GeophysicalTimeSeriesRaw, packed 8 days per byte
+PACKED_FIELDS = ('validity', 'rejection')
+
+
+class ShardedTimeSeries:
+
+    def __init__(self, path: str, period: str = 'M'):
+        self.path = path
+        self.period = period  # numpy datetime unit of a shard: 'M' (month), 'Y' (year), 'W' (week)
+        self.index = self._read_index()  # shard key -> {'dates': raw dates, stage: days processed}
+
+    def keys(self) -> list[str]:
+        return sorted(self.index)
+
+    def key_of(self, dates) -> np.ndarray:
+        """
+        Shards of dates.
+
+        :param dates: datetime64 dates
+        :return: shard key of each date (e.g. '2024-05' for monthly shards)
+        """
+        return np.datetime_as_string(np.asarray(dates).astype(f'datetime64[{self.period}]'))
+
+    def filename(self, key: str) -> str:
+        return os.path.join(self.path, key + '.pickle')
+
+    def dates(self) -> np.ndarray:
+        # Raw dates of all shards, without opening them
+        if len(self.index) == 0:
+            return np.array([], dtype='datetime64[s]')
+        return np.concatenate([self.index[key]['dates'] for key in self.keys()])
+
+    def keys_between(self, start=None, end=None) -> list[str]:
+        keys = self.keys()
+        if start is not None:
+            keys = [key for key in keys if key >= str(self.key_of(np.datetime64(start)))]
+        if end is not None:
+            keys = [key for key in keys if key <= str(self.key_of(np.datetime64(end)))]
+        return keys
+
+    def query(self, start=None, end=None) -> GeophysicalTimeSeries:
+        """
+        Time series of the shards overlapping a date range.
+
+        :param start: first date (None: from the first shard)
+        :param end: last date (None: up to the last shard)
+        :return: all days of the overlapping shards, None if there are none
+        """
+        return self.open(self.keys_between(start, end))
+
+    def open(self, keys: list[str]) -> GeophysicalTimeSeries:
+        # Shards concatenated in key order; changes are tracked for update
+        data = None
+        for key in keys:
+            shard = GeophysicalTimeSeries.load(self.filename(key))
+            if data is None:
+                data = shard
+            else:
+                data.extend(shard)
+        if data is not None:
+            data._journal_start(self.path)
+            data.__dict__['_shard_keys'] = list(keys)
+        return data
+
+    def append(self, raw: GeophysicalTimeSeriesRaw) -> list[str]:
+        """
+        Add new acquisitions to the shards of their period.
+
+        :param raw: raw data of the new days
+        :return: keys of the shards that received days
+        """
+        keys = self.key_of(raw.dates)
+        for key in np.unique(keys):
+            part = raw.take(np.flatnonzero(keys == key))
+            if key in self.index:
+                shard = GeophysicalTimeSeries.load(self.filename(key))
+                shard.raw.extend(part)
+            else:
+                shard = GeophysicalTimeSeries()
+                shard.raw = part
+                self.index[key] = dict()
+            os.makedirs(self.path, exist_ok=True)
+            shard.save(self.filename(key))
+            self.index[key]['dates'] = shard.raw.dates.copy()
+        self._write_index()
+        return np.unique(keys).tolist()
+
+    def update(self, data: GeophysicalTimeSeries) -> None:
+        """
+        Write the changes made to an opened time series back to its shards.
+
+        Only the shards with changed days are loaded and saved, and their journals only record what
+        changed. Attributes without a day axis (e.g. the inversion cache keys) go to the shards
+        changed for the same part, or to all its shards if nothing else changed.
+
+        :param data: time series returned by query or open
+        """
+        parts = data._parts()
+        dirty = defaultdict(set)  # shard key -> part paths
+        whole = set()
+        for path, name, start, value in data._journal_records():
+            if path not in parts or (name is not None and name.startswith('_')):
+                continue
+            part = parts[path]
+            if name is not None and name not in part.JOURNAL_AXES:
+                whole.add(path)
+                continue
+            start = start * 8 if name in PACKED_FIELDS else start
+            for key in np.unique(self.key_of(part.dates[start:])):
+                dirty[key].add(path)
+        for path in whole:
+            if not any(path in paths for paths in dirty.values()):
+                for key in np.unique(self.key_of(parts[path].dates)):
+                    dirty[key].add(path)
+        opened = data.__dict__.get('_shard_keys', [])
+        if any(key not in opened for key in dirty):
+            raise ValueError('Changes outside the opened shards: {}'.format(sorted(set(dirty) - set(opened))))
+        for key in sorted(dirty):
+            shard = GeophysicalTimeSeries.load(self.filename(key))
+            for path in dirty[key]:
+                part = parts[path]
+                index = np.flatnonzero(self.key_of(part.dates) == key)
+                taken = part.take(index, decay=False) if path == ('raw',) else part.take(index)
+                target = shard._parts().get(path)
+                if target is None:
+                    shard._set_part(path, taken)
+                else:
+                    target.assign(taken)
+            shard.save(self.filename(key))
+        data._journal_start(self.path)
+
+    def split(self, data: GeophysicalTimeSeries) -> None:
+        """
+        Store a time series kept in a single pickle as shards.
+
+        :param data: time series, considered processed by every stage
+        """
+        shards = defaultdict(GeophysicalTimeSeries)
+        for path, part in data._parts().items():
+            keys = self.key_of(part.dates)
+            for key in np.unique(keys):
+                shards[key]._set_part(path, part.take(np.flatnonzero(keys == key)))
+        os.makedirs(self.path, exist_ok=True)
+        for key, shard in shards.items():
+            shard.save(self.filename(key))
+            dates = shard.raw.dates.copy() if shard.raw is not None else np.array([], dtype='datetime64[s]')
+            self.index[key] = {'dates': dates, 'qc': len(dates), 'filtered': len(dates)}
+        self._write_index()
+
+    def stale(self, stage: str) -> list[str]:
+        # Shards with days added since the stage last ran on them
+        return [key for key in self.keys() if self.index[key].get(stage, 0) < len(self.index[key]['dates'])]
+
+    def mark_done(self, stage: str, key: str) -> None:
+        self.index[key][stage] = len(self.index[key]['dates'])
+        self._write_index()
+
+    def with_lookback(self, raw: GeophysicalTimeSeriesRaw, duration: np.timedelta64) -> GeophysicalTimeSeriesRaw:
+        """
+        Raw data preceded by the last days of the previous shard (e.g. the look-back of a filter).
+
+        :param raw: raw data of one shard
+        :param duration: look-back before the first day of raw
+        :return: copy of the days within duration before raw and of raw, without decays
+        """
+        keys = self.keys()
+        key = str(self.key_of(raw.dates.min()))
+        combined = raw.take(slice(None), decay=False)
+        position = keys.index(key) if key in keys else 0
+        if position == 0:
+            return combined
+        previous = GeophysicalTimeSeries.load(self.filename(keys[position - 1])).raw
+        if previous is None:
+            return combined
+        days = np.flatnonzero(previous.dates >= raw.dates.min() - duration)
+        if len(days) == 0:
+            return combined
+        history = previous.take(days, decay=False)
+        history.extend(combined)
+        return history
+
+    def compact(self) -> None:
+        # Fold the journal of every shard into its pickle
+        for key in self.keys():
+            GeophysicalTimeSeries.load(self.filename(key)).compact(self.filename(key))
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.index = dict()
+
+    def _read_index(self) -> dict:
+        filename = os.path.join(self.path, 'index.pickle')
+        if not os.path.isfile(filename):
+            return dict()
+        with open(filename, 'rb') as fin:
+            return pickle.load(fin)
+
+    def _write_index(self) -> None:
+        filename = os.path.join(self.path, 'index.pickle')
+        with open(filename + '.tmp', 'wb') as fout:
+            pickle.dump(self.index, fout)
+        os.replace(filename + '.tmp', filename)
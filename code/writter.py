@@ -2,17 +2,33 @@ import os
 
 import numpy as np
 
+from collections import OrderedDict
+from io import StringIO
+
 from tools.geodata import GeophysicalTimeSeries
+from tools.instrumentation import count
 
 def write_dat(data: GeophysicalTimeSeries, filename: str, task_id: int,
               include_chargeability: bool = True, index_to_write: int = -1) -> None:
 
-    dpids = data.raw.task_dpid_lookup[task_id]
-    number_of_measurements = len(dpids)
+    text = format_dat(data, filename, task_id, include_chargeability=include_chargeability, index_to_write=index_to_write)
+    with open(filename, 'w') as fout:
+        fout.write(text)
+    count('files_written')
+
+
+def format_dat(data: GeophysicalTimeSeries, filename: str, task_id: int,
+               include_chargeability: bool = True, index_to_write: int = -1) -> str:
+
+    # Only the quadrupoles acquired on that day and accepted by quality control
+    indices = data.raw.metadata.task_indices(task_id)
+    indices = indices[data.raw.accepted_at(index_to_write)[indices]]
+    abmn = data.raw.metadata.abmn[indices].tolist()
+    number_of_measurements = len(indices)
     spacing = 1
     ip_delay = 0.020
     pulse_length = 4
-    with open(filename, 'w') as fout:
+    with StringIO() as fout:
         # Write Header
         fout.writelines(os.path.basename(filename) + '\n')  # FileName
         fout.writelines(str(spacing) + '\n')  # SpacingX
@@ -27,21 +43,21 @@ def write_dat(data: GeophysicalTimeSeries, filename: str, task_id: int,
             fout.writelines('Chargeability\n')
             fout.writelines('mV/V\n')
             fout.writelines('{} {}\n'.format(ip_delay, pulse_length))
-            for dpid in dpids:
+            resistance = data.raw.resistance[indices, index_to_write]
+            chargeability = data.raw.chargeability[indices, index_to_write]
+            for row in range(number_of_measurements):
                 # Write Data with IP
-                meas_index = data.raw.geometry_lookuptable[dpid]
-                abmn = data.raw.dpid_abmn_lookup[dpid]
-                fout.writelines('4 {} 0 {} 0 {} 0 {} 0 {} {}\n'.format(*abmn, 
-                    data.raw.resistance[meas_index, index_to_write],
-                    data.raw.chargeability[meas_index, index_to_write]))
+                fout.writelines('4 {} 0 {} 0 {} 0 {} 0 {} {}\n'.format(*abmn[row], 
+                    resistance[row],
+                    chargeability[row]))
         else:
             fout.writelines('0\n')
-            for dpid in dpids:
+            resistance = data.raw.resistance[indices, index_to_write]
+            for row in range(number_of_measurements):
                 # Write Data without IP
-                meas_index = data.raw.geometry_lookuptable[dpid]
-                abmn = data.raw.dpid_abmn_lookup[dpid]
-                fout.writelines('4 {} 0 {} 0 {} 0 {} 0 {}\n'.format(*abmn, 
-                    data.raw.resistance[meas_index, index_to_write]))
+                fout.writelines('4 {} 0 {} 0 {} 0 {} 0 {}\n'.format(*abmn[row], 
+                    resistance[row]))
+        return fout.getvalue()
 
 
 def write_dat_timelapse(data: GeophysicalTimeSeries, filename: str, task_id: int,
@@ -49,57 +65,107 @@ def write_dat_timelapse(data: GeophysicalTimeSeries, filename: str, task_id: int
                         index_to_write: int = -1,
                         index_for_baseline: int = 0) -> None:
 
-    dpids = data.raw.task_dpid_lookup[task_id]
-    number_of_measurements = len(dpids)
-    spacing = 1
-    ip_delay = 0.020
-    pulse_length = 4
-    with open(filename, 'w') as fout:
-        # Write Header
-        fout.writelines(os.path.basename(filename) + '\n')  # FileName
-        fout.writelines(str(spacing) + '\n')  # SpacingX
-        fout.writelines('11\n')  # General Array File
-        fout.writelines('0\n')  # ArrayCode
-        fout.writelines('Type of measurement (0=app.resistivity,1=resistance)\n')
-        fout.writelines('1\n')
-        fout.writelines('Type of geometric factor (0=Horizontal distance,1=Linear distance)\r\n')
-        fout.writelines('0\r\n')
-        fout.writelines(str(number_of_measurements) + '\n')
-        fout.writelines('2\n')
-        if include_chargeability:
-            fout.writelines('1\n')
-            fout.writelines('Chargeability\n')
-            fout.writelines('mV/V\n')
-            fout.writelines('{} {}\n'.format(ip_delay, pulse_length))
+    # Two time sections: the baseline (the reference) and the day to write
+    writer = TimelapseWriter(data, task_id, include_chargeability=include_chargeability)
+    writer.write(filename, [index_for_baseline, index_to_write])
+
+
+SECTION_ORDINALS = ('Second', 'Third', 'Fourth', 'Fifth', 'Sixth', 'Seventh', 'Eighth', 'Ninth', 'Tenth')
+
+
+class TimelapseWriter:
+    """ Res2DInv time-lapse dat files of one task with two or more time sections
+
+    The electrode columns of the task and the value columns of each day are formatted once
+    and reused by every file containing that day (e.g. a fixed or rolling baseline).
+    """
+
+    def __init__(self, data: GeophysicalTimeSeries, task_id: int, include_chargeability: bool = True,
+                 cache_size: int = 16):
+        self.data = data
+        self.include_chargeability = include_chargeability
+        self.cache_size = cache_size
+        self.indices = data.raw.metadata.task_indices(task_id)
+        self.electrodes = np.array(['4 {} 0 {} 0 {} 0 {} 0'.format(*abmn)
+                                    for abmn in data.raw.metadata.abmn[self.indices].tolist()], dtype=object)
+        self._columns = OrderedDict()
+
+    def columns(self, index_day: int) -> tuple[np.ndarray, np.ndarray]:
+        """ Formatted resistance and chargeability of one day (task quadrupoles) """
+        index_day = range(len(self.data.raw.dates))[index_day]
+        if index_day in self._columns:
+            self._columns.move_to_end(index_day)
         else:
-            fout.writelines('0\n')
-        fout.writelines('Time sequence data \n')
-        fout.writelines('Number of time sections \n')
-        fout.writelines('2 \n')
-        fout.writelines('Time unit \n')
-        fout.writelines('Day \n')
-        fout.writelines('Second time section interval \n')
-        fout.writelines('1 \n')
-        # Write data
-        if include_chargeability:
-            for dpid in dpids:
-                # Write Data with IP
-                meas_index = data.raw.geometry_lookuptable[dpid]
-                abmn = data.raw.dpid_abmn_lookup[dpid]
-                fout.writelines('4 {} 0 {} 0 {} 0 {} 0 {} {} {} {}\n'.format(*abmn, 
-                    data.raw.resistance[meas_index, index_to_write],
-                    data.raw.resistance[meas_index, index_for_baseline],
-                    data.raw.chargeability[meas_index, index_to_write],
-                    data.raw.chargeability[meas_index, index_for_baseline]))
+            resistance = np.array(list(map(str, self.data.raw.resistance[self.indices, index_day])), dtype=object)
+            chargeability = None
+            if self.include_chargeability:
+                chargeability = np.array(list(map(str, self.data.raw.chargeability[self.indices, index_day])), dtype=object)
+            self._columns[index_day] = (resistance, chargeability)
+            if len(self._columns) > self.cache_size:
+                self._columns.popitem(last=False)
+        return self._columns[index_day]
+
+    def header(self, filename: str, number_of_measurements: int, intervals: list[float]) -> str:
+        """ Header of a time-lapse dat file
+
+        Args:
+            filename (str): dat file
+            number_of_measurements (int): data rows
+            intervals (list[float]): time [days] between each time section and the one before it
+
+        Returns:
+            str: the header lines
+        """
+        number_of_sections = len(intervals) + 1
+        spacing = 1
+        ip_delay = 0.020
+        pulse_length = 4
+        lines = [os.path.basename(filename) + '\n',  # FileName
+                 str(spacing) + '\n',  # SpacingX
+                 '11\n',  # General Array File
+                 '0\n',  # ArrayCode
+                 'Type of measurement (0=app.resistivity,1=resistance)\n',
+                 '1\n',
+                 'Type of geometric factor (0=Horizontal distance,1=Linear distance)\r\n',
+                 '0\r\n',
+                 str(number_of_measurements) + '\n',
+                 '2\n']
+        if self.include_chargeability:
+            lines += ['1\n', 'Chargeability\n', 'mV/V\n', '{} {}\n'.format(ip_delay, pulse_length)]
         else:
-            for dpid in dpids:
-                # Write Data without IP
-                meas_index = data.raw.geometry_lookuptable[dpid]
-                abmn = data.raw.dpid_abmn_lookup[dpid]
-                fout.writelines('4 {} 0 {} 0 {} 0 {} 0 {} {}\n'.format(*abmn, 
-                    data.raw.resistance[meas_index, index_to_write],
-                    data.raw.resistance[meas_index, index_for_baseline]))
-        fout.writelines('0\r\n')
-        fout.writelines('0\r\n')
-        fout.writelines('0\r\n')
-        fout.writelines('0\r\n')
+            lines += ['0\n']
+        lines += ['Time sequence data \n', 'Number of time sections \n', '{} \n'.format(number_of_sections),
+                  'Time unit \n', 'Day \n']
+        for section in range(1, number_of_sections):
+            ordinal = SECTION_ORDINALS[section - 1] if section <= len(SECTION_ORDINALS) else f'Time section {section + 1}'
+            lines += [f'{ordinal} time section interval \n', '{:g} \n'.format(round(intervals[section - 1], 4))]
+        return ''.join(lines)
+
+    def write(self, filename: str, sections: list[int]) -> None:
+        """ Write one time-lapse dat file
+
+        Args:
+            filename (str): dat file
+            sections (list[int]): day index of each time section, in chronological order
+        """
+        text = self.format(filename, sections)
+        with open(filename, 'w') as fout:
+            fout.write(text)
+        count('files_written')
+
+    def format(self, filename: str, sections: list[int]) -> str:
+        # Content of a time-lapse dat file
+        # Only the quadrupoles acquired and accepted on every section
+        accepted = np.ones(len(self.indices), dtype=bool)
+        for index_day in sections:
+            accepted &= self.data.raw.accepted_at(index_day)[self.indices]
+        rows = np.flatnonzero(accepted)
+        columns = [self.columns(index_day) for index_day in sections]
+        blocks = [self.electrodes[rows]] + [resistance[rows] for resistance, _ in columns]
+        if self.include_chargeability:
+            blocks += [chargeability[rows] for _, chargeability in columns]
+        lines = [' '.join(line) + '\n' for line in zip(*blocks)]
+        # Elapsed days between consecutive sections
+        dates = self.data.raw.dates[list(sections)].astype('datetime64[s]')
+        intervals = (np.diff(dates) / np.timedelta64(1, 'D')).tolist()
+        return self.header(filename, len(rows), intervals) + ''.join(lines) + '0\r\n' * 4